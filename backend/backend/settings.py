@@ -3,6 +3,7 @@ from pathlib import Path
 import os
 from dotenv import load_dotenv
 import dj_database_url
+from corsheaders.defaults import default_headers
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -16,6 +17,15 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY')
 
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+# Сколько секунд initData Telegram Web App считается действительным (по auth_date)
+TELEGRAM_INIT_DATA_MAX_AGE = int(os.environ.get('TELEGRAM_INIT_DATA_MAX_AGE', 60 * 60 * 24))
+# Размер LRU проверенных initData в каждом процессе (см. shop/authentication.py)
+TELEGRAM_AUTH_CACHE_SIZE = 10000
+
+# Отправитель уведомлений из очереди OutboxMessage (см. shop/outbox.py)
+OUTBOX_SENDER = 'shop.outbox.TelegramSender'
+
 # Режим отладки. На сервере должен быть 'False'.
 DEBUG = os.environ.get('DJANGO_DEBUG', '') != 'False'
 
@@ -34,6 +44,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'whitenoise.runserver_nostatic',
     # Сторонние приложения
     'django_ckeditor_5',
@@ -102,6 +113,39 @@ DATABASES = {
 }
 
 
+# --- Кэш ---
+# В production используется общий Redis (карточки товаров, версии каталога и т.д. должны
+# инвалидироваться сразу во всех воркерах gunicorn). Без REDIS_URL - локальный кэш процесса.
+
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
+# Корзины живут в кэше и сбрасываются в БД фоновой задачей раз в CART_FLUSH_INTERVAL
+# секунд (см. shop/carts.py). Без общего кэша (Redis) процессы не видят корзины
+# друг друга, поэтому тогда каждое изменение сразу пишется в БД.
+CART_WRITE_BEHIND = bool(REDIS_URL)
+CART_FLUSH_INTERVAL = int(os.environ.get('CART_FLUSH_INTERVAL', 5))
+
+# Просмотры статей копятся в кэше и сбрасываются в БД раз в ARTICLE_VIEWS_FLUSH_INTERVAL
+# секунд (см. shop/counters.py). Без Redis каждый просмотр сразу пишется в БД.
+ARTICLE_VIEWS_BUFFERED = bool(REDIS_URL)
+ARTICLE_VIEWS_FLUSH_INTERVAL = int(os.environ.get('ARTICLE_VIEWS_FLUSH_INTERVAL', 30))
+# Засчитывать не больше одного просмотра статьи в день от одного пользователя Telegram
+ARTICLE_VIEWS_DEDUP = os.environ.get('ARTICLE_VIEWS_DEDUP', 'True') != 'False'
+
 # --- Настройки для Django REST Framework и CORS ---
 
 REST_FRAMEWORK = {
@@ -113,6 +157,8 @@ REST_FRAMEWORK = {
 # Пример для .env: CORS_ALLOWED_ORIGINS_STR=https://bf55.ru,https://www.bf55.ru
 cors_origins_str = os.environ.get('CORS_ALLOWED_ORIGINS_STR', 'http://localhost:3000')
 CORS_ALLOWED_ORIGINS = [origin.strip() for origin in cors_origins_str.split(',')]
+# Idempotency-Key: повторная отправка заказа возвращает уже созданный заказ
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
 
 
 # --- Настройки для работы за Reverse Proxy (Nginx) в Production ---
@@ -156,6 +202,12 @@ STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Миниатюры (ImageSpecField) генерирует воркер run_thumbnail_worker при загрузке
+# изображения, а обращение к URL миниатюры не трогает хранилище (см. shop/thumbnails.py)
+IMAGEKIT_DEFAULT_CACHEFILE_STRATEGY = 'shop.thumbnails.QueuedThumbnailStrategy'
+# Процессов рендеринга миниатюр в воркере и команде rebuild_thumbnails
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', os.cpu_count() or 1))
+
 
 # --- Прочие Настройки ---
 
@@ -1,16 +1,26 @@
 # backend/shop/admin.py
-import csv
 from django.contrib import admin, messages
-from django.http import HttpResponse
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from django.utils.html import format_html
+from datetime import timedelta
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
 # 1. ИЗМЕНЕНИЕ: Импортируем forms из django
 from django import forms
 from .models import (
     InfoPanel, Category, Product, ProductImage, PromoBanner, ProductInfoCard,
     DiscountRule, ColorGroup, ShopSettings, FaqItem, ShopImage,
     Feature, CharacteristicCategory, Characteristic, ProductCharacteristic, Cart,
-    CartItem, Order, OrderItem, ArticleCategory, Article
+    CartItem, Order, OrderItem, OutboxMessage, ArticleCategory, Article, ProductDocument, SalesRollupState,
+    ThumbnailJob
 )
+from .caching import invalidate_product_cards_on_commit
+from .analytics import sales_dashboard
+from .documents import rebuild_product_document
+from .exports import csv_response, order_item_rows, order_rows
 
 class MultipleFileInput(forms.FileInput):
     """
@@ -25,6 +35,60 @@ class MultipleFileInput(forms.FileInput):
         else:
             self.attrs = {}
 
+# --- Быстрые списки для больших таблиц (заказы, товары, корзины) ---
+
+# Ниже этого числа строк точный COUNT(*) дешев, выше - берется оценка PostgreSQL
+ESTIMATED_COUNT_THRESHOLD = 100_000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор, который для больших таблиц без фильтров берет оценку числа строк
+    из статистики PostgreSQL (pg_class.reltuples) вместо точного COUNT(*).
+    С фильтрами и поиском число считается точно (по индексам).
+    """
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                    [connection.ops.quote_name(queryset.model._meta.db_table)]
+                )
+                row = cursor.fetchone()
+            if row and row[0] > ESTIMATED_COUNT_THRESHOLD:
+                return row[0]
+        return super().count
+
+
+class LargeTableAdminMixin:
+    paginator = EstimatedCountPaginator
+    # Не считать второй раз общее число строк рядом с результатом поиска/фильтра
+    show_full_result_count = False
+
+
+class CategoryPathListFilter(admin.RelatedFieldListFilter):
+    """Фильтр по категории: полные названия берутся одним запросом, а не обходом родителей для каждой."""
+    def field_choices(self, field, request, model_admin):
+        return sorted(Category.full_paths().items(), key=lambda item: item[1])
+
+
+class DeliveryMethodListFilter(admin.SimpleListFilter):
+    """Фильтр по способу доставки без SELECT DISTINCT по всей таблице заказов."""
+    title = "Способ доставки"
+    parameter_name = 'delivery_method'
+
+    def lookups(self, request, model_admin):
+        return Order.DeliveryMethod.choices
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(delivery_method=self.value())
+        return queryset
+
+
 # --- Все классы Inline остаются без изменений ---
 class FeatureInline(admin.TabularInline):
     model = Feature
@@ -86,12 +150,12 @@ class ProductAdminForm(forms.ModelForm):
 
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     # 3. ИЗМЕНЕНИЕ: Подключаем нашу кастомную форму
     form = ProductAdminForm
 
     list_display = ('name', 'category', 'regular_price', 'is_active', 'display_deal_status')
-    list_filter = ('category', 'is_active', 'info_panels', 'color_group')
+    list_filter = (('category', CategoryPathListFilter), 'is_active', 'info_panels', 'color_group')
     search_fields = ('name', 'description', 'characteristics__characteristic__name', 'characteristics__value')
     list_editable = ('is_active',)
 
@@ -119,7 +183,25 @@ class ProductAdmin(admin.ModelAdmin):
         }),
     )
 
-    filter_horizontal = ('related_products', 'info_panels',)
+    filter_horizontal = ('info_panels',)
+    # Поиск вместо выпадающих списков: форма не загружает все товары и категории
+    autocomplete_fields = ('category', 'color_group', 'related_products')
+
+    def get_list_display(self, request):
+        # Полные названия категорий одним запросом на страницу (Category.__str__ ходил бы к родителям)
+        category_paths = Category.full_paths()
+
+        @admin.display(description='Категория', ordering='category__name')
+        def category(obj):
+            return category_paths.get(obj.category_id, '')
+
+        return [category if field == 'category' else field for field in super().get_list_display(request)]
+
+    def get_search_fields(self, request):
+        # Автодополнение (сопутствующие товары, цели скидок) ищет только по названию, без JOIN по характеристикам
+        if request.resolver_match and request.resolver_match.url_name == 'autocomplete':
+            return ('name',)
+        return super().get_search_fields(request)
 
     # 5. ИЗМЕНЕНИЕ: Переопределяем метод сохранения модели
     def save_model(self, request, obj, form, change):
@@ -149,14 +231,27 @@ class ProductAdmin(admin.ModelAdmin):
 
     actions = ['make_active', 'make_inactive', 'duplicate_product']
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Инлайны и M2M сохранены - сразу собираем документ страницы,
+        # чтобы правка была видна без ожидания фоновой задачи
+        rebuild_product_document(form.instance.pk)
+
     def make_active(self, request, queryset):
-        queryset.update(is_active=True)
+        self._set_active(queryset, True)
     make_active.short_description = "Сделать выделенные товары активными"
 
     def make_inactive(self, request, queryset):
-        queryset.update(is_active=False)
+        self._set_active(queryset, False)
     make_inactive.short_description = "Сделать выделенные товары неактивными"
 
+    def _set_active(self, queryset, is_active):
+        # update() не вызывает сигналы, поэтому карточки и документы сбрасываем явно
+        product_ids = list(queryset.values_list('id', flat=True))
+        Product.objects.filter(id__in=product_ids).update(is_active=is_active)
+        invalidate_product_cards_on_commit(product_ids)
+        ProductDocument.mark_stale(product_ids)
+
     @admin.action(description='Дублировать выбранные товары')
     def duplicate_product(self, request, queryset):
         if queryset.count() > 5:
@@ -204,6 +299,15 @@ class CategoryAdmin(admin.ModelAdmin):
     list_display = ('__str__',)
     search_fields = ('name',)
 
+    def get_list_display(self, request):
+        category_paths = Category.full_paths()
+
+        @admin.display(description='Категория', ordering='name')
+        def full_path(obj):
+            return category_paths.get(obj.id, obj.name)
+
+        return (full_path,)
+
 @admin.register(ColorGroup)
 class ColorGroupAdmin(admin.ModelAdmin):
     list_display = ('name',)
@@ -254,6 +358,7 @@ class DiscountRuleAdmin(admin.ModelAdmin):
     list_filter = ('discount_type', 'is_active')
     list_editable = ('is_active',)
     search_fields = ('name',)
+    autocomplete_fields = ('product_target', 'category_target')
 
     fieldsets = (
         (None, {
@@ -278,7 +383,7 @@ class ShopSettingsAdmin(admin.ModelAdmin):
 
     fieldsets = (
         ('Основные настройки', {
-            'fields': ('manager_username', 'contact_phone')
+            'fields': ('manager_username', 'manager_chat_id', 'contact_phone')
         }),
         ('Настройки страниц', {
             'classes': ('collapse',),
@@ -342,13 +447,26 @@ class CartItemInline(admin.TabularInline):
     verbose_name = "Товар в корзине"
     verbose_name_plural = "Товары в корзине"
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+
 @admin.register(Cart)
-class CartAdmin(admin.ModelAdmin):
+class CartAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('telegram_id', 'created_at', 'updated_at')
     search_fields = ('telegram_id',)
+    ordering = ('-updated_at',)
     inlines = [CartItemInline]
     readonly_fields = ('telegram_id', 'created_at', 'updated_at')
 
+    def get_search_results(self, request, queryset, search_term):
+        # Точный поиск по Telegram ID идет по уникальному индексу (icontains сканировал бы всю таблицу)
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        if not search_term.isdigit():
+            return queryset.none(), False
+        return queryset.filter(telegram_id=int(search_term)), False
+
     def has_add_permission(self, request):
         return False
 
@@ -363,10 +481,16 @@ class OrderItemInline(admin.TabularInline):
     verbose_name = "Товар в заказе"
     verbose_name_plural = "Товары в заказе"
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+
+DASHBOARD_PERIODS = (7, 30, 90, 365)
+
+
 @admin.register(Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('id', 'status', 'get_full_name', 'delivery_method', 'city', 'final_total', 'created_at')
-    list_filter = ('status', 'delivery_method', 'created_at')
+    list_filter = ('status', DeliveryMethodListFilter, 'created_at')
     search_fields = ('id', 'first_name', 'last_name', 'phone', 'city', 'cdek_office_address')
 
     readonly_fields = (
@@ -374,7 +498,7 @@ class OrderAdmin(admin.ModelAdmin):
         'subtotal', 'discount_amount', 'final_total', 'applied_rule'
     )
     inlines = [OrderItemInline]
-    actions = ['export_as_csv']
+    actions = ['export_as_csv', 'export_items_as_csv']
 
     fieldsets = (
         ('Основная информация', {'fields': ('id', 'status', 'created_at', 'telegram_id')}),
@@ -405,21 +529,77 @@ class OrderAdmin(admin.ModelAdmin):
     def has_add_permission(self, request):
         return False
 
+    def get_urls(self):
+        return [
+            path('dashboard/', self.admin_site.admin_view(self.dashboard_view), name='shop_order_dashboard'),
+        ] + super().get_urls()
+
+    def dashboard_view(self, request):
+        """Отчет по продажам за период. Читает только дневные агрегаты (см. analytics.py)."""
+        try:
+            days = int(request.GET.get('days', 30))
+        except ValueError:
+            days = 30
+        if days not in DASHBOARD_PERIODS:
+            days = 30
+        date_to = timezone.localdate()
+        date_from = date_to - timedelta(days=days - 1)
+        data = sales_dashboard(date_from, date_to)
+        status_labels = dict(Order.OrderStatus.choices)
+        data['statuses'] = [dict(row, label=status_labels.get(row['status'], row['status'])) for row in data['statuses']]
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': "Продажи",
+            'days': days,
+            'periods': DASHBOARD_PERIODS,
+            'date_from': date_from,
+            'date_to': date_to,
+            'watermark': SalesRollupState.load().watermark,
+            **data,
+        }
+        return TemplateResponse(request, 'admin/shop/order/dashboard.html', context)
+
     @admin.action(description='Экспортировать выбранные заказы в CSV')
     def export_as_csv(self, request, queryset):
-        meta = self.model._meta
-        field_names = [
-            'id', 'status', 'last_name', 'first_name', 'patronymic', 'phone',
-            'delivery_method', 'city', 'district', 'street', 'house',
-            'apartment', 'postcode', 'cdek_office_address', 'final_total', 'created_at'
-        ]
-        response = HttpResponse(content_type='text/csv; charset=utf-8')
-        response['Content-Disposition'] = f'attachment; filename={meta.verbose_name_plural}.csv'
-        writer = csv.writer(response)
-        writer.writerow(field_names)
-        for obj in queryset:
-            writer.writerow([getattr(obj, field) for field in field_names])
-        return response
+        return csv_response(order_rows(queryset), self.model._meta.verbose_name_plural)
+
+    @admin.action(description='Экспортировать выбранные заказы с товарами в CSV')
+    def export_items_as_csv(self, request, queryset):
+        return csv_response(order_item_rows(queryset), 'Заказы с товарами')
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'created_at', 'sent_at', 'attempts', 'available_at')
+    list_filter = ('kind', ('sent_at', admin.EmptyFieldListFilter))
+    readonly_fields = ('kind', 'payload', 'created_at', 'available_at', 'attempts', 'sent_at', 'last_error')
+    actions = ['retry']
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description='Отправить повторно')
+    def retry(self, request, queryset):
+        updated = queryset.filter(sent_at__isnull=True).update(attempts=0, available_at=timezone.now(), last_error='')
+        self.message_user(request, f"Поставлено в очередь повторно: {updated}.", messages.SUCCESS)
+
+
+@admin.register(ThumbnailJob)
+class ThumbnailJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'model', 'object_id', 'source_name', 'attempts', 'available_at')
+    list_filter = ('model',)
+    readonly_fields = ('model', 'object_id', 'source_field', 'source_name', 'created_at', 'available_at', 'attempts', 'last_error')
+    actions = ['retry']
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description='Сгенерировать повторно')
+    def retry(self, request, queryset):
+        updated = queryset.update(attempts=0, available_at=timezone.now(), last_error='')
+        self.message_user(request, f"Поставлено в очередь повторно: {updated}.", messages.SUCCESS)
 
 
 @admin.register(ArticleCategory)
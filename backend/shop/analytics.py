@@ -0,0 +1,181 @@
+# backend/shop/analytics.py
+"""
+Дневные агрегаты продаж для отчетов в админке.
+
+Агрегаты (SalesDay, ProductSalesDay, CategorySalesDay, DiscountRuleSalesDay)
+обновляются инкрементально: задача update_sales_rollups (scheduler.py) находит
+заказы, измененные после водяного знака (Order.updated_at), и пересчитывает
+только затронутые дни. Пересчет дня целиком (а не прибавление разницы) делает
+обновление идемпотентным: смена статуса или повторный проход не задвоят цифры.
+
+Дашборд (OrderAdmin.dashboard_view) читает только агрегаты и не сканирует историю заказов.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import (
+    CategorySalesDay, DiscountRuleSalesDay, Order, OrderItem, ProductSalesDay, SalesDay, SalesRollupState
+)
+
+# Заказы, измененные за последнюю минуту, берутся следующим проходом:
+# транзакция, начатая раньше водяного знака, могла еще не закоммититься
+ROLLUP_LAG = timedelta(minutes=1)
+
+ROLLUP_MODELS = (SalesDay, ProductSalesDay, CategorySalesDay, DiscountRuleSalesDay)
+
+MONEY = DecimalField(max_digits=14, decimal_places=2)
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _created_in_days(days, field='created_at'):
+    """
+    Условие "создан в один из дней" диапазонами [начало дня, начало следующего) по
+    местному времени. В отличие от фильтра по TruncDate, использует индекс по created_at.
+    Идущие подряд дни объединяются в один диапазон.
+    """
+    ranges = []
+    for day in sorted(days):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + timedelta(days=1)
+        else:
+            ranges.append([day, day + timedelta(days=1)])
+    condition = Q()
+    for first, after_last in ranges:
+        condition |= Q(**{f'{field}__gte': _day_start(first), f'{field}__lt': _day_start(after_last)})
+    return condition
+
+
+def _orders_by_day(days):
+    return Order.objects.filter(_created_in_days(days)).annotate(day=TruncDate('created_at'))
+
+
+def rebuild_sales_days(days):
+    """Пересчитывает агрегаты за указанные дни (по местному времени, TIME_ZONE)."""
+    days = sorted(set(days))
+    if not days:
+        return 0
+
+    by_status = _orders_by_day(days).values('day', 'status').annotate(
+        orders_count=Count('id'),
+        subtotal_sum=Sum('subtotal'),
+        discount_sum=Sum('discount_amount'),
+        total_sum=Sum('final_total'),
+    ).order_by()
+
+    paid_orders = _orders_by_day(days).exclude(status=Order.OrderStatus.CANCELED)
+    by_rule = paid_orders.filter(applied_rule__isnull=False).exclude(applied_rule='').values('day', 'applied_rule').annotate(
+        orders_count=Count('id'),
+        discount_sum=Sum('discount_amount'),
+        total_sum=Sum('final_total'),
+    ).order_by()
+
+    by_product = OrderItem.objects.filter(_created_in_days(days, 'order__created_at'))\
+        .annotate(day=TruncDate('order__created_at'))\
+        .exclude(order__status=Order.OrderStatus.CANCELED)\
+        .values('day', 'product_id', 'product__category_id').annotate(
+            quantity_sum=Sum('quantity'),
+            revenue_sum=Sum(F('quantity') * F('price_at_purchase'), output_field=MONEY),
+        ).order_by()
+
+    product_rows = []
+    categories = defaultdict(lambda: [0, 0])
+    for row in by_product:
+        product_rows.append(ProductSalesDay(
+            day=row['day'], product_id=row['product_id'], quantity=row['quantity_sum'], revenue=row['revenue_sum']
+        ))
+        totals = categories[row['day'], row['product__category_id']]
+        totals[0] += row['quantity_sum']
+        totals[1] += row['revenue_sum']
+
+    with transaction.atomic():
+        for model in ROLLUP_MODELS:
+            model.objects.filter(day__in=days).delete()
+        SalesDay.objects.bulk_create([
+            SalesDay(
+                day=row['day'], status=row['status'], orders_count=row['orders_count'],
+                subtotal=row['subtotal_sum'], discount_amount=row['discount_sum'], final_total=row['total_sum']
+            )
+            for row in by_status
+        ])
+        DiscountRuleSalesDay.objects.bulk_create([
+            DiscountRuleSalesDay(
+                day=row['day'], applied_rule=row['applied_rule'], orders_count=row['orders_count'],
+                discount_amount=row['discount_sum'], final_total=row['total_sum']
+            )
+            for row in by_rule
+        ])
+        ProductSalesDay.objects.bulk_create(product_rows, batch_size=1000)
+        CategorySalesDay.objects.bulk_create([
+            CategorySalesDay(day=day, category_id=category_id, quantity=quantity, revenue=revenue)
+            for (day, category_id), (quantity, revenue) in categories.items()
+        ])
+    return len(days)
+
+
+def update_sales_rollups():
+    """Пересчитывает дни с заказами, измененными после водяного знака. Возвращает число дней."""
+    upper = timezone.now() - ROLLUP_LAG
+    with transaction.atomic():
+        # Блокировка строки состояния: два прохода не обновляют агрегаты одновременно
+        SalesRollupState.load()
+        state = SalesRollupState.objects.select_for_update().get(pk=1)
+
+        changed = Order.objects.filter(updated_at__lte=upper)
+        if state.watermark is not None:
+            changed = changed.filter(updated_at__gt=state.watermark)
+        days = set(changed.annotate(day=TruncDate('created_at')).values_list('day', flat=True).distinct())
+
+        rebuild_sales_days(days)
+        state.watermark = upper
+        state.save()
+    return len(days)
+
+
+def rebuild_all_sales_rollups():
+    """Полный пересчет агрегатов за всю историю (первичное заполнение)."""
+    days = set(Order.objects.annotate(day=TruncDate('created_at')).values_list('day', flat=True).distinct())
+    with transaction.atomic():
+        for model in ROLLUP_MODELS:
+            model.objects.exclude(day__in=days).delete()
+        rebuild_sales_days(days)
+        state = SalesRollupState.load()
+        state.watermark = timezone.now() - ROLLUP_LAG
+        state.save()
+    return len(days)
+
+
+def sales_dashboard(date_from, date_to, top=10):
+    """Данные дашборда за период [date_from, date_to] - только из агрегатов."""
+    period = {'day__gte': date_from, 'day__lte': date_to}
+    paid_days = SalesDay.objects.filter(**period).exclude(status=Order.OrderStatus.CANCELED)
+
+    totals = paid_days.aggregate(
+        orders_count_sum=Sum('orders_count'), subtotal_sum=Sum('subtotal'),
+        discount_amount_sum=Sum('discount_amount'), final_total_sum=Sum('final_total'),
+    )
+    return {
+        'totals': totals,
+        'daily': paid_days.values('day').annotate(
+            orders_count_sum=Sum('orders_count'), final_total_sum=Sum('final_total'),
+        ).order_by('-day'),
+        'statuses': SalesDay.objects.filter(**period).values('status').annotate(
+            orders_count_sum=Sum('orders_count'), final_total_sum=Sum('final_total'),
+        ).order_by('-orders_count_sum'),
+        'products': ProductSalesDay.objects.filter(**period).values('product_id', 'product__name').annotate(
+            quantity_sum=Sum('quantity'), revenue_sum=Sum('revenue'),
+        ).order_by('-revenue_sum')[:top],
+        'categories': CategorySalesDay.objects.filter(**period).values('category_id', 'category__name').annotate(
+            quantity_sum=Sum('quantity'), revenue_sum=Sum('revenue'),
+        ).order_by('-revenue_sum')[:top],
+        'rules': DiscountRuleSalesDay.objects.filter(**period).values('applied_rule').annotate(
+            orders_count_sum=Sum('orders_count'), discount_amount_sum=Sum('discount_amount'), final_total_sum=Sum('final_total'),
+        ).order_by('-orders_count_sum'),
+    }
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shop'
+
+    def ready(self):
+        # Подключаем обработчики сигналов (материализованные пути категорий и т.д.)
+        from . import signals  # noqa: F401
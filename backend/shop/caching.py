@@ -0,0 +1,211 @@
+# backend/shop/caching.py
+"""
+Кэш готовых JSON-фрагментов карточек товаров (ProductListSerializer)
+и версии общих данных (дерево категорий, правила скидок, лента блога).
+
+Ключ фрагмента содержит версию товара. Версия меняется при любом изменении
+товара, его инфо-панелек или фото после коммита транзакции (см. signals.py
+и invalidate_product_cards_on_commit), поэтому старые фрагменты
+просто перестают читаться, а "опоздавший" запрос не может записать устаревшую
+карточку под актуальной версией.
+"""
+import hashlib
+import json
+import time
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+@lru_cache(maxsize=None)
+def redis_client():
+    """
+    Клиент общего Redis (REDIS_URL) для операций, которых нет в API кэша Django
+    (скрипты, множества). Без REDIS_URL - None.
+    """
+    if not settings.REDIS_URL:
+        return None
+    return redis.Redis.from_url(settings.REDIS_URL)
+
+
+# Увеличьте при изменении набора полей ProductListSerializer
+CARD_SCHEMA_VERSION = 1
+CARD_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _card_version_key(product_id):
+    return f'product-card-version:{product_id}'
+
+
+def _card_key(product_id, version):
+    return f'product-card:{CARD_SCHEMA_VERSION}:{product_id}:{version}'
+
+
+def get_card_versions(product_ids):
+    """Возвращает словарь {id товара: версия карточки}, создавая недостающие версии."""
+    keys = {product_id: _card_version_key(product_id) for product_id in product_ids}
+    found = cache.get_many(keys.values())
+    versions = {}
+    for product_id, key in keys.items():
+        version = found.get(key)
+        if version is None:
+            token = time.time_ns()
+            version = token if cache.add(key, token, None) else cache.get(key, token)
+        versions[product_id] = version
+    return versions
+
+
+def invalidate_product_cards(product_ids):
+    """Делает недействительными закэшированные карточки указанных товаров."""
+    product_ids = set(product_ids)
+    if product_ids:
+        token = time.time_ns()
+        cache.set_many({_card_version_key(product_id): token for product_id in product_ids}, None)
+
+
+def invalidate_product_cards_on_commit(product_ids):
+    """
+    Сбрасывает карточки товаров после коммита текущей транзакции (вне транзакции - сразу).
+    Если сменить версию до коммита, параллельный запрос прочитает еще старый товар
+    и закэширует устаревшую карточку под новой версией.
+    """
+    # ID собираются сейчас: после коммита связи (например, удаленной инфо-панельки) уже не найти
+    product_ids = set(product_ids)
+    if product_ids:
+        transaction.on_commit(lambda: invalidate_product_cards(product_ids))
+
+
+def get_product_cards(product_ids, serialize):
+    """
+    Возвращает карточки товаров в порядке `product_ids`.
+    `serialize(missing_ids)` вызывается один раз для товаров, которых нет в кэше,
+    и должна вернуть словарь {id товара: карточка}.
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return []
+
+    versions = get_card_versions(set(product_ids))
+    keys = {product_id: _card_key(product_id, versions[product_id]) for product_id in product_ids}
+    cards = cache.get_many(set(keys.values()))
+
+    missing = list(dict.fromkeys(product_id for product_id in product_ids if keys[product_id] not in cards))
+    if missing:
+        fresh = {keys[product_id]: data for product_id, data in serialize(missing).items()}
+        cache.set_many(fresh, CARD_CACHE_TIMEOUT)
+        cards.update(fresh)
+
+    # Товары, которые не удалось сериализовать (например, удаленные), пропускаются
+    return [cards[keys[product_id]] for product_id in product_ids if keys[product_id] in cards]
+
+
+# --- Версии общих данных (дерево категорий, правила скидок) ---
+
+CATALOG_VERSION_KEY = 'catalog-version'
+DISCOUNT_RULES_VERSION_KEY = 'discount-rules-version'
+CATEGORY_TREE_TIMEOUT = 60 * 60 * 24
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        token = time.time_ns()
+        version = token if cache.add(key, token, None) else cache.get(key, token)
+    return version
+
+
+def _bump_version(key):
+    cache.set(key, time.time_ns(), None)
+
+
+def get_catalog_version():
+    """Текущая версия каталога. Меняется при любом изменении категорий (см. signals.py)."""
+    return _get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    _bump_version(CATALOG_VERSION_KEY)
+
+
+def category_tree_key(version):
+    return f'category-tree:{version}'
+
+
+def get_discount_rules_version():
+    """Версия правил скидок: по ней каждый процесс понимает, что его скомпилированные правила устарели."""
+    return _get_version(DISCOUNT_RULES_VERSION_KEY)
+
+
+def bump_discount_rules_version():
+    _bump_version(DISCOUNT_RULES_VERSION_KEY)
+
+
+# --- Мемоизация расчета выбранных товаров (CalculateSelectionView) ---
+
+SELECTION_CACHE_TIMEOUT = 60 * 10
+
+
+def pricing_version(product_ids):
+    """
+    Отпечаток всего, от чего зависит расчет цен набора товаров: правила скидок,
+    дерево категорий и версии карточек товаров (меняются вместе с ценой).
+    """
+    card_versions = get_card_versions(set(product_ids))
+    state = [
+        get_discount_rules_version(),
+        get_catalog_version(),
+        sorted(card_versions.items()),
+    ]
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+
+def selection_cache_key(selection, version, base_url):
+    """Ключ ответа для выбора [(id товара, количество), ...] при версии цен `version` (pricing_version)."""
+    state = [selection, version, base_url]
+    digest = hashlib.sha256(json.dumps(state).encode()).hexdigest()
+    return f'selection:{digest}'
+
+
+# --- Состояние строк корзины для дельта-ответов (CartView) ---
+
+CART_LINES_TIMEOUT = 60 * 60 * 24
+
+
+def cart_lines_key(telegram_id, version):
+    return f'cart-lines:{telegram_id}:{version}'
+
+
+# --- Идемпотентность оформления заказа (OrderCreateView) ---
+
+ORDER_IDEMPOTENCY_TIMEOUT = 60 * 60 * 24
+
+
+def order_idempotency_key(telegram_id, key):
+    return f'order-idempotency:{telegram_id}:{key}'
+
+
+# --- Лента блога (ArticleListView) ---
+
+BLOG_VERSION_KEY = 'blog-version'
+BLOG_INDEX_TIMEOUT = 60 * 60 * 24
+
+
+def get_blog_version():
+    """Версия блога. Меняется при изменении и публикации статей и их категорий (см. signals.py)."""
+    return _get_version(BLOG_VERSION_KEY)
+
+
+def bump_blog_version():
+    _bump_version(BLOG_VERSION_KEY)
+
+
+def blog_index_key(version, category_slug, base_url):
+    """Ключ первой страницы ленты (со списком категорий) для категории и адреса сайта."""
+    digest = hashlib.sha256(json.dumps([category_slug, base_url]).encode()).hexdigest()
+    return f'blog-index:{version}:{digest}'
+
+
+def blog_categories_key(version):
+    return f'blog-categories:{version}'
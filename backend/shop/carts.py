@@ -0,0 +1,252 @@
+# backend/shop/carts.py
+"""
+Хранилище корзин.
+
+Активные корзины живут в общем кэше (Redis; в тестах и без REDIS_URL - локальный
+кэш процесса) и читаются/изменяются без обращений к БД. Изменения записываются
+в журнал "грязных" корзин, который фоновая задача flush_dirty_carts (scheduler.py)
+пачками сбрасывает в таблицы Cart/CartItem. При падении теряется не больше
+интервала сброса (CART_FLUSH_INTERVAL).
+
+Без общего кэша (CART_WRITE_BEHIND = False) процессы не видят корзины друг
+друга, поэтому корзины читаются из БД и каждое изменение сразу записывается в
+нее, минуя кэш.
+
+Состояние корзины: {'version': int, 'items': {id товара: количество}}.
+Порядок items - порядок добавления товаров.
+"""
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .caching import redis_client
+from .models import Cart, CartItem, Product
+
+# Корзина хранится в кэше месяц с последнего изменения, что заведомо больше интервала сброса
+CART_TIMEOUT = 60 * 60 * 24 * 30
+CART_LOCK_TIMEOUT = 5
+DIRTY_LOG_TIMEOUT = 60 * 60 * 24
+FLUSH_BATCH_SIZE = 500
+
+DIRTY_SEQ_KEY = 'cart-dirty-seq'
+FLUSH_CURSOR_KEY = 'cart-flush-cursor'
+FLUSH_STUCK_KEY = 'cart-flush-stuck'
+
+
+def _cart_key(telegram_id):
+    return f'cart:{telegram_id}'
+
+
+def _dirty_key(seq):
+    return f'cart-dirty:{seq}'
+
+
+# Удаляет блокировку, только если она все еще наша (сравнение и удаление - одна операция Redis)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class CartLocked(Exception):
+    """Блокировку корзины не удалось получить за CART_LOCK_TIMEOUT."""
+
+
+def _acquire_lock(key, token):
+    client = redis_client()
+    if client is not None:
+        return bool(client.set(key, token, nx=True, px=int(CART_LOCK_TIMEOUT * 1000)))
+    return cache.add(key, token, CART_LOCK_TIMEOUT)
+
+
+def _release_lock(key, token):
+    """
+    Снимает блокировку, если ее значение все еще token. В Redis проверка и удаление
+    атомарны: иначе между get и delete блокировка может истечь и достаться другому
+    процессу, а мы удалим уже чужую. Без Redis кэш локален для процесса, и это
+    окно гонки допустимо.
+    """
+    client = redis_client()
+    if client is not None:
+        client.eval(RELEASE_LOCK_SCRIPT, 1, key, token)
+    elif cache.get(key) == token:
+        cache.delete(key)
+
+
+@contextmanager
+def cart_lock(telegram_id):
+    """
+    Блокировка корзины между процессами (SET NX в Redis, без него - cache.add в локальном кэше).
+    Если держатель блокировки упал, она истекает через CART_LOCK_TIMEOUT.
+    Если блокировку не удалось получить за это время, бросает CartLocked.
+    """
+    key = f'cart-lock:{telegram_id}'
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + CART_LOCK_TIMEOUT
+    while not _acquire_lock(key, token):
+        if time.monotonic() >= deadline:
+            raise CartLocked(telegram_id)
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        _release_lock(key, token)
+
+
+def _load_from_db(telegram_id):
+    cart = Cart.objects.filter(telegram_id=telegram_id).only('id', 'version').first()
+    if cart is None:
+        return {'version': 0, 'items': {}}
+    items = CartItem.objects.filter(cart=cart).order_by('added_at', 'id').values_list('product_id', 'quantity')
+    return {'version': cart.version, 'items': dict(items)}
+
+
+def get_cart(telegram_id):
+    """Состояние корзины; при промахе кэша корзина поднимается из БД."""
+    if not settings.CART_WRITE_BEHIND:
+        # Кэш процесса не видит изменений из других процессов
+        return _load_from_db(telegram_id)
+    state = cache.get(_cart_key(telegram_id))
+    if state is None:
+        state = _load_from_db(telegram_id)
+        # add, а не set: не затираем корзину, которую параллельно успели изменить
+        if not cache.add(_cart_key(telegram_id), state, CART_TIMEOUT):
+            state = cache.get(_cart_key(telegram_id), state)
+    return state
+
+
+def change_cart(telegram_id, quantities):
+    """
+    Применяет изменения {id товара: количество} (0 и меньше - удалить).
+    Возвращает (новое состояние, версия до изменения).
+    """
+    with cart_lock(telegram_id):
+        return change_locked_cart(telegram_id, quantities)
+
+
+def change_locked_cart(telegram_id, quantities):
+    """То же, что change_cart, для кода, который уже держит cart_lock (например, оформление заказа)."""
+    state = get_cart(telegram_id)
+    previous_version = state['version']
+    items = dict(state['items'])
+    for product_id, quantity in quantities.items():
+        if quantity > 0:
+            items[product_id] = quantity
+        else:
+            items.pop(product_id, None)
+
+    if items != state['items']:
+        state = {'version': previous_version + 1, 'items': items}
+        _save(telegram_id, state)
+    return state, previous_version
+
+
+def _save(telegram_id, state):
+    if not settings.CART_WRITE_BEHIND:
+        _write_carts({telegram_id: state})
+        return
+    cache.set(_cart_key(telegram_id), state, CART_TIMEOUT)
+    # Журнал: номер из атомарного счетчика -> корзина. Номер берется ПОСЛЕ записи
+    # корзины, поэтому сброс, увидевший номер, увидит и это состояние.
+    cache.add(DIRTY_SEQ_KEY, 0, None)
+    seq = cache.incr(DIRTY_SEQ_KEY)
+    cache.set(_dirty_key(seq), telegram_id, DIRTY_LOG_TIMEOUT)
+
+
+def persist_carts(telegram_ids):
+    """Записывает текущие состояния корзин из кэша в БД одной транзакцией."""
+    keys = {_cart_key(telegram_id): telegram_id for telegram_id in set(telegram_ids)}
+    return _write_carts({keys[key]: state for key, state in cache.get_many(keys).items()})
+
+
+def _write_carts(states):
+    """Записывает состояния {telegram_id: состояние} в БД одной транзакцией. Возвращает число корзин."""
+    if not states:
+        return 0
+
+    # Товары могли удалить, пока они лежали в корзине
+    product_ids = {product_id for state in states.values() for product_id in state['items']}
+    existing_products = set(Product.objects.filter(id__in=product_ids).values_list('id', flat=True))
+
+    now = timezone.now()
+    with transaction.atomic():
+        Cart.objects.bulk_create(
+            [Cart(telegram_id=telegram_id, version=state['version'], updated_at=now) for telegram_id, state in states.items()],
+            update_conflicts=True,
+            unique_fields=['telegram_id'],
+            update_fields=['version', 'updated_at'],
+        )
+        cart_ids = dict(Cart.objects.filter(telegram_id__in=states).values_list('telegram_id', 'id'))
+
+        wanted = {
+            (cart_ids[telegram_id], product_id): quantity
+            for telegram_id, state in states.items()
+            for product_id, quantity in state['items'].items()
+            if product_id in existing_products
+        }
+        stale_ids = [
+            item_id for item_id, cart_id, product_id in
+            CartItem.objects.filter(cart_id__in=cart_ids.values()).values_list('id', 'cart_id', 'product_id')
+            if (cart_id, product_id) not in wanted
+        ]
+        if stale_ids:
+            CartItem.objects.filter(id__in=stale_ids).delete()
+        if wanted:
+            CartItem.objects.bulk_create(
+                [CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity) for (cart_id, product_id), quantity in wanted.items()],
+                update_conflicts=True,
+                unique_fields=['cart', 'product'],
+                update_fields=['quantity'],
+            )
+    return len(states)
+
+
+def _flush_batch(cursor, last):
+    """Сбрасывает записи журнала с номерами (cursor, last]. Возвращает (число корзин, новый курсор)."""
+    seqs = range(cursor + 1, last + 1)
+    entries = cache.get_many([_dirty_key(seq) for seq in seqs])
+    telegram_ids = []
+    new_cursor = cursor
+    for seq in seqs:
+        telegram_id = entries.get(_dirty_key(seq))
+        if telegram_id is None:
+            # Номер выдан, но запись еще не сделана - ждем до следующего прохода.
+            # Если и тогда ее нет (процесс упал между incr и set), пропускаем номер.
+            if cache.get(FLUSH_STUCK_KEY) != seq:
+                cache.set(FLUSH_STUCK_KEY, seq, DIRTY_LOG_TIMEOUT)
+                break
+        else:
+            telegram_ids.append(telegram_id)
+        new_cursor = seq
+
+    count = persist_carts(telegram_ids)
+    cache.set(FLUSH_CURSOR_KEY, new_cursor, None)
+    cache.delete_many([_dirty_key(seq) for seq in range(cursor + 1, new_cursor + 1)])
+    return count, new_cursor
+
+
+def flush_dirty_carts():
+    """
+    Сбрасывает в БД корзины, измененные с прошлого сброса. Журнал читается пачками
+    по FLUSH_BATCH_SIZE записей (одна транзакция на пачку), курсор сдвигается после
+    каждой: большой накопившийся журнал не превращается в один огромный MGET и
+    транзакцию. Возвращает число корзин.
+    """
+    cursor = cache.get(FLUSH_CURSOR_KEY, 0)
+    last = cache.get(DIRTY_SEQ_KEY, 0)
+    count = 0
+    while cursor < last:
+        batch_count, new_cursor = _flush_batch(cursor, min(last, cursor + FLUSH_BATCH_SIZE))
+        count += batch_count
+        if new_cursor < min(last, cursor + FLUSH_BATCH_SIZE):
+            # Пачка остановилась на незаписанном номере - остальное в следующий проход
+            break
+        cursor = new_cursor
+    return count
@@ -0,0 +1,110 @@
+# backend/shop/counters.py
+"""
+Буферизованный счетчик просмотров статей.
+
+Просмотр не трогает строку статьи в БД: он увеличивает счетчик в общем кэше
+(Redis), а фоновая задача flush_article_views (scheduler.py) раз в
+ARTICLE_VIEWS_FLUSH_INTERVAL секунд применяет все накопленные просмотры одним
+UPDATE. Популярная статья больше не сериализует запросы на блокировке строки,
+а сортировка по views_count работает как раньше (с отставанием на интервал).
+ID статей с накопленными просмотрами хранятся в множестве (SET в Redis), поэтому
+сброс читает только их счетчики, а не перебирает все статьи.
+
+Без Redis (ARTICLE_VIEWS_BUFFERED = False или не задан REDIS_URL) процессы не
+видят буферы друг друга, поэтому просмотр сразу пишется в БД одним атомарным UPDATE.
+
+С ARTICLE_VIEWS_DEDUP просмотры одного пользователя Telegram засчитываются
+не чаще раза в день для каждой статьи.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from .caching import redis_client
+from .models import Article
+
+SEEN_TIMEOUT = 60 * 60 * 24 * 2
+
+DIRTY_KEY = 'article-views-dirty'
+
+
+def _views_key(article_id):
+    return f'article-views:{article_id}'
+
+
+def _seen_key(article_id, viewer_id, day):
+    return f'article-seen:{article_id}:{viewer_id}:{day.isoformat()}'
+
+
+def _take_dirty(client):
+    """Атомарно забирает (и очищает) множество статей с накопленными просмотрами."""
+    members, _ = client.pipeline(transaction=True).smembers(DIRTY_KEY).delete(DIRTY_KEY).execute()
+    return {int(member) for member in members}
+
+
+def record_article_view(article_id, viewer_id=None):
+    """Засчитывает просмотр статьи. Возвращает False, если пользователь уже смотрел ее сегодня."""
+    if viewer_id is not None and settings.ARTICLE_VIEWS_DEDUP:
+        if not cache.add(_seen_key(article_id, viewer_id, timezone.localdate()), 1, SEEN_TIMEOUT):
+            return False
+
+    client = redis_client() if settings.ARTICLE_VIEWS_BUFFERED else None
+    if client is None:
+        apply_article_views({article_id: 1})
+        return True
+
+    key = _views_key(article_id)
+    cache.add(key, 0, None)
+    cache.incr(key)
+    # После incr: сброс, забравший ID из множества, увидит и этот просмотр
+    client.sadd(DIRTY_KEY, article_id)
+    return True
+
+
+def apply_article_views(increments):
+    """Прибавляет просмотры {id статьи: число} одним UPDATE."""
+    increments = {article_id: count for article_id, count in increments.items() if count}
+    if not increments:
+        return
+    table = Article._meta.db_table
+    if connection.vendor == 'postgresql':
+        values = ', '.join(['(%s, %s)'] * len(increments))
+        params = [value for item in increments.items() for value in item]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE "{table}" SET views_count = "{table}".views_count + v.views '
+                f'FROM (VALUES {values}) AS v(id, views) WHERE "{table}".id = v.id',
+                params
+            )
+    else:
+        Article.objects.filter(id__in=increments).update(views_count=F('views_count') + Case(
+            *(When(id=article_id, then=Value(count)) for article_id, count in increments.items()),
+            default=Value(0), output_field=IntegerField(),
+        ))
+
+
+def flush_article_views():
+    """Переносит накопленные в кэше просмотры в БД. Возвращает число обновленных статей."""
+    client = redis_client()
+    if client is None:
+        return 0
+    # Просмотр, пришедший после _take_dirty, снова добавит свою статью в множество
+    keys = {_views_key(article_id): article_id for article_id in _take_dirty(client)}
+    pending = {keys[key]: count for key, count in cache.get_many(keys).items() if count}
+    if not pending:
+        return 0
+
+    # Сначала забираем просмотры из буфера (decr атомарен: просмотры, пришедшие
+    # после get_many, остаются в счетчике до следующего сброса), затем пишем в БД
+    for article_id, count in pending.items():
+        cache.decr(_views_key(article_id), count)
+    try:
+        apply_article_views(pending)
+    except Exception:
+        for article_id, count in pending.items():
+            cache.incr(_views_key(article_id), count)
+        client.sadd(DIRTY_KEY, *pending)
+        raise
+    return len(pending)
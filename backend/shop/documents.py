@@ -0,0 +1,120 @@
+# backend/shop/documents.py
+"""
+Read-model детальных страниц товаров.
+
+Документ (ProductDocument.data) - это ответ /api/products/<pk>/ с относительными URL
+и списком ID сопутствующих товаров вместо их карточек. Документы пересобираются
+фоновой задачей (scheduler.py, команда rebuild_product_documents) и сразу после
+сохранения товара в админке. Пока документ устарел, страница отдается живой сериализацией.
+"""
+from django.conf import settings
+from django.db.models import F, Prefetch
+from django.utils import timezone
+
+from .models import Product, ProductCharacteristic, ProductDocument
+from .serializers import ProductCardListSerializer, ProductDetailSerializer
+
+
+def product_detail_queryset():
+    """
+    Запрос, который "жадно" загружает все связанные данные детальной страницы товара:
+    число запросов фиксировано и не зависит от количества характеристик, фото или
+    вариаций (см. тесты). Используется при сборке документа (rebuild_product_document)
+    и в ProductDetailView только для живой сериализации, пока документ устарел или не собран.
+    """
+    return Product.objects.filter(is_active=True).select_related(
+        'category',       # Загружаем категорию (связь один-ко-многим)
+        'color_group'     # Загружаем группу цветов
+    ).prefetch_related(
+        'info_panels',    # Загружаем все инфо-панели (многие-ко-многим)
+        'images',         # Загружаем все доп. изображения
+        'info_cards',     # Загружаем все инфо-карточки
+        'features',       # Загружаем особенности (функционал)
+        Prefetch(
+            'characteristics', # Характеристики сразу с названиями и их категориями
+            queryset=ProductCharacteristic.objects.select_related('characteristic__category')
+        ),
+        # Сопутствующие товары отдаются карточками из кэша; инфо-панельки для
+        # карточек, которых нет в кэше, подгружает ProductCardListSerializer.
+        Prefetch(
+            'related_products',
+            queryset=Product.objects.filter(is_active=True)
+        ),
+        Prefetch(
+            'color_group__products', # Загружаем все товары из той же группы цветов
+            queryset=Product.objects.filter(is_active=True),
+            to_attr='color_variations_prefetched' # Сохраняем результат в отдельный атрибут
+        )
+    )
+
+
+class ProductDocumentSerializer(ProductDetailSerializer):
+    """Детальный сериализатор без карточек сопутствующих товаров (они подставляются при выдаче)."""
+    class Meta(ProductDetailSerializer.Meta):
+        fields = tuple(
+            field for field in dict.fromkeys(ProductDetailSerializer.Meta.fields) if field != 'related_products'
+        )
+
+
+def rebuild_product_document(product_id):
+    """
+    Пересобирает документ одного товара. Если за время сборки товар снова изменился,
+    документ остается устаревшим и будет пересобран следующим проходом.
+    """
+    if not Product.objects.filter(pk=product_id, is_active=True).exists():
+        # Неактивный или удаленный товар: документ не нужен
+        ProductDocument.objects.filter(pk=product_id).delete()
+        return False
+
+    # Версию фиксируем ДО чтения данных товара
+    document, _ = ProductDocument.objects.get_or_create(product_id=product_id)
+    version = document.version
+
+    product = product_detail_queryset().filter(pk=product_id).first()
+    if product is None:
+        return False
+
+    data = dict(ProductDocumentSerializer(product, context={}).data)
+    data['related_product_ids'] = [related.id for related in product.related_products.all()]
+
+    return bool(ProductDocument.objects.filter(pk=product_id, version=version).update(
+        data=data, built_version=version, built_at=timezone.now()
+    ))
+
+
+def rebuild_stale_product_documents(limit=200):
+    """Пересобирает устаревшие и недостающие документы. Возвращает число обработанных товаров."""
+    stale_ids = list(
+        ProductDocument.objects.filter(version__gt=F('built_version')).values_list('product_id', flat=True)[:limit]
+    )
+    missing_ids = list(
+        Product.objects.filter(is_active=True, document__isnull=True).values_list('id', flat=True)[:limit]
+    )
+    for product_id in stale_ids + missing_ids:
+        rebuild_product_document(product_id)
+    return len(stale_ids) + len(missing_ids)
+
+
+def get_product_document(product_id):
+    """Возвращает актуальный документ активного товара или None."""
+    return ProductDocument.objects.filter(
+        product_id=product_id, product__is_active=True, version=F('built_version')
+    ).values_list('data', flat=True).first()
+
+
+def _absolutize_media_urls(value, request):
+    if isinstance(value, dict):
+        return {key: _absolutize_media_urls(item, request) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_absolutize_media_urls(item, request) for item in value]
+    if isinstance(value, str) and value.startswith(settings.MEDIA_URL):
+        return request.build_absolute_uri(value)
+    return value
+
+
+def render_product_document(data, request):
+    """Превращает документ в ответ API: абсолютные URL медиа и карточки сопутствующих товаров."""
+    data = _absolutize_media_urls(data, request)
+    related_ids = data.pop('related_product_ids', [])
+    data['related_products'] = ProductCardListSerializer.for_ids(related_ids, {'request': request})
+    return data
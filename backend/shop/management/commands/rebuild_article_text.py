@@ -0,0 +1,24 @@
+# backend/shop/management/commands/rebuild_article_text.py
+from django.core.management.base import BaseCommand
+
+from shop.models import Article
+
+BATCH_SIZE = 200
+
+
+class Command(BaseCommand):
+    help = "Заполняет текст без разметки, число слов и время чтения статей. Запускать после деплоя."
+
+    def handle(self, *args, **options):
+        articles = Article.objects.only('id', 'content', 'content_type', *Article.TEXT_FIELDS).order_by('id')
+        batch = []
+        updated = 0
+        for article in articles.iterator(chunk_size=BATCH_SIZE):
+            article.update_text_fields()
+            batch.append(article)
+            if len(batch) >= BATCH_SIZE:
+                updated += Article.objects.bulk_update(batch, Article.TEXT_FIELDS)
+                batch = []
+        if batch:
+            updated += Article.objects.bulk_update(batch, Article.TEXT_FIELDS)
+        self.stdout.write(self.style.SUCCESS(f"Обновлено статей: {updated}"))
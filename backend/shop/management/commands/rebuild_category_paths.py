@@ -0,0 +1,12 @@
+# backend/shop/management/commands/rebuild_category_paths.py
+from django.core.management.base import BaseCommand
+
+from shop.models import Category
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает материализованные пути (tree_path) всех категорий. Запускать после деплоя и при ручных правках в БД."
+
+    def handle(self, *args, **options):
+        updated = Category.rebuild_tree_paths()
+        self.stdout.write(self.style.SUCCESS(f"Обновлено путей категорий: {updated}"))
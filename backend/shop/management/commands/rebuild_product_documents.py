@@ -0,0 +1,27 @@
+# backend/shop/management/commands/rebuild_product_documents.py
+from django.core.management.base import BaseCommand
+
+from shop.documents import rebuild_product_document, rebuild_stale_product_documents
+from shop.models import Product
+
+
+class Command(BaseCommand):
+    help = "Пересобирает документы детальных страниц товаров (по умолчанию только устаревшие)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Пересобрать документы всех активных товаров.")
+
+    def handle(self, *args, **options):
+        if options['all']:
+            count = 0
+            for product_id in Product.objects.filter(is_active=True).values_list('id', flat=True).iterator():
+                rebuild_product_document(product_id)
+                count += 1
+        else:
+            count = 0
+            while True:
+                processed = rebuild_stale_product_documents()
+                if not processed:
+                    break
+                count += processed
+        self.stdout.write(self.style.SUCCESS(f"Пересобрано документов: {count}"))
@@ -0,0 +1,15 @@
+# backend/shop/management/commands/rebuild_sales_rollups.py
+from django.core.management.base import BaseCommand
+
+from shop.analytics import rebuild_all_sales_rollups, update_sales_rollups
+
+
+class Command(BaseCommand):
+    help = "Обновляет дневные агрегаты продаж (по умолчанию только дни с новыми и измененными заказами)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Пересчитать агрегаты за всю историю заказов.")
+
+    def handle(self, *args, **options):
+        count = rebuild_all_sales_rollups() if options['all'] else update_sales_rollups()
+        self.stdout.write(self.style.SUCCESS(f"Пересчитано дней: {count}"))
@@ -0,0 +1,18 @@
+# backend/shop/management/commands/rebuild_search_index.py
+from django.core.management.base import BaseCommand
+
+from shop.models import Product, Article
+from shop.search import update_search_vector
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает полнотекстовый индекс (search_vector) для всех товаров и статей."
+
+    def handle(self, *args, **options):
+        for model in (Product, Article):
+            fields = ['pk'] + [field_name for field_name, _ in model.search_vector_fields]
+            count = 0
+            for instance in model.objects.only(*fields).iterator(chunk_size=500):
+                update_search_vector(instance)
+                count += 1
+            self.stdout.write(self.style.SUCCESS(f"{model._meta.verbose_name_plural}: обновлено {count}"))
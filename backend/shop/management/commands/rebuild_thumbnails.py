@@ -0,0 +1,21 @@
+# backend/shop/management/commands/rebuild_thumbnails.py
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from shop.thumbnails import rebuild_all_thumbnails, thumbnail_pool
+
+
+class Command(BaseCommand):
+    help = "Генерирует миниатюры всех изображений в пуле процессов (по умолчанию только отсутствующие)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Перерисовать и уже существующие миниатюры.")
+        parser.add_argument('--workers', type=int, default=settings.THUMBNAIL_WORKERS,
+                            help="Процессов рендеринга (0 - в текущем процессе).")
+
+    def handle(self, *args, **options):
+        with thumbnail_pool(options['workers']) as executor:
+            done, errors = rebuild_all_thumbnails(executor, force=options['force'])
+        for (model, object_id, source_field, name), error in errors:
+            self.stderr.write(f"{model} #{object_id}.{source_field} {name}: {error}")
+        self.stdout.write(self.style.SUCCESS(f"Обработано изображений: {done}, с ошибкой: {len(errors)}"))
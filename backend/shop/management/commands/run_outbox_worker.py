@@ -0,0 +1,41 @@
+# backend/shop/management/commands/run_outbox_worker.py
+import time
+import traceback
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from shop.outbox import get_sender, process_outbox
+
+
+class Command(BaseCommand):
+    help = "Отправляет исходящие уведомления (уведомления о заказах менеджеру, см. shop/outbox.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Отправить одну пачку и выйти (для cron).")
+        parser.add_argument('--batch-size', type=int, default=50, help="Сообщений за один проход.")
+        parser.add_argument('--interval', type=float, default=2, help="Пауза в секундах, когда очередь пуста.")
+
+    def handle(self, *args, **options):
+        sender = get_sender()
+        if options['once']:
+            self.run_batch(sender, options['batch_size'])
+            return
+
+        self.stdout.write("Воркер уведомлений запущен")
+        while True:
+            processed = self.run_batch(sender, options['batch_size'])
+            # Полная пачка - в очереди, скорее всего, есть еще сообщения
+            if processed < options['batch_size']:
+                time.sleep(options['interval'])
+
+    def run_batch(self, sender, batch_size):
+        close_old_connections()
+        try:
+            sent, failed = process_outbox(batch_size, sender)
+        except Exception:
+            self.stderr.write(f"Ошибка обработки очереди уведомлений:\n{traceback.format_exc()}")
+            return 0
+        if sent or failed:
+            self.stdout.write(f"Отправлено: {sent}, с ошибкой: {failed}")
+        return sent + failed
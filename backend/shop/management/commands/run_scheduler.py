@@ -0,0 +1,41 @@
+# backend/shop/management/commands/run_scheduler.py
+import time
+import traceback
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from shop.scheduler import PERIODIC_JOBS
+
+
+class Command(BaseCommand):
+    help = "Запускает периодические задачи магазина (см. shop/scheduler.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Выполнить все задачи один раз и выйти (для cron).")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            for job, _ in PERIODIC_JOBS:
+                self.run_job(job)
+            return
+
+        self.stdout.write(f"Планировщик запущен, задач: {len(PERIODIC_JOBS)}")
+        next_run = {job: 0 for job, _ in PERIODIC_JOBS}
+        while True:
+            now = time.monotonic()
+            for job, interval in PERIODIC_JOBS:
+                if now >= next_run[job]:
+                    self.run_job(job)
+                    next_run[job] = now + interval
+            time.sleep(max(0.5, min(next_run.values()) - time.monotonic()))
+
+    def run_job(self, job):
+        close_old_connections()
+        try:
+            result = job()
+            if result:
+                self.stdout.write(f"{job.__name__}: {result}")
+        except Exception:
+            # Ошибка одной задачи не должна останавливать остальные
+            self.stderr.write(f"{job.__name__} завершилась с ошибкой:\n{traceback.format_exc()}")
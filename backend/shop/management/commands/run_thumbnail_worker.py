@@ -0,0 +1,44 @@
+# backend/shop/management/commands/run_thumbnail_worker.py
+import time
+import traceback
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from shop.thumbnails import process_thumbnail_jobs, thumbnail_pool
+
+
+class Command(BaseCommand):
+    help = "Генерирует миниатюры загруженных изображений (очередь ThumbnailJob, см. shop/thumbnails.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Обработать одну пачку и выйти (для cron).")
+        parser.add_argument('--batch-size', type=int, default=50, help="Изображений за один проход.")
+        parser.add_argument('--interval', type=float, default=2, help="Пауза в секундах, когда очередь пуста.")
+        parser.add_argument('--workers', type=int, default=settings.THUMBNAIL_WORKERS,
+                            help="Процессов рендеринга (0 - в текущем процессе).")
+
+    def handle(self, *args, **options):
+        with thumbnail_pool(options['workers']) as executor:
+            if options['once']:
+                self.run_batch(executor, options['batch_size'])
+                return
+
+            self.stdout.write("Воркер миниатюр запущен")
+            while True:
+                processed = self.run_batch(executor, options['batch_size'])
+                # Полная пачка - в очереди, скорее всего, есть еще задачи
+                if processed < options['batch_size']:
+                    time.sleep(options['interval'])
+
+    def run_batch(self, executor, batch_size):
+        close_old_connections()
+        try:
+            done, failed = process_thumbnail_jobs(executor, batch_size)
+        except Exception:
+            self.stderr.write(f"Ошибка обработки очереди миниатюр:\n{traceback.format_exc()}")
+            return 0
+        if done or failed:
+            self.stdout.write(f"Обработано изображений: {done}, с ошибкой: {failed}")
+        return done + failed
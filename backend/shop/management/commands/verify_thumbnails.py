@@ -0,0 +1,12 @@
+# backend/shop/management/commands/verify_thumbnails.py
+from django.core.management.base import BaseCommand
+
+from shop.thumbnails import verify_thumbnails
+
+
+class Command(BaseCommand):
+    help = "Сверяет манифесты миниатюр (поле thumbnails) с файлами в хранилище и ставит недостающие в очередь."
+
+    def handle(self, *args, **options):
+        fixed, queued = verify_thumbnails()
+        self.stdout.write(self.style.SUCCESS(f"Исправлено манифестов: {fixed}, поставлено в очередь: {queued}"))
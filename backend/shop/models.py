@@ -1,14 +1,17 @@
 # backend/shop/models.py
 from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.utils import timezone
 from django_ckeditor_5.fields import CKEditor5Field
-from django.db.models import Case, When, F, DecimalField
+from django.db.models import F
 from imagekit.models import ImageSpecField
 from imagekit.processors import ResizeToFit
 from colorfield.fields import ColorField
 from django.contrib.auth.models import User
 from django.utils.text import slugify
-from django.utils.html import strip_tags
+from .caching import invalidate_product_cards_on_commit
+from .utils import html_to_text
 import math # Импортируем math для округления
 
 # --- Модель InfoPanel (без изменений) ---
@@ -30,8 +33,66 @@ class InfoPanel(models.Model):
 class Category(models.Model):
     name = models.CharField("Название категории", max_length=100)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='subcategories', verbose_name="Родительская категория")
+    # Материализованный путь вида "1/5/12/" (ID предков от корня + собственный ID).
+    # Поддерживается сигналами (см. signals.py), позволяет выбирать поддерево одним запросом.
+    tree_path = models.CharField("Путь в дереве", max_length=255, blank=True, default='', editable=False, db_index=True)
+
+    @property
+    def ancestor_ids(self):
+        """Возвращает ID всех предков категории и её самой (от корня к листу) без запросов к БД."""
+        if self.tree_path:
+            return [int(pk) for pk in self.tree_path.split('/') if pk]
+        # Путь ещё не заполнен (например, до запуска rebuild_category_paths) - идем по родителям
+        ids = []
+        k = self
+        while k is not None:
+            ids.append(k.id)
+            k = k.parent
+        return ids[::-1]
+
+    @classmethod
+    def rebuild_tree_paths(cls):
+        """Полностью пересчитывает материализованные пути всех категорий. Возвращает число обновленных."""
+        parents = dict(cls.objects.values_list('id', 'parent_id'))
+        paths = {}
+
+        def build(pk):
+            if pk not in paths:
+                parent_id = parents[pk]
+                paths[pk] = (build(parent_id) if parent_id else '') + f"{pk}/"
+            return paths[pk]
+
+        to_update = []
+        for category in cls.objects.only('id', 'tree_path'):
+            path = build(category.id)
+            if category.tree_path != path:
+                category.tree_path = path
+                to_update.append(category)
+        cls.objects.bulk_update(to_update, ['tree_path'], batch_size=500)
+        return len(to_update)
+
+    @classmethod
+    def full_paths(cls):
+        """Полные названия всех категорий {id: 'Родитель -> Потомок'} одним запросом (для списков в админке)."""
+        rows = {pk: (name, parent_id) for pk, name, parent_id in cls.objects.values_list('id', 'name', 'parent_id')}
+        paths = {}
+
+        def build(pk):
+            if pk not in paths:
+                name, parent_id = rows[pk]
+                paths[pk] = f"{build(parent_id)} -> {name}" if parent_id in rows else name
+            return paths[pk]
+
+        for pk in rows:
+            build(pk)
+        return paths
 
     def __str__(self):
+        ancestor_ids = self.ancestor_ids[:-1] if self.tree_path else []
+        if ancestor_ids and not Category.parent.is_cached(self):
+            # Названия всех предков одним запросом вместо запроса на каждого родителя
+            names = dict(Category.objects.filter(id__in=ancestor_ids).values_list('id', 'name'))
+            return ' -> '.join([names.get(pk, '') for pk in ancestor_ids] + [self.name])
         full_path = [self.name]
         k = self.parent
         while k is not None:
@@ -136,7 +197,10 @@ class Product(models.Model):
     )
     description = CKEditor5Field("Описание", config_name='default')
 
-    # 2. ИЗМЕНЕНИЕ: Удалено дублирующееся поле 'price'
+    # Актуальная цена, сохраненная в БД (акционная или обычная).
+    # Пересчитывается в save() и периодической задачей refresh_deal_prices (см. scheduler.py),
+    # поэтому сортировка по цене идет по индексу, а не по CASE с текущим временем.
+    effective_price = models.DecimalField("Актуальная цена", max_digits=10, decimal_places=2, null=True, editable=False)
 
     category = models.ForeignKey(Category, on_delete=models.PROTECT, related_name="products", verbose_name="Категория")
     info_panels = models.ManyToManyField(InfoPanel, blank=True, verbose_name="Информационные панельки")
@@ -147,11 +211,18 @@ class Product(models.Model):
                                           processors=[ResizeToFit(width=600)],
                                           format='WEBP',
                                           options={'quality': 85})
+    # Манифест сгенерированных миниатюр {спецификация: {'source': файл-оригинал, 'url': URL}}.
+    # Заполняет воркер миниатюр (см. thumbnails.py): сериализаторы берут URL отсюда, не трогая хранилище
+    thumbnails = models.JSONField("Миниатюры", default=dict, blank=True, editable=False)
     audio_sample = models.FileField("Пример аудио (MP3, WAV)", upload_to='products/audio/', null=True, blank=True)
 
     related_products = models.ManyToManyField('self', blank=True, symmetrical=False, verbose_name="Сопутствующие товары")
     color_group = models.ForeignKey(ColorGroup, on_delete=models.SET_NULL, related_name='products', null=True, blank=True, verbose_name="Группа цветов")
 
+    # Поисковый индекс: tsvector по названию и описанию без HTML (обновляется сигналом при сохранении)
+    search_vector = SearchVectorField(null=True, editable=False)
+    search_vector_fields = (('name', 'A'), ('description', 'B'))
+
     @property
     def is_deal_of_the_day(self):
         """
@@ -164,16 +235,50 @@ class Product(models.Model):
             self.deal_ends_at > timezone.now()
         )
 
+    PRICE_FIELDS = frozenset({'regular_price', 'deal_price', 'deal_ends_at'})
+
+    def calculate_current_price(self):
+        """Вычисляет актуальную цену по акции 'Товар дня' на текущий момент."""
+        if self.is_deal_of_the_day:
+            return self.deal_price
+        return self.regular_price
+
     @property
     def current_price(self):
         """
-        Возвращает актуальную цену товара.
-        Эта функция теперь будет использовать наше новое свойство is_deal_of_the_day.
+        Возвращает актуальную цену товара из сохраненного поля effective_price.
+        Если поле еще не заполнено (товар не пересохранялся после деплоя), считает цену на лету.
         """
-        # Этот код остается рабочим благодаря свойству is_deal_of_the_day!
-        if self.is_deal_of_the_day:
-            return self.deal_price
-        return self.regular_price
+        if self.effective_price is not None:
+            return self.effective_price
+        return self.calculate_current_price()
+
+    def save(self, *args, **kwargs):
+        self.effective_price = self.calculate_current_price()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and self.PRICE_FIELDS.intersection(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'effective_price'}
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def sync_effective_prices(cls):
+        """
+        Приводит effective_price всех товаров в соответствие с акциями:
+        закончившиеся акции возвращают обычную цену. Возвращает число обновленных товаров.
+        """
+        deal_active_condition = models.Q(deal_price__isnull=False, deal_ends_at__gt=timezone.now())
+        to_deal = list(cls.objects.filter(deal_active_condition)
+                       .exclude(effective_price=F('deal_price')).values_list('id', flat=True))
+        to_regular = list(cls.objects.exclude(deal_active_condition)
+                          .exclude(effective_price=F('regular_price')).values_list('id', flat=True))
+        if to_deal:
+            cls.objects.filter(id__in=to_deal).update(effective_price=F('deal_price'))
+        if to_regular:
+            cls.objects.filter(id__in=to_regular).update(effective_price=F('regular_price'))
+        # update() не вызывает сигналы, поэтому карточки и документы сбрасываем явно
+        invalidate_product_cards_on_commit(to_deal + to_regular)
+        ProductDocument.mark_stale(to_deal + to_regular)
+        return len(to_deal) + len(to_regular)
 
     def __str__(self):
         return self.name
@@ -182,31 +287,61 @@ class Product(models.Model):
         verbose_name = "Товар"
         verbose_name_plural = "Товары"
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['is_active', 'effective_price'], name='product_active_price_idx'),
+            # Список товаров в админке: сортировка по дате, фильтры по категории и активности
+            models.Index(fields=['-created_at'], name='product_created_idx'),
+            models.Index(fields=['category', '-created_at'], name='product_category_created_idx'),
+            models.Index(fields=['is_active', '-created_at'], name='product_active_created_idx'),
+            GinIndex(fields=['search_vector'], name='product_search_vector_idx'),
+            GinIndex(fields=['name'], opclasses=['gin_trgm_ops'], name='product_name_trgm_idx'),
+        ]
 
     @classmethod
     def annotate_with_price(cls, queryset):
         """
-        Аннотирует queryset новым полем 'price', которое содержит
-        актуальную цену (акционную или обычную).
+        Аннотирует queryset полем 'price' - псевдонимом сохраненной актуальной цены.
+        Сортировка и фильтрация по 'price' идут напрямую по колонке effective_price (и ее индексу).
         """
-        now = timezone.now()
+        return queryset.annotate(price=F('effective_price'))
+
+# --- Модель ProductDocument (read-model детальной страницы) ---
+class ProductDocument(models.Model):
+    """
+    Готовый JSON детальной страницы товара, собранный заранее (см. documents.py).
+    Документ актуален, пока version == built_version: любое изменение товара или
+    связанных с ним данных увеличивает version, а пересборка записывает built_version.
+    """
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='document', verbose_name="Товар")
+    data = models.JSONField("Документ", default=dict)
+    version = models.PositiveIntegerField("Версия данных", default=1)
+    built_version = models.PositiveIntegerField("Версия документа", default=0)
+    built_at = models.DateTimeField("Дата сборки", null=True, blank=True)
 
-        # Условие, при котором акция "Товар дня" активна
-        deal_active_condition = models.Q(
-            deal_price__isnull=False,
-            deal_ends_at__gt=now
-        )
+    def __str__(self):
+        return f"Документ товара {self.product_id}"
 
-        # Создаем "виртуальное" поле 'price'
-        # Если акция активна -> берем deal_price
-        # Иначе -> берем regular_price
-        price_annotation = Case(
-            When(deal_active_condition, then=F('deal_price')),
-            default=F('regular_price'),
-            output_field=DecimalField()
-        )
+    class Meta:
+        verbose_name = "Документ страницы товара"
+        verbose_name_plural = "Документы страниц товаров"
+
+    @classmethod
+    def mark_stale(cls, product_ids):
+        """
+        Помечает устаревшими документы указанных товаров, а также товаров,
+        которые ссылаются на них (сопутствующие товары и цветовые вариации).
+        """
+        product_ids = set(product_ids)
+        if not product_ids:
+            return
+        referencing = Product.related_products.through.objects\
+            .filter(to_product_id__in=product_ids).values('from_product_id')
+        cls.objects.filter(
+            models.Q(product_id__in=product_ids) |
+            models.Q(product_id__in=referencing) |
+            models.Q(product__color_group__products__in=product_ids)
+        ).update(version=F('version') + 1)
 
-        return queryset.annotate(price=price_annotation)
 
 # --- Модель ProductImage (С ИЗМЕНЕНИЯМИ) ---
 class ProductImage(models.Model):
@@ -218,6 +353,7 @@ class ProductImage(models.Model):
                                      processors=[ResizeToFit(width=800, height=800)],
                                      format='WEBP',
                                      options={'quality': 85})
+    thumbnails = models.JSONField("Миниатюры", default=dict, blank=True, editable=False)
 
     def __str__(self):
         return f"Фото для {self.product.name}"
@@ -236,6 +372,7 @@ class PromoBanner(models.Model):
                                      processors=[ResizeToFit(width=280)],
                                      format='WEBP',
                                      options={'quality': 80})
+    thumbnails = models.JSONField("Миниатюры", default=dict, blank=True, editable=False)
 
     link_url = models.URLField("URL-ссылка (куда ведет баннер)", blank=True, null=True)
     text_content = models.CharField("Текст на баннере", max_length=150, blank=True, help_text="Оставьте пустым, если текст не нужен")
@@ -262,6 +399,7 @@ class ProductInfoCard(models.Model):
                                      processors=[ResizeToFit(width=240)],
                                      format='WEBP',
                                      options={'quality': 80})
+    thumbnails = models.JSONField("Миниатюры", default=dict, blank=True, editable=False)
 
     link_url = models.URLField("URL для перехода по клику")
 
@@ -298,6 +436,12 @@ class DiscountRule(models.Model):
 class ShopSettings(models.Model):
 
     manager_username = models.CharField("Юзернейм менеджера в Telegram", max_length=100, help_text="Без @", default="username")
+    manager_chat_id = models.CharField(
+        "Chat ID менеджера в Telegram", max_length=32, blank=True,
+        help_text="Куда бот присылает уведомления о заказах. Бот не может написать пользователю по юзернейму: "
+                  "укажите числовой ID чата (менеджер должен сначала написать боту). Если пусто - используется @юзернейм "
+                  "(работает только для публичных каналов и групп)."
+    )
     contact_phone = models.CharField("Контактный телефон", max_length=20, blank=True)
     about_us_section = CKEditor5Field("Блок 'О нас'", blank=True, help_text="Краткий рассказ о магазине", config_name='default')
     delivery_section = CKEditor5Field("Блок 'Условия доставки'", blank=True, config_name='default')
@@ -393,6 +537,7 @@ class ShopImage(models.Model):
                                      processors=[ResizeToFit(width=800)],
                                      format='WEBP',
                                      options={'quality': 85})
+    thumbnails = models.JSONField("Миниатюры", default=dict, blank=True, editable=False)
 
     caption = models.CharField("Подпись (опционально)", max_length=200, blank=True)
     order = models.PositiveIntegerField("Порядок", default=0)
@@ -407,6 +552,8 @@ class Cart(models.Model):
     telegram_id = models.BigIntegerField("Telegram ID пользователя", unique=True, db_index=True)
     created_at = models.DateTimeField("Дата создания", auto_now_add=True)
     updated_at = models.DateTimeField("Дата обновления", auto_now=True)
+    # Версия состояния корзины из хранилища (см. carts.py); по ней клиент получает дельты (см. CartView)
+    version = models.PositiveIntegerField("Версия", default=0, editable=False)
 
     def __str__(self):
         return f"Корзина пользователя {self.telegram_id}"
@@ -414,6 +561,9 @@ class Cart(models.Model):
     class Meta:
         verbose_name = "Корзина пользователя"
         verbose_name_plural = "Корзины пользователей"
+        indexes = [
+            models.Index(fields=['-updated_at'], name='cart_updated_idx'),
+        ]
 
 class CartItem(models.Model):
     """Модель товара в корзине."""
@@ -446,6 +596,8 @@ class Order(models.Model):
 
     telegram_id = models.BigIntegerField("Telegram ID пользователя", db_index=True)
     created_at = models.DateTimeField("Дата создания", auto_now_add=True)
+    # По нему аналитика находит новые и измененные заказы (см. analytics.py)
+    updated_at = models.DateTimeField("Дата изменения", auto_now=True, db_index=True)
     status = models.CharField("Статус заказа", max_length=20, choices=OrderStatus.choices, default=OrderStatus.NEW)
 
     # Контактные данные
@@ -476,6 +628,10 @@ class Order(models.Model):
     final_total = models.DecimalField("Итоговая сумма", max_digits=10, decimal_places=2)
     applied_rule = models.CharField("Примененная скидка", max_length=255, blank=True, null=True)
 
+    # Ключ из заголовка Idempotency-Key: повторная отправка того же заказа
+    # (например, при обрыве связи) возвращает уже созданный заказ
+    idempotency_key = models.CharField("Ключ идемпотентности", max_length=64, blank=True, null=True, editable=False)
+
     def get_full_name(self):
         return f"{self.last_name} {self.first_name} {self.patronymic}".strip()
     get_full_name.short_description = "ФИО клиента"
@@ -487,6 +643,19 @@ class Order(models.Model):
         verbose_name = "Заказ"
         verbose_name_plural = "Заказы"
         ordering = ['-created_at']
+        indexes = [
+            # Список заказов в админке: сортировка по дате и фильтры по статусу/способу доставки
+            models.Index(fields=['-created_at'], name='order_created_idx'),
+            models.Index(fields=['status', '-created_at'], name='order_status_created_idx'),
+            models.Index(fields=['delivery_method', '-created_at'], name='order_delivery_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['telegram_id', 'idempotency_key'],
+                condition=models.Q(idempotency_key__isnull=False),
+                name='order_idempotency_key_uniq',
+            ),
+        ]
 
 
 class OrderItem(models.Model):
@@ -503,6 +672,140 @@ class OrderItem(models.Model):
         verbose_name_plural = "Товары в заказе"
 
 
+class OutboxMessage(models.Model):
+    """
+    Исходящее уведомление (transactional outbox). Записывается в той же транзакции,
+    что и событие (например, новый заказ), и отправляется воркером run_outbox_worker
+    (см. outbox.py). Так внешний HTTP-запрос не задерживает оформление заказа,
+    а уведомление не теряется, если отправка не удалась.
+    """
+    class Kind(models.TextChoices):
+        NEW_ORDER = 'new_order', 'Новый заказ'
+
+    kind = models.CharField("Тип", max_length=30, choices=Kind.choices)
+    payload = models.JSONField("Данные", default=dict)
+    created_at = models.DateTimeField("Дата создания", auto_now_add=True)
+    available_at = models.DateTimeField("Отправить не раньше", default=timezone.now)
+    attempts = models.PositiveIntegerField("Попыток отправки", default=0)
+    sent_at = models.DateTimeField("Дата отправки", null=True, blank=True)
+    last_error = models.TextField("Последняя ошибка", blank=True)
+
+    def __str__(self):
+        return f"{self.get_kind_display()} #{self.id}"
+
+    class Meta:
+        verbose_name = "Исходящее уведомление"
+        verbose_name_plural = "Исходящие уведомления"
+        ordering = ['available_at']
+        indexes = [
+            # Очередь воркера: неотправленные сообщения по времени готовности
+            models.Index(fields=['available_at'], condition=models.Q(sent_at__isnull=True), name='outbox_pending_idx'),
+        ]
+
+
+class ThumbnailJob(models.Model):
+    """
+    Задача генерации миниатюр (ImageSpecField) одного исходного изображения.
+    Ставится при сохранении нового изображения и выполняется воркером
+    run_thumbnail_worker (см. thumbnails.py), а не в запросе админки.
+    """
+    model = models.CharField("Модель", max_length=100)
+    object_id = models.PositiveBigIntegerField("ID объекта")
+    source_field = models.CharField("Поле изображения", max_length=50)
+    source_name = models.CharField("Файл изображения", max_length=255)
+    created_at = models.DateTimeField("Дата создания", auto_now_add=True)
+    available_at = models.DateTimeField("Выполнить не раньше", default=timezone.now)
+    attempts = models.PositiveIntegerField("Попыток", default=0)
+    last_error = models.TextField("Последняя ошибка", blank=True)
+
+    def __str__(self):
+        return f"{self.model} #{self.object_id}: {self.source_name}"
+
+    class Meta:
+        verbose_name = "Задача генерации миниатюр"
+        verbose_name_plural = "Задачи генерации миниатюр"
+        ordering = ['available_at']
+        constraints = [
+            # Одна задача на изображение: повторная загрузка обновляет существующую
+            models.UniqueConstraint(fields=['model', 'object_id', 'source_field'], name='thumbnail_job_source_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['available_at'], name='thumbnail_job_available_idx'),
+        ]
+
+
+# --- Дневные агрегаты продаж (см. analytics.py) ---
+class SalesDay(models.Model):
+    """Заказы и выручка за день в разрезе статуса заказа."""
+    day = models.DateField("День")
+    status = models.CharField("Статус заказа", max_length=20, choices=Order.OrderStatus.choices)
+    orders_count = models.PositiveIntegerField("Заказов", default=0)
+    subtotal = models.DecimalField("Сумма (без скидки)", max_digits=14, decimal_places=2, default=0)
+    discount_amount = models.DecimalField("Скидки", max_digits=14, decimal_places=2, default=0)
+    final_total = models.DecimalField("Выручка", max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name = "Продажи за день"
+        verbose_name_plural = "Продажи по дням"
+        unique_together = ('day', 'status')
+
+
+class ProductSalesDay(models.Model):
+    """Продажи товара за день (без отмененных заказов, по цене на момент покупки)."""
+    day = models.DateField("День")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', verbose_name="Товар")
+    quantity = models.PositiveIntegerField("Продано, шт.", default=0)
+    revenue = models.DecimalField("Сумма", max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name = "Продажи товара за день"
+        verbose_name_plural = "Продажи товаров по дням"
+        unique_together = ('day', 'product')
+
+
+class CategorySalesDay(models.Model):
+    """Продажи категории за день (без отмененных заказов)."""
+    day = models.DateField("День")
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+', verbose_name="Категория")
+    quantity = models.PositiveIntegerField("Продано, шт.", default=0)
+    revenue = models.DecimalField("Сумма", max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name = "Продажи категории за день"
+        verbose_name_plural = "Продажи категорий по дням"
+        unique_together = ('day', 'category')
+
+
+class DiscountRuleSalesDay(models.Model):
+    """Заказы со скидкой за день в разрезе примененного правила (без отмененных заказов)."""
+    day = models.DateField("День")
+    applied_rule = models.CharField("Примененная скидка", max_length=255)
+    orders_count = models.PositiveIntegerField("Заказов", default=0)
+    discount_amount = models.DecimalField("Скидки", max_digits=14, decimal_places=2, default=0)
+    final_total = models.DecimalField("Выручка", max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name = "Скидка за день"
+        verbose_name_plural = "Скидки по дням"
+        unique_together = ('day', 'applied_rule')
+
+
+class SalesRollupState(models.Model):
+    """Водяной знак агрегатов: заказы, измененные до этого момента, уже учтены."""
+    watermark = models.DateTimeField("Учтены изменения до", null=True, blank=True)
+
+    def save(self, *args, **kwargs):
+        self.pk = 1; super().save(*args, **kwargs)
+
+    @classmethod
+    def load(cls):
+        obj, created = cls.objects.get_or_create(pk=1); return obj
+
+    class Meta:
+        verbose_name = "Состояние агрегатов продаж"
+        verbose_name_plural = "Состояние агрегатов продаж"
+
+
 class ArticleCategory(models.Model):
     """Категории для статей (например, Обзоры, Новости)."""
     name = models.CharField("Название категории", max_length=100, unique=True)
@@ -545,6 +848,7 @@ class Article(models.Model):
                                                   processors=[ResizeToFit(width=1200)],
                                                   format='WEBP',
                                                   options={'quality': 85})
+    thumbnails = models.JSONField("Миниатюры", default=dict, blank=True, editable=False)
 
     # --- Тип и тело статьи ---
     # --- ВОТ ВТОРОЕ НЕДОСТАЮЩЕЕ ПОЛЕ ---
@@ -556,6 +860,9 @@ class Article(models.Model):
     # --- Организация и связи ---
     category = models.ForeignKey(ArticleCategory, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Категория")
     status = models.CharField("Статус", max_length=10, choices=Status.choices, default=Status.DRAFT, help_text="'Черновик' не виден пользователям, 'Опубликовано' - виден всем.")
+    # Опубликована и дата публикации наступила. Отложенные статьи открывает задача
+    # publish_scheduled_articles (scheduler.py), поэтому выборки не сравнивают даты с текущим временем
+    is_visible = models.BooleanField("Видна на сайте", default=False, editable=False, db_index=True)
     is_featured = models.BooleanField("Закрепленная статья", default=False, help_text="Отметьте, чтобы статья отображалась в особых блоках (например, 'Статья дня').")
     related_products = models.ManyToManyField(Product, blank=True, verbose_name="Связанные товары", help_text="Товары, которые будут рекомендоваться в конце статьи.")
 
@@ -564,17 +871,29 @@ class Article(models.Model):
     meta_description = models.TextField("Meta Description (для SEO)", max_length=160, blank=True, help_text="Краткое описание для Google и Яндекс (до 160 символов). Очень важно для привлечения пользователей.")
     views_count = models.PositiveIntegerField("Количество просмотров", default=0, editable=False) # editable=False, чтобы его нельзя было изменить вручную в админке
 
-    @property
-    def reading_time(self):
-        """Вычисляет примерное время на чтение статьи в минутах."""
-        if self.content_type == self.ContentType.INTERNAL and self.content:
-            # Очищаем HTML-теги, чтобы посчитать только слова
-            plain_text = strip_tags(self.content)
-            word_count = len(plain_text.split())
-            # Средняя скорость чтения взрослого человека ~200 слов в минуту
-            time_in_minutes = math.ceil(word_count / 200)
-            return time_in_minutes
-        return 0 # Для внешних ссылок или пустых статей время чтения 0
+    # Текст статьи без HTML и производные от него поля. Считаются в save() (для старых
+    # статей - командой rebuild_article_text), чтобы чтение статьи не разбирало HTML.
+    plain_text = models.TextField("Текст без разметки", blank=True, editable=False)
+    word_count = models.PositiveIntegerField("Количество слов", default=0, editable=False)
+    reading_time = models.PositiveIntegerField("Время чтения, мин", default=0, editable=False)
+
+    # Поисковый индекс: tsvector по заголовку, описанию и тексту без HTML (обновляется сигналом при сохранении)
+    search_vector = SearchVectorField(null=True, editable=False)
+    search_vector_fields = (('title', 'A'), ('meta_description', 'B'), ('plain_text', 'C'))
+
+    # Поля, которые пересчитываются из content
+    TEXT_FIELDS = ('plain_text', 'word_count', 'reading_time')
+
+    def update_text_fields(self):
+        """Пересчитывает текст без разметки, число слов и время чтения из content."""
+        if self.content_type == self.ContentType.INTERNAL:
+            self.plain_text = html_to_text(self.content)
+        else:
+            self.plain_text = ''
+        self.word_count = len(self.plain_text.split())
+        # Средняя скорость чтения взрослого человека ~200 слов в минуту.
+        # Для внешних ссылок или пустых статей время чтения 0
+        self.reading_time = math.ceil(self.word_count / 200)
 
     def __str__(self):
         return self.title
@@ -583,9 +902,36 @@ class Article(models.Model):
         # Автоматическое создание slug из title, если slug не задан
         if not self.slug:
             self.slug = slugify(self.title)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'content', 'content_type'}.intersection(update_fields):
+            self.update_text_fields()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], *self.TEXT_FIELDS}
+        if update_fields is None or {'status', 'published_at'}.intersection(update_fields):
+            self.is_visible = self.status == self.Status.PUBLISHED and self.published_at <= timezone.now()
+            if update_fields is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'is_visible'}
         super().save(*args, **kwargs)
 
+    @classmethod
+    def publish_scheduled(cls):
+        """
+        Открывает статьи, дата публикации которых наступила (и скрывает те,
+        у которых она снова в будущем). Возвращает число измененных статей.
+        """
+        now = timezone.now()
+        should_be_visible = models.Q(status=cls.Status.PUBLISHED, published_at__lte=now)
+        shown = cls.objects.filter(should_be_visible, is_visible=False).update(is_visible=True)
+        hidden = cls.objects.filter(is_visible=True).exclude(should_be_visible).update(is_visible=False)
+        return shown + hidden
+
     class Meta:
         verbose_name = "Статья"
         verbose_name_plural = "Статьи"
-        ordering = ['-published_at']
\ No newline at end of file
+        ordering = ['-published_at']
+        indexes = [
+            # Лента блога: видимые статьи по дате публикации
+            models.Index(fields=['is_visible', '-published_at'], name='article_visible_published_idx'),
+            GinIndex(fields=['search_vector'], name='article_search_vector_idx'),
+            GinIndex(fields=['title'], opclasses=['gin_trgm_ops'], name='article_title_trgm_idx'),
+        ]
\ No newline at end of file
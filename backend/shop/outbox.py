@@ -0,0 +1,137 @@
+# backend/shop/outbox.py
+"""
+Отправка исходящих уведомлений (transactional outbox).
+
+Сообщения OutboxMessage записываются в одной транзакции с событием (см.
+OrderCreateSerializer.create), а воркер `python manage.py run_outbox_worker`
+забирает их пачками через SELECT ... FOR UPDATE SKIP LOCKED под аренду
+CLAIM_TIMEOUT: несколько воркеров не отправят одно сообщение дважды и не ждут
+друг друга. Отправка идет уже после коммита аренды, поэтому медленный Telegram
+не держит транзакцию и блокировки строк. Если воркер упал между отправкой и
+отметкой об отправке, сообщение уйдет повторно после истечения аренды.
+
+Неудачная отправка откладывается с экспоненциальной задержкой; после
+MAX_ATTEMPTS попыток сообщение остается в админке с текстом последней ошибки.
+Отправитель подключается настройкой OUTBOX_SENDER (путь к классу с методом send(text)).
+"""
+import json
+import urllib.error
+import urllib.request
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Order, OutboxMessage, ShopSettings
+
+MAX_ATTEMPTS = 10
+BACKOFF_BASE = 10       # секунд до второй попытки, дальше задержка удваивается
+BACKOFF_MAX = 60 * 60
+SEND_TIMEOUT = 10
+# Заведомо больше времени отправки пачки (SEND_TIMEOUT на сообщение)
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+class TelegramSender:
+    """Отправляет уведомления менеджеру через Telegram Bot API (sendMessage)."""
+
+    def send(self, text):
+        if not settings.TELEGRAM_BOT_TOKEN:
+            raise RuntimeError("TELEGRAM_BOT_TOKEN не задан")
+        shop_settings = ShopSettings.load()
+        # Бот не может написать пользователю по юзернейму, только по ID чата;
+        # @юзернейм подходит лишь для публичных каналов и групп
+        chat_id = shop_settings.manager_chat_id or f"@{shop_settings.manager_username.lstrip('@')}"
+
+        request = urllib.request.Request(
+            f"{settings.TELEGRAM_API_URL}/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage",
+            data=json.dumps({'chat_id': chat_id, 'text': text}).encode(),
+            headers={'Content-Type': 'application/json'},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=SEND_TIMEOUT) as response:
+                result = json.loads(response.read())
+        except urllib.error.HTTPError as exc:
+            raise RuntimeError(f"Telegram API {exc.code}: {exc.read()[:500].decode(errors='replace')}") from exc
+        if not result.get('ok'):
+            raise RuntimeError(f"Telegram API: {result.get('description', result)}")
+
+
+def get_sender():
+    return import_string(settings.OUTBOX_SENDER)()
+
+
+def _format_new_order(payload):
+    order = Order.objects.filter(pk=payload['order_id']).first()
+    if order is None:
+        return None
+    items = order.items.select_related('product')
+    lines = [
+        f"Новый заказ #{order.id}",
+        f"{order.get_full_name()}, {order.phone}",
+        f"Доставка: {order.delivery_method}",
+        "",
+        *(f"{item.product.name} (x{item.quantity})" for item in items),
+        "-----------------",
+        f"Сумма: {order.subtotal} ₽",
+        f"Скидка ({order.applied_rule or 'нет'}): {order.discount_amount} ₽",
+        f"Итого к оплате: {order.final_total} ₽",
+    ]
+    return "\n".join(lines)
+
+
+FORMATTERS = {
+    OutboxMessage.Kind.NEW_ORDER: _format_new_order,
+}
+
+
+def backoff_delay(attempts):
+    """Задержка перед следующей попыткой после `attempts` неудачных."""
+    return timedelta(seconds=min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX))
+
+
+def claim_outbox_messages(batch_size):
+    """Забирает пачку готовых к отправке сообщений (SELECT ... FOR UPDATE SKIP LOCKED) под аренду CLAIM_TIMEOUT."""
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(sent_at__isnull=True, available_at__lte=now, attempts__lt=MAX_ATTEMPTS)
+            .order_by('available_at')[:batch_size]
+        )
+        for message in batch:
+            message.attempts += 1
+            message.available_at = now + CLAIM_TIMEOUT
+        OutboxMessage.objects.bulk_update(batch, ['attempts', 'available_at'])
+    return batch
+
+
+def process_outbox(batch_size=50, sender=None):
+    """
+    Отправляет одну пачку готовых к отправке сообщений.
+    Возвращает (отправлено, с ошибкой).
+    """
+    sender = sender or get_sender()
+    sent = failed = 0
+
+    for message in claim_outbox_messages(batch_size):
+        try:
+            text = FORMATTERS[message.kind](message.payload)
+            if text is None:
+                # Объект уже удален - отправлять нечего
+                last_error = "Объект уведомления не найден"
+            else:
+                sender.send(text)
+                last_error = ''
+        except Exception as exc:
+            OutboxMessage.objects.filter(pk=message.pk).update(
+                available_at=timezone.now() + backoff_delay(message.attempts), last_error=f"{type(exc).__name__}: {exc}"
+            )
+            failed += 1
+        else:
+            OutboxMessage.objects.filter(pk=message.pk).update(sent_at=timezone.now(), last_error=last_error)
+            sent += 1
+
+    return sent, failed
@@ -0,0 +1,71 @@
+# backend/shop/quotes.py
+"""
+Подписанные ценовые предложения (квоты).
+
+Эндпоинты расчета (корзина, выбор товаров) вместе с итогами отдают квоту:
+подписанный HMAC (django.core.signing) снимок позиций, цен, правила и итогов.
+Оформление заказа принимает квоту и не пересчитывает скидки, если квота
+не истекла, выписана этому же пользователю на те же позиции и с тех пор
+не изменились ни цены этих товаров, ни правила скидок, ни дерево категорий.
+"""
+from django.core import signing
+
+from .caching import pricing_version
+
+QUOTE_SALT = 'shop.quote'
+QUOTE_MAX_AGE = 60 * 15
+
+
+def order_pricing(calculation_results):
+    """
+    Из результата calculate_detailed_discounts берет то, что нужно заказу:
+    [id товара, количество, цена покупки] и итоги (Decimal хранятся строками).
+    """
+    items = []
+    for item in calculation_results['items']:
+        price = item['discounted_price'] if item['discounted_price'] is not None else item['original_price']
+        items.append([item['product'].id, item['quantity'], str(price)])
+    return {
+        'items': items,
+        'subtotal': str(calculation_results['subtotal']),
+        'discount_amount': str(calculation_results['discount_amount']),
+        'final_total': str(calculation_results['final_total']),
+        'applied_rule': calculation_results['applied_rule'],
+    }
+
+
+def issue_quote(telegram_id, pricing, version):
+    """
+    Подписывает расчет для пользователя.
+    `version` - pricing_version товаров, снятый ДО чтения товаров и правил для расчета:
+    если цены изменятся во время расчета, квота окажется под старой версией и не пройдет redeem_quote.
+    """
+    payload = {
+        'user': telegram_id,
+        'pricing': pricing,
+        'version': version,
+    }
+    return signing.dumps(payload, salt=QUOTE_SALT, compress=True)
+
+
+def redeem_quote(token, telegram_id, items):
+    """
+    Проверяет квоту для позиций заказа [(id товара, количество), ...].
+    Возвращает расчет из квоты или None, если квоту использовать нельзя и нужен пересчет.
+    """
+    if not token:
+        return None
+    try:
+        payload = signing.loads(token, salt=QUOTE_SALT, max_age=QUOTE_MAX_AGE)
+    except signing.BadSignature:  # в том числе SignatureExpired
+        return None
+
+    pricing = payload['pricing']
+    if payload['user'] != telegram_id:
+        return None
+    quoted_items = sorted((product_id, quantity) for product_id, quantity, _ in pricing['items'])
+    if quoted_items != sorted(items):
+        return None
+    if payload['version'] != pricing_version(product_id for product_id, _ in items):
+        return None
+    return pricing
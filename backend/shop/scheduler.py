@@ -0,0 +1,62 @@
+# backend/shop/scheduler.py
+"""
+Реестр периодических задач магазина.
+Все задачи выполняются одним процессом: python manage.py run_scheduler
+"""
+from django.conf import settings
+
+PERIODIC_JOBS = []
+
+
+def periodic_job(interval):
+    """Регистрирует функцию как периодическую задачу с интервалом в секундах."""
+    def decorator(func):
+        PERIODIC_JOBS.append((func, interval))
+        return func
+    return decorator
+
+
+@periodic_job(interval=60)
+def refresh_deal_prices():
+    """Возвращает обычную цену товарам, у которых закончилась акция 'Товар дня'."""
+    from .models import Product
+    return Product.sync_effective_prices()
+
+
+@periodic_job(interval=30)
+def rebuild_product_documents():
+    """Пересобирает устаревшие документы детальных страниц товаров."""
+    from .documents import rebuild_stale_product_documents
+    return rebuild_stale_product_documents()
+
+
+@periodic_job(interval=settings.CART_FLUSH_INTERVAL)
+def flush_carts():
+    """Сбрасывает в БД корзины, измененные в кэше (см. carts.py)."""
+    from .carts import flush_dirty_carts
+    return flush_dirty_carts()
+
+
+@periodic_job(interval=60)
+def publish_scheduled_articles():
+    """Открывает статьи с наступившей датой публикации и сбрасывает кэш ленты блога."""
+    from .caching import bump_blog_version
+    from .models import Article
+    changed = Article.publish_scheduled()
+    if changed:
+        bump_blog_version()
+    return changed
+
+
+@periodic_job(interval=settings.ARTICLE_VIEWS_FLUSH_INTERVAL)
+def flush_article_views():
+    """Переносит накопленные просмотры статей в БД (см. counters.py)."""
+    from .counters import flush_article_views
+    return flush_article_views()
+
+
+@periodic_job(interval=300)
+def update_sales_rollups():
+    """Обновляет дневные агрегаты продаж по новым и измененным заказам (см. analytics.py)."""
+    from .analytics import update_sales_rollups
+    return update_sales_rollups()
@@ -0,0 +1,65 @@
+# backend/shop/search.py
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+from django.db import connection
+from django.db.models import F, Q, TextField, Value
+from rest_framework import filters
+from rest_framework.settings import api_settings
+
+from .utils import html_to_text
+
+# Словарь PostgreSQL со стеммингом русского языка ("наушники" найдет "наушников")
+SEARCH_CONFIG = 'russian'
+
+
+def update_search_vector(instance):
+    """
+    Пересчитывает колонку search_vector для одного объекта.
+    Поля и их веса берутся из атрибута модели search_vector_fields.
+    """
+    if connection.vendor != 'postgresql':
+        return
+
+    model = type(instance)
+    vector = None
+    for field_name, weight in model.search_vector_fields:
+        text = html_to_text(getattr(instance, field_name))
+        part = SearchVector(Value(text, output_field=TextField()), weight=weight, config=SEARCH_CONFIG)
+        vector = part if vector is None else vector + part
+
+    model.objects.filter(pk=instance.pk).update(search_vector=vector)
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    """
+    Замена SearchFilter для PostgreSQL: ищет по заранее посчитанному tsvector
+    (морфология) и по триграммам названия (опечатки), сортирует по релевантности.
+    На других БД (например, sqlite в тестах) работает как обычный SearchFilter.
+
+    View может указать search_trigram_field - поле для нечеткого поиска по триграммам.
+    """
+    def filter_queryset(self, request, queryset, view):
+        if connection.vendor != 'postgresql':
+            return super().filter_queryset(request, queryset, view)
+
+        terms = ' '.join(self.get_search_terms(request))
+        if not terms:
+            return queryset
+
+        query = SearchQuery(terms, config=SEARCH_CONFIG, search_type='websearch')
+        queryset = queryset.annotate(search_rank=SearchRank(F('search_vector'), query))
+        condition = Q(search_vector=query)
+        score = F('search_rank')
+
+        trigram_field = getattr(view, 'search_trigram_field', None)
+        if trigram_field:
+            # Оператор %> использует GIN-индекс gin_trgm_ops по этому полю
+            condition |= Q(**{f'{trigram_field}__trigram_word_similar': terms})
+            queryset = queryset.annotate(search_similarity=TrigramWordSimilarity(terms, trigram_field))
+            score = score + F('search_similarity')
+
+        queryset = queryset.filter(condition)
+
+        # Явная сортировка пользователя (?ordering=price) важнее релевантности
+        if not request.query_params.get(api_settings.ORDERING_PARAM):
+            queryset = queryset.annotate(search_score=score).order_by('-search_score', '-pk')
+        return queryset
@@ -1,11 +1,18 @@
 # backend/shop/serializers.py
+from decimal import Decimal
+
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from django.db import models, transaction
+from django.db.models import prefetch_related_objects
+from django.utils.text import Truncator
+from .caching import get_product_cards
+from .thumbnails import thumbnail_url
 from .models import (
     InfoPanel, Category, Product, ProductImage, PromoBanner,
     ProductInfoCard, ColorGroup, ShopSettings, FaqItem, ShopImage,
     Feature, CharacteristicCategory, Characteristic,
-    ProductCharacteristic, Cart, CartItem, Order, OrderItem, Article, ArticleCategory
+    ProductCharacteristic, Cart, CartItem, Order, OrderItem, OutboxMessage, Article, ArticleCategory
 )
 
 
@@ -36,12 +43,21 @@ class ImageUrlBuilderSerializer(serializers.ModelSerializer):
     Базовый сериализатор, который умеет строить абсолютные URL для полей с файлами.
     """
     def _get_absolute_url(self, file_field):
-        """Вспомогательный метод для получения полного URL."""
+        """
+        Вспомогательный метод для получения полного URL.
+        Без request в контексте (например, при сборке документов для кэша) возвращает относительный URL.
+        """
         request = self.context.get('request')
-        if request and file_field and hasattr(file_field, 'url'):
-            return request.build_absolute_uri(file_field.url)
+        if file_field and hasattr(file_field, 'url'):
+            return request.build_absolute_uri(file_field.url) if request else file_field.url
         return None
 
+    def _get_thumbnail_url(self, obj, spec_name):
+        """URL миниатюры из манифеста объекта (см. thumbnails.thumbnail_url), без обращения к хранилищу."""
+        url = thumbnail_url(obj, spec_name)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if url and request else url
+
 
 # --- Вспомогательные сериализаторы ---
 
@@ -58,7 +74,11 @@ class CategorySerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'subcategories')
 
     def get_subcategories(self, obj):
-        serializer = CategorySerializer(obj.subcategories.all(), many=True)
+        # Дерево целиком загружается одним запросом (см. CategoryListView):
+        # дочерние категории берутся из словаря {parent_id: [категории]} в контексте
+        children = self.context.get('children_by_parent')
+        subcategories = children.get(obj.id, []) if children is not None else obj.subcategories.all()
+        serializer = CategorySerializer(subcategories, many=True, context=self.context)
         return serializer.data
 
 
@@ -75,7 +95,7 @@ class ProductImageSerializer(ImageUrlBuilderSerializer):
         return self._get_absolute_url(obj.image)
 
     def get_thumbnail_url(self, obj):
-        return self._get_absolute_url(obj.image_thumbnail)
+        return self._get_thumbnail_url(obj, 'image_thumbnail')
 
 # Сериализатор для инфо-карточек (фич)
 class ProductInfoCardSerializer(ImageUrlBuilderSerializer):
@@ -87,7 +107,7 @@ class ProductInfoCardSerializer(ImageUrlBuilderSerializer):
         fields = ('title', 'image_url', 'link_url')
 
     def get_image_url(self, obj):
-        return self._get_absolute_url(obj.image_thumbnail)
+        return self._get_thumbnail_url(obj, 'image_thumbnail')
 
 # Сериализатор для промо-баннеров (сторис)
 class PromoBannerSerializer(ImageUrlBuilderSerializer):
@@ -99,7 +119,7 @@ class PromoBannerSerializer(ImageUrlBuilderSerializer):
         fields = ('id', 'image_url', 'link_url', 'text_content', 'text_color')
 
     def get_image_url(self, obj):
-        return self._get_absolute_url(obj.image_thumbnail)
+        return self._get_thumbnail_url(obj, 'image_thumbnail')
 
 # Сериализатор для фото магазина на странице FAQ
 class ShopImageSerializer(ImageUrlBuilderSerializer):
@@ -114,18 +134,59 @@ class ShopImageSerializer(ImageUrlBuilderSerializer):
         return self._get_absolute_url(obj.image)
 
     def get_thumbnail_url(self, obj):
-        return self._get_absolute_url(obj.image_thumbnail)
+        return self._get_thumbnail_url(obj, 'image_thumbnail')
 
 
 # --- Основные сериализаторы ---
 
+class ProductCardListSerializer(serializers.ListSerializer):
+    """
+    Собирает список карточек товаров из кэша готовых фрагментов (см. caching.py).
+    Сериализуются (и подгружают info_panels) только товары, которых нет в кэше.
+    Во фрагментах хранятся относительные URL, абсолютными они становятся здесь.
+    """
+    def to_representation(self, data):
+        products = data.all() if isinstance(data, models.manager.BaseManager) else data
+        products_by_id = {product.pk: product for product in products}
+
+        def serialize(missing_ids):
+            missing = [products_by_id[product_id] for product_id in missing_ids]
+            prefetch_related_objects(missing, 'info_panels')
+            return _serialize_cards(missing)
+
+        cards = get_product_cards([product.pk for product in products], serialize)
+        return _absolutize_cards(cards, self.context.get('request'))
+
+    @classmethod
+    def for_ids(cls, product_ids, context):
+        """Карточки товаров по их ID (товары грузятся из БД только при промахах кэша)."""
+        def serialize(missing_ids):
+            return _serialize_cards(Product.objects.filter(id__in=missing_ids).prefetch_related('info_panels'))
+
+        cards = get_product_cards(product_ids, serialize)
+        return _absolutize_cards(cards, context.get('request'))
+
+
+def _serialize_cards(products):
+    # Без request в контексте сериализатор отдает относительные URL
+    card_serializer = ProductListSerializer(context={})
+    return {product.pk: card_serializer.to_representation(product) for product in products}
+
+
+def _absolutize_cards(cards, request):
+    for card in cards:
+        if request and card['main_image_thumbnail_url']:
+            card['main_image_thumbnail_url'] = request.build_absolute_uri(card['main_image_thumbnail_url'])
+    return cards
+
+
 # Сериализатор для превью в списке товаров
 class ProductListSerializer(serializers.ModelSerializer):
     info_panels = InfoPanelSerializer(many=True, read_only=True)
     main_image_thumbnail_url = serializers.SerializerMethodField()
 
     # ИЗМЕНЕНИЕ 1: 'price' теперь всегда актуальная цена (обычная или акционная)
-    # Мы используем свойство current_price, которое создали в модели
+    # Свойство current_price читает сохраненное поле effective_price, без вычислений по времени
     price = serializers.DecimalField(max_digits=10, decimal_places=2, source='current_price', read_only=True)
 
     class Meta:
@@ -139,16 +200,17 @@ class ProductListSerializer(serializers.ModelSerializer):
             'main_image_thumbnail_url',
             'info_panels'
         )
+        # Списки карточек собираются из кэша (см. ProductCardListSerializer)
+        list_serializer_class = ProductCardListSerializer
 
     def get_main_image_thumbnail_url(self, obj):
         request = self.context.get('request')
-        # Проверяем наличие main_image_thumbnail, чтобы избежать ошибок, если у товара нет фото
-        if hasattr(obj, 'main_image_thumbnail') and obj.main_image_thumbnail:
-            return request.build_absolute_uri(obj.main_image_thumbnail.url)
-        return None
+        # URL из манифеста миниатюр; None, если у товара нет фото
+        url = thumbnail_url(obj, 'main_image_thumbnail')
+        return request.build_absolute_uri(url) if url and request else url
 
 # Сериализатор для цветовых вариаций (квадратики)
-class ColorVariationSerializer(serializers.ModelSerializer):
+class ColorVariationSerializer(ImageUrlBuilderSerializer):
     main_image_thumbnail_url = serializers.SerializerMethodField()
 
     class Meta:
@@ -156,11 +218,10 @@ class ColorVariationSerializer(serializers.ModelSerializer):
         fields = ('id', 'main_image_thumbnail_url')
 
     def get_main_image_thumbnail_url(self, obj):
-        request = self.context.get('request')
-        return request.build_absolute_uri(obj.main_image_thumbnail.url) if hasattr(obj, 'main_image_thumbnail') and obj.main_image_thumbnail else None
+        return self._get_thumbnail_url(obj, 'main_image_thumbnail')
 
 # Сериализатор для детальной страницы товара
-class ProductDetailSerializer(serializers.ModelSerializer):
+class ProductDetailSerializer(ImageUrlBuilderSerializer):
     info_panels = InfoPanelSerializer(many=True, read_only=True)
     images = ProductImageSerializer(many=True, read_only=True)
     info_cards = ProductInfoCardSerializer(many=True, read_only=True)
@@ -190,17 +251,15 @@ class ProductDetailSerializer(serializers.ModelSerializer):
         )
 
     def get_grouped_characteristics(self, obj):
-        # Получаем все характеристики товара, сразу подгружая связанные категории и названия
-        characteristics = obj.characteristics.select_related('characteristic__category').all()
+        # Характеристики вместе с названиями и категориями подгружены в ProductDetailView.get_queryset
+        characteristics = obj.characteristics.all()
 
-        # Группируем их по категориям
+        # Группируем их по категориям за один проход, без вложенного сериализатора на каждую строку
         grouped_data = {}
         for pc in characteristics:
             category_name = pc.characteristic.category.name
-            if category_name not in grouped_data:
-                grouped_data[category_name] = []
-            grouped_data[category_name].append(
-                ProductCharacteristicSerializer(pc).data
+            grouped_data.setdefault(category_name, []).append(
+                {'name': pc.characteristic.name, 'value': pc.value}
             )
 
         # Преобразуем в список для сериализатора
@@ -212,22 +271,23 @@ class ProductDetailSerializer(serializers.ModelSerializer):
         return result
 
     def get_main_image_url(self, obj):
-        request = self.context.get('request')
-        return request.build_absolute_uri(obj.main_image.url) if obj.main_image else None
+        return self._get_absolute_url(obj.main_image)
 
     def get_main_image_thumbnail_url(self, obj):
-        request = self.context.get('request')
-        return request.build_absolute_uri(obj.main_image_thumbnail.url) if hasattr(obj, 'main_image_thumbnail') and obj.main_image_thumbnail else None
+        return self._get_thumbnail_url(obj, 'main_image_thumbnail')
 
     def get_audio_sample(self, obj):
-        request = self.context.get('request')
-        return request.build_absolute_uri(obj.audio_sample.url) if obj.audio_sample else None
+        return self._get_absolute_url(obj.audio_sample)
 
     def get_color_variations(self, obj):
         if not obj.color_group:
             return []
-        queryset = Product.objects.filter(color_group=obj.color_group).exclude(id=obj.id)
-        return ColorVariationSerializer(queryset, many=True, context={'request': self.context.get('request')}).data
+        # Товары группы подгружены в ProductDetailView.get_queryset (to_attr на color_group)
+        variations = getattr(obj.color_group, 'color_variations_prefetched', None)
+        if variations is None:
+            variations = Product.objects.filter(color_group=obj.color_group, is_active=True)
+        variations = [product for product in variations if product.id != obj.id]
+        return ColorVariationSerializer(variations, many=True, context={'request': self.context.get('request')}).data
 
 # Сериализатор для глобальных настроек
 class ShopSettingsSerializer(serializers.ModelSerializer):
@@ -285,9 +345,8 @@ class DealOfTheDaySerializer(serializers.ModelSerializer):
 
     def get_main_image_thumbnail_url(self, obj):
         request = self.context.get('request')
-        if hasattr(obj, 'main_image_thumbnail') and obj.main_image_thumbnail:
-            return request.build_absolute_uri(obj.main_image_thumbnail.url)
-        return None
+        url = thumbnail_url(obj, 'main_image_thumbnail')
+        return request.build_absolute_uri(url) if url else None
 
 class CartItemSerializer(serializers.ModelSerializer):
     """Сериализатор для отдельного товара в корзине."""
@@ -313,6 +372,21 @@ class CartSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'telegram_id', 'updated_at')
 
 
+class DetailedCartItemListSerializer(serializers.ListSerializer):
+    """Берет карточки всех товаров корзины одним обращением к кэшу карточек."""
+    def to_representation(self, data):
+        items = list(data)
+        cards = ProductListSerializer(many=True, context=self.context).to_representation(
+            [item['product'] for item in items]
+        )
+        result = []
+        for item, card in zip(items, cards):
+            representation = self.child.to_representation({**item, 'product': None})
+            representation['product'] = card
+            result.append(representation)
+        return result
+
+
 class DetailedCartItemSerializer(serializers.Serializer):
     """
     Сериализатор для "раскрашенных" товаров из функции расчета.
@@ -324,6 +398,9 @@ class DetailedCartItemSerializer(serializers.Serializer):
     original_price = serializers.DecimalField(max_digits=10, decimal_places=2)
     discounted_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, allow_null=True)
 
+    class Meta:
+        list_serializer_class = DetailedCartItemListSerializer
+
 
 class OrderItemSerializer(serializers.ModelSerializer):
     """Сериализатор для товаров ВНУТРИ заказа."""
@@ -360,35 +437,30 @@ class OrderCreateSerializer(serializers.ModelSerializer):
         }
 
     def create(self, validated_data):
-        items_data = validated_data.pop('items')
-        calculation_results = self.context.get('calculation_results')
+        # Состав и количества берутся из расчета (квоты или корзины), а не из тела
+        # запроса: позиции заказа всегда сходятся с подписанными суммами
+        validated_data.pop('items')
+        # Расчет заказа (см. quotes.order_pricing): из подписанной квоты или пересчитанный
+        pricing = self.context.get('pricing')
 
-        if not calculation_results:
+        if not pricing:
              raise serializers.ValidationError("Не удалось рассчитать стоимость заказа.")
 
-        order = Order.objects.create(
-            **validated_data,
-            telegram_id=self.context.get('telegram_id'),
-            subtotal=calculation_results['subtotal'],
-            discount_amount=calculation_results['discount_amount'],
-            final_total=calculation_results['final_total'],
-            applied_rule=calculation_results['applied_rule']
-        )
-
-        for item_data in items_data:
-            product_info = next(
-                (item for item in calculation_results['items'] if item['product'].id == item_data['product_id']),
-                None
-            )
-            if not product_info:
-                continue
-
-            OrderItem.objects.create(
-                order=order,
-                product_id=item_data['product_id'],
-                quantity=item_data['quantity'],
-                price_at_purchase=product_info['discounted_price'] if product_info['discounted_price'] is not None else product_info['original_price']
+        # Заказ и все его позиции создаются вместе или не создаются вовсе
+        with transaction.atomic():
+            order = Order.objects.create(
+                **validated_data,
+                telegram_id=self.context.get('telegram_id'),
+                subtotal=pricing['subtotal'],
+                discount_amount=pricing['discount_amount'],
+                final_total=pricing['final_total'],
+                applied_rule=pricing['applied_rule']
             )
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product_id=product_id, quantity=quantity, price_at_purchase=Decimal(price))
+                for product_id, quantity, price in pricing['items']
+            ])
+            OutboxMessage.objects.create(kind=OutboxMessage.Kind.NEW_ORDER, payload={'order_id': order.id})
 
         return order
 
@@ -415,7 +487,11 @@ class ArticleListSerializer(ImageUrlBuilderSerializer):
         fields = ('title', 'slug', 'published_at', 'category', 'cover_image_url')
 
     def get_cover_image_url(self, obj):
-        return self._get_absolute_url(obj.cover_image_list_thumbnail)
+        return self._get_thumbnail_url(obj, 'cover_image_list_thumbnail')
+
+# Длина meta description, которую показывают поисковики
+META_DESCRIPTION_LENGTH = 160
+
 
 class ArticleDetailSerializer(ImageUrlBuilderSerializer):
     """Сериализатор для детального отображения статьи."""
@@ -424,8 +500,9 @@ class ArticleDetailSerializer(ImageUrlBuilderSerializer):
     related_products = ProductListSerializer(many=True, read_only=True)
     cover_image_url = serializers.SerializerMethodField()
 
-    # 1. ИЗМЕНЕНИЕ: Добавляем поле для времени чтения
+    # 1. ИЗМЕНЕНИЕ: Добавляем поле для времени чтения (хранится в модели, см. Article.update_text_fields)
     reading_time = serializers.IntegerField(read_only=True)
+    meta_description = serializers.SerializerMethodField()
 
     class Meta:
         model = Article
@@ -438,4 +515,8 @@ class ArticleDetailSerializer(ImageUrlBuilderSerializer):
         )
 
     def get_cover_image_url(self, obj):
-        return self._get_absolute_url(obj.cover_image_detail_thumbnail)
+        return self._get_thumbnail_url(obj, 'cover_image_detail_thumbnail')
+
+    def get_meta_description(self, obj):
+        # Если описание не заполнено, берем начало текста статьи (уже без HTML)
+        return obj.meta_description or Truncator(obj.plain_text).chars(META_DESCRIPTION_LENGTH)
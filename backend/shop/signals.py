@@ -0,0 +1,232 @@
+# backend/shop/signals.py
+from django.db import connections, transaction
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_migrate, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .analytics import rebuild_sales_days
+from .caching import (
+    bump_blog_version, bump_catalog_version, bump_discount_rules_version, invalidate_product_cards_on_commit
+)
+from .models import (
+    Category, Product, Article, InfoPanel, ProductImage, ProductDocument, ProductInfoCard,
+    Feature, ProductCharacteristic, Characteristic, CharacteristicCategory, DiscountRule, Order, ArticleCategory
+)
+from .search import update_search_vector
+
+
+@receiver(pre_migrate)
+def create_postgres_extensions(sender, using='default', **kwargs):
+    """Включает расширение pg_trgm до создания триграммных индексов."""
+    if sender.name != 'shop':
+        return
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+
+@receiver(post_save, sender=Category)
+def update_category_tree_path(sender, instance, raw=False, **kwargs):
+    """
+    Поддерживает материализованный путь категории в актуальном состоянии.
+    При переносе категории в другую ветку одним UPDATE переписывает пути всех её потомков.
+    """
+    if raw:
+        return
+
+    parent_path = ''
+    if instance.parent_id:
+        parent_path = Category.objects.filter(pk=instance.parent_id).values_list('tree_path', flat=True).first() or ''
+
+    old_path = instance.tree_path
+    new_path = f"{parent_path}{instance.pk}/"
+    if old_path == new_path:
+        return
+
+    Category.objects.filter(pk=instance.pk).update(tree_path=new_path)
+    if old_path:
+        Category.objects.filter(tree_path__startswith=old_path).exclude(pk=instance.pk).update(
+            tree_path=Concat(Value(new_path), Substr('tree_path', len(old_path) + 1))
+        )
+    instance.tree_path = new_path
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def bump_catalog_version_on_category_change(sender, instance, **kwargs):
+    """Сбрасывает закэшированное дерево категорий (и его ETag)."""
+    # После коммита: иначе другой процесс успеет закэшировать старое дерево под новой версией
+    transaction.on_commit(bump_catalog_version)
+
+
+# --- Перекомпиляция правил скидок (см. discounts.py) ---
+
+@receiver(post_save, sender=DiscountRule)
+@receiver(post_delete, sender=DiscountRule)
+@receiver(post_save, sender=Category)
+def bump_discount_rules_on_change(sender, instance, **kwargs):
+    # Категории: в подсказках скидок показываются их названия
+    transaction.on_commit(bump_discount_rules_version)
+
+
+@receiver(post_save, sender=Product)
+def bump_discount_rules_on_target_product_change(sender, instance, raw=False, **kwargs):
+    # В подсказках скидок показывается название целевого товара
+    if not raw and DiscountRule.objects.filter(product_target_id=instance.pk).exists():
+        transaction.on_commit(bump_discount_rules_version)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Article)
+def update_search_index(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Пересчитывает tsvector товара/статьи, если изменились индексируемые поля."""
+    if raw:
+        return
+    indexed_fields = {field_name for field_name, _ in sender.search_vector_fields}
+    if update_fields is not None and not indexed_fields.intersection(update_fields):
+        return
+    update_search_vector(instance)
+
+
+# --- Инвалидация кэша карточек товаров (см. caching.py) ---
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_card_on_product_change(sender, instance, **kwargs):
+    invalidate_product_cards_on_commit([instance.pk])
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def invalidate_card_on_image_change(sender, instance, **kwargs):
+    invalidate_product_cards_on_commit([instance.product_id])
+
+
+@receiver(post_save, sender=InfoPanel)
+@receiver(pre_delete, sender=InfoPanel)
+def invalidate_cards_on_info_panel_change(sender, instance, **kwargs):
+    # pre_delete: после удаления связи с товарами уже не найти
+    invalidate_product_cards_on_commit(instance.product_set.values_list('id', flat=True))
+
+
+@receiver(m2m_changed, sender=Product.info_panels.through)
+def invalidate_cards_on_info_panels_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_product_cards_on_commit([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        invalidate_product_cards_on_commit(pk_set)
+    elif action == 'pre_clear':
+        invalidate_product_cards_on_commit(instance.product_set.values_list('id', flat=True))
+
+
+# --- Устаревание документов детальных страниц (см. documents.py) ---
+
+@receiver(pre_save, sender=Product)
+def remember_old_color_group(sender, instance, raw=False, **kwargs):
+    # Вариации старой группы цветов тоже должны узнать об уходе товара
+    instance._old_color_group_id = None
+    if not raw and instance.pk:
+        instance._old_color_group_id = Product.objects.filter(pk=instance.pk).values_list('color_group_id', flat=True).first()
+
+
+@receiver(post_save, sender=Product)
+def mark_document_stale_on_product_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    ProductDocument.mark_stale([instance.pk])
+    old_group_id = getattr(instance, '_old_color_group_id', None)
+    if old_group_id and old_group_id != instance.color_group_id:
+        ProductDocument.mark_stale(Product.objects.filter(color_group_id=old_group_id).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Product)
+def mark_color_variations_stale_on_thumbnail_change(sender, instance, update_fields=None, **kwargs):
+    # Миниатюра товара показывается в вариациях цвета на страницах других товаров группы
+    if update_fields is not None and 'thumbnails' in update_fields and instance.color_group_id:
+        ProductDocument.mark_stale(
+            Product.objects.filter(color_group_id=instance.color_group_id).values_list('id', flat=True)
+        )
+
+
+@receiver(pre_delete, sender=Product)
+def mark_documents_stale_on_product_delete(sender, instance, **kwargs):
+    # pre_delete: после удаления ссылки на товар из сопутствующих уже не найти
+    ProductDocument.mark_stale([instance.pk])
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=ProductInfoCard)
+@receiver(post_delete, sender=ProductInfoCard)
+@receiver(post_save, sender=Feature)
+@receiver(post_delete, sender=Feature)
+@receiver(post_save, sender=ProductCharacteristic)
+@receiver(post_delete, sender=ProductCharacteristic)
+def mark_document_stale_on_part_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        ProductDocument.mark_stale([instance.product_id])
+
+
+@receiver(post_save, sender=InfoPanel)
+@receiver(pre_delete, sender=InfoPanel)
+def mark_documents_stale_on_info_panel_change(sender, instance, **kwargs):
+    ProductDocument.mark_stale(instance.product_set.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Characteristic)
+def mark_documents_stale_on_characteristic_change(sender, instance, created, **kwargs):
+    if not created:
+        ProductDocument.mark_stale(
+            ProductCharacteristic.objects.filter(characteristic=instance).values_list('product_id', flat=True)
+        )
+
+
+@receiver(post_save, sender=CharacteristicCategory)
+def mark_documents_stale_on_characteristic_category_change(sender, instance, created, **kwargs):
+    if not created:
+        ProductDocument.mark_stale(
+            ProductCharacteristic.objects.filter(characteristic__category=instance).values_list('product_id', flat=True)
+        )
+
+
+@receiver(m2m_changed, sender=Product.info_panels.through)
+def mark_documents_stale_on_info_panels_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            ProductDocument.mark_stale([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        ProductDocument.mark_stale(pk_set)
+    elif action == 'pre_clear':
+        ProductDocument.mark_stale(instance.product_set.values_list('id', flat=True))
+
+
+@receiver(m2m_changed, sender=Product.related_products.through)
+def mark_documents_stale_on_related_products_change(sender, instance, action, reverse, pk_set, **kwargs):
+    # В обе стороны связи участвуют товары: помечаем и сам товар, и его "соседей"
+    if action in ('post_add', 'post_remove'):
+        ProductDocument.mark_stale({instance.pk, *pk_set})
+    elif action == 'pre_clear':
+        ProductDocument.mark_stale([instance.pk])
+
+
+# --- Кэш ленты блога (см. ArticleListView) ---
+
+@receiver(post_save, sender=Article)
+@receiver(post_delete, sender=Article)
+@receiver(post_save, sender=ArticleCategory)
+@receiver(post_delete, sender=ArticleCategory)
+def bump_blog_version_on_change(sender, instance, **kwargs):
+    transaction.on_commit(bump_blog_version)
+
+
+# --- Агрегаты продаж (см. analytics.py) ---
+
+@receiver(post_delete, sender=Order)
+def rebuild_sales_day_on_order_delete(sender, instance, **kwargs):
+    # Удаление не меняет updated_at, поэтому инкрементальный проход его не увидит
+    day = timezone.localdate(instance.created_at)
+    transaction.on_commit(lambda: rebuild_sales_days([day]))
@@ -1,12 +1,52 @@
 # backend/shop/tests.py
 
+import csv
+import hashlib
+import hmac
+import io
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlencode
 from decimal import Decimal
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
-from datetime import timedelta
+from datetime import datetime, timedelta
+from unittest import mock
+from PIL import Image
+from django.contrib.auth.models import User
+from django.core.management import call_command
 from rest_framework import status
 from rest_framework.test import APITestCase
-from .models import Category, Product, DiscountRule
+from .models import (
+    Category, Product, DiscountRule, InfoPanel, ColorGroup, Feature,
+    CharacteristicCategory, Characteristic, ProductCharacteristic, ProductDocument, Cart, CartItem, Order,
+    OrderItem, OutboxMessage, ShopSettings, Article, ArticleCategory, SalesDay, ProductSalesDay, CategorySalesDay, DiscountRuleSalesDay,
+    PromoBanner, ThumbnailJob
+)
+from . import scheduler
+from .analytics import rebuild_sales_days, update_sales_rollups
+from .authentication import verified_init_data
+from .caching import get_card_versions, order_idempotency_key, pricing_version
+from .counters import flush_article_views
+from .carts import cart_lock, change_cart, flush_dirty_carts, get_cart, persist_carts
+from .discounts import calculate_detailed_discounts, calculate_detailed_discounts_reference
+from .documents import rebuild_stale_product_documents
+from .exports import order_item_rows, order_rows
+from .outbox import MAX_ATTEMPTS, process_outbox
+from .quotes import redeem_quote
+from .thumbnails import InlineExecutor, process_thumbnail_jobs, rebuild_all_thumbnails, verify_thumbnails
+from .utils import validate_init_data
 
 class CalculateCartAPITestCase(APITestCase):
     """
@@ -164,4 +204,1521 @@ class CalculateCartAPITestCase(APITestCase):
         self.assertEqual(response.data['subtotal'], subtotal)
         self.assertEqual(response.data['discount_amount'], discount)
         self.assertEqual(response.data['final_total'], subtotal - discount)
-        self.assertEqual(response.data['applied_rule'], self.rule_category_qty.name)
\ No newline at end of file
+        self.assertEqual(response.data['applied_rule'], self.rule_category_qty.name)
+
+class CategoryTreePathTestCase(APITestCase):
+    """
+    Тесты для материализованного пути категорий (tree_path).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = Category.objects.create(name='Аудио')
+        cls.child = Category.objects.create(name='Наушники', parent=cls.root)
+        cls.leaf = Category.objects.create(name='Беспроводные', parent=cls.child)
+        cls.other = Category.objects.create(name='Чехлы')
+
+        cls.product_leaf = Product.objects.create(name='TWS', category=cls.leaf, regular_price=Decimal('100.00'))
+        cls.product_other = Product.objects.create(name='Чехол', category=cls.other, regular_price=Decimal('50.00'))
+
+    def test_tree_path_is_built_on_save(self):
+        """Тест: путь содержит ID всех предков и самой категории."""
+        self.leaf.refresh_from_db()
+        self.assertEqual(self.leaf.tree_path, f"{self.root.id}/{self.child.id}/{self.leaf.id}/")
+        self.assertEqual(self.leaf.ancestor_ids, [self.root.id, self.child.id, self.leaf.id])
+
+    def test_moving_category_rewrites_descendants(self):
+        """Тест: при переносе ветки пути потомков пересчитываются."""
+        self.child.parent = self.other
+        self.child.save()
+        self.leaf.refresh_from_db()
+        self.assertEqual(self.leaf.tree_path, f"{self.other.id}/{self.child.id}/{self.leaf.id}/")
+
+    def test_rebuild_tree_paths(self):
+        """Тест: полный пересчет восстанавливает пути, испорченные в обход сигналов."""
+        Category.objects.update(tree_path='')
+        Category.rebuild_tree_paths()
+        self.leaf.refresh_from_db()
+        self.assertEqual(self.leaf.tree_path, f"{self.root.id}/{self.child.id}/{self.leaf.id}/")
+
+    def test_product_list_filters_by_subtree(self):
+        """Тест: фильтр по родительской категории возвращает товары из всех подкатегорий."""
+        response = self.client.get(reverse('product-list'), {'category': self.root.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ids = [item['id'] for item in response.data['results']]
+        self.assertEqual(ids, [self.product_leaf.id])
+
+    def test_product_list_without_paths_does_not_write(self):
+        """Тест: до заполнения путей фильтр работает по родителям и не пересчитывает пути."""
+        Category.objects.update(tree_path='')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('product-list'), {'category': self.root.id})
+        self.assertEqual([item['id'] for item in response.data['results']], [self.product_leaf.id])
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE')])
+        self.assertFalse(Category.objects.exclude(tree_path='').exists())
+
+
+class KeysetPaginationTestCase(APITestCase):
+    """
+    Тесты курсорной пагинации ленты товаров.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Аксессуары')
+        # Одинаковые цены проверяют разрешение "ничьих" по id
+        prices = ['300.00', '100.00', '200.00', '100.00', '300.00']
+        cls.products = [
+            Product.objects.create(name=f'Товар {i}', category=category, regular_price=Decimal(price))
+            for i, price in enumerate(prices)
+        ]
+
+    def collect_all_pages(self, params):
+        response = self.client.get(reverse('product-list'), params)
+        self.assertNotIn('count', response.data)
+        ids = [item['id'] for item in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(item['id'] for item in response.data['results'])
+        return ids
+
+    def test_created_at_ordering_walks_all_pages(self):
+        """Тест: лента по дате создания отдается целиком, без повторов и пропусков."""
+        ids = self.collect_all_pages({'ordering': '-created_at', 'page_size': 2})
+        expected = list(Product.objects.order_by('-created_at', '-pk').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+    def test_price_ordering_with_equal_prices(self):
+        """Тест: сортировка по цене корректно листается при одинаковых ценах."""
+        ids = self.collect_all_pages({'ordering': 'price', 'page_size': 2})
+        expected = [p.id for p in sorted(self.products, key=lambda p: (p.regular_price, p.id))]
+        self.assertEqual(ids, expected)
+
+    def test_price_ordering_pages_across_empty_prices(self):
+        """Тест: товары без effective_price (до заполнения) идут в конце ленты в обоих направлениях."""
+        unpriced = [self.products[1].id, self.products[3].id]
+        Product.objects.filter(id__in=unpriced).update(effective_price=None)
+        priced = [p for p in self.products if p.id not in unpriced]
+
+        ids = self.collect_all_pages({'ordering': 'price', 'page_size': 2})
+        self.assertEqual(ids, [p.id for p in sorted(priced, key=lambda p: (p.regular_price, p.id))] + unpriced)
+
+        ids = self.collect_all_pages({'ordering': '-price', 'page_size': 2})
+        expected = [p.id for p in sorted(priced, key=lambda p: (p.regular_price, p.id), reverse=True)]
+        self.assertEqual(ids, expected + unpriced[::-1])
+
+    def test_invalid_cursor(self):
+        """Тест: битый курсор дает 404, а не 500."""
+        response = self.client.get(reverse('product-list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class EffectivePriceTestCase(APITestCase):
+    """
+    Тесты сохраненной актуальной цены (effective_price).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Наушники')
+
+    def test_deal_price_is_stored_on_save(self):
+        """Тест: при активной акции в effective_price сохраняется акционная цена."""
+        product = Product.objects.create(
+            name='Товар дня', category=self.category, regular_price=Decimal('2000.00'),
+            deal_price=Decimal('1500.00'), deal_ends_at=timezone.now() + timedelta(days=1)
+        )
+        product.refresh_from_db()
+        self.assertEqual(product.effective_price, Decimal('1500.00'))
+        self.assertEqual(product.current_price, Decimal('1500.00'))
+
+    def test_expired_deal_is_flipped_by_sync(self):
+        """Тест: после окончания акции синхронизация возвращает обычную цену."""
+        product = Product.objects.create(
+            name='Товар дня', category=self.category, regular_price=Decimal('2000.00'),
+            deal_price=Decimal('1500.00'), deal_ends_at=timezone.now() + timedelta(days=1)
+        )
+        Product.objects.filter(pk=product.pk).update(deal_ends_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(Product.sync_effective_prices(), 1)
+        product.refresh_from_db()
+        self.assertEqual(product.effective_price, Decimal('2000.00'))
+
+
+class ProductCardCacheTestCase(APITestCase):
+    """
+    Тесты кэша карточек товаров.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Колонки')
+        cls.panel = InfoPanel.objects.create(name='Хит')
+        cls.product = Product.objects.create(name='Колонка', category=category, regular_price=Decimal('990.00'))
+        cls.product.info_panels.add(cls.panel)
+
+    def setUp(self):
+        cache.clear()
+
+    def get_card(self):
+        response = self.client.get(reverse('product-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results'][0]
+
+    def test_cached_cards_skip_serialization_queries(self):
+        """Тест: повторная выдача ленты не подгружает инфо-панельки."""
+        self.get_card()
+        with self.assertNumQueries(1):
+            card = self.get_card()
+        self.assertEqual(card['info_panels'][0]['name'], 'Хит')
+
+    def test_info_panel_change_invalidates_card(self):
+        """Тест: изменение инфо-панельки сразу видно в карточке."""
+        self.get_card()
+        self.panel.name = 'Новинка'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.panel.save()
+        self.assertEqual(self.get_card()['info_panels'][0]['name'], 'Новинка')
+
+    def test_m2m_change_invalidates_card(self):
+        """Тест: отвязка инфо-панельки от товара сбрасывает карточку."""
+        self.get_card()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.info_panels.clear()
+        self.assertEqual(self.get_card()['info_panels'], [])
+
+    def test_card_version_changes_after_commit(self):
+        """Тест: версия карточки меняется только после коммита изменения товара."""
+        versions = get_card_versions([self.product.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+            # До коммита параллельный запрос видит старый товар - и старую версию
+            self.assertEqual(get_card_versions([self.product.pk]), versions)
+        self.assertNotEqual(get_card_versions([self.product.pk]), versions)
+
+
+class ProductDetailQueryBudgetTestCase(APITestCase):
+    """
+    Тест: детальная страница товара собирается за фиксированное число запросов.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Наушники')
+        cls.color_group = ColorGroup.objects.create(name='AirPods')
+        cls.product = Product.objects.create(
+            name='AirPods белые', category=category, regular_price=Decimal('100.00'), color_group=cls.color_group
+        )
+        cls.category = category
+        cls.char_categories = [CharacteristicCategory.objects.create(name=f'Группа {i}', order=i) for i in range(2)]
+        cls.add_details(cls.product, 0)
+
+    @classmethod
+    def add_details(cls, product, offset):
+        """Добавляет товару по несколько связанных объектов каждого вида."""
+        for i in range(offset, offset + 3):
+            characteristic = Characteristic.objects.create(
+                name=f'Характеристика {i}', category=cls.char_categories[i % 2]
+            )
+            ProductCharacteristic.objects.create(product=product, characteristic=characteristic, value=str(i))
+            Feature.objects.create(product=product, name=f'Особенность {i}', order=i)
+            product.info_panels.add(InfoPanel.objects.create(name=f'Панель {i}'))
+            product.related_products.add(
+                Product.objects.create(name=f'Сопутствующий {i}', category=cls.category, regular_price=Decimal('10.00'))
+            )
+            Product.objects.create(
+                name=f'AirPods цвет {i}', category=cls.category, regular_price=Decimal('100.00'), color_group=cls.color_group
+            )
+
+    def fetch_detail(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('product-detail', args=[self.product.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(queries)
+
+    def test_query_count_does_not_grow_with_related_data(self):
+        response, query_count = self.fetch_detail()
+        self.assertEqual(len(response.data['grouped_characteristics']), 2)
+        self.assertEqual(len(response.data['color_variations']), 3)
+        # поиск готового документа + товар + 7 prefetch-запросов
+        # + инфо-панельки карточек сопутствующих товаров
+        self.assertLessEqual(query_count, 10)
+
+        self.add_details(self.product, 3)
+        response, query_count_after = self.fetch_detail()
+        self.assertEqual(len(response.data['features']), 6)
+        self.assertEqual(len(response.data['color_variations']), 6)
+        self.assertEqual(query_count_after, query_count)
+
+
+class ProductDocumentTestCase(APITestCase):
+    """
+    Тесты read-model детальной страницы: документ совпадает с живой сериализацией,
+    устаревает при изменениях и не отдается, пока не пересобран.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Наушники')
+        cls.color_group = ColorGroup.objects.create(name='AirPods')
+        cls.product = Product.objects.create(
+            name='AirPods белые', category=cls.category, regular_price=Decimal('100.00'), color_group=cls.color_group
+        )
+        cls.variation = Product.objects.create(
+            name='AirPods черные', category=cls.category, regular_price=Decimal('100.00'), color_group=cls.color_group
+        )
+        cls.related = Product.objects.create(name='Чехол', category=cls.category, regular_price=Decimal('10.00'))
+        cls.product.related_products.add(cls.related)
+        characteristic = Characteristic.objects.create(
+            name='Вес', category=CharacteristicCategory.objects.create(name='Основные')
+        )
+        ProductCharacteristic.objects.create(product=cls.product, characteristic=characteristic, value='5 г')
+        Feature.objects.create(product=cls.product, name='Шумоподавление')
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('product-detail', args=[self.product.id])
+
+    def is_fresh(self, product):
+        document = ProductDocument.objects.get(pk=product.pk)
+        return document.version == document.built_version
+
+    def test_document_matches_live_response(self):
+        live = self.client.get(self.url).json()
+        self.assertEqual(rebuild_stale_product_documents(), 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), live)
+        # Документ + карточки сопутствующих товаров из кэша
+        self.assertLessEqual(len(queries), 2)
+
+    def test_changes_mark_document_stale(self):
+        rebuild_stale_product_documents()
+        self.assertTrue(self.is_fresh(self.product))
+
+        Feature.objects.create(product=self.product, name='Быстрая зарядка')
+        self.assertFalse(self.is_fresh(self.product))
+        # Пока документ устарел, страница отдается живой сериализацией
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.data['features']), 2)
+
+        rebuild_stale_product_documents()
+        self.assertTrue(self.is_fresh(self.product))
+
+        # Изменение сопутствующего товара и цветовой вариации затрагивает документ
+        self.related.name = 'Чехол кожаный'
+        self.related.save()
+        self.assertFalse(self.is_fresh(self.product))
+        rebuild_stale_product_documents()
+        self.variation.save()
+        self.assertFalse(self.is_fresh(self.product))
+
+    def test_inactive_product_document_is_removed(self):
+        rebuild_stale_product_documents()
+        self.product.is_active = False
+        self.product.save()
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+        rebuild_stale_product_documents()
+        self.assertFalse(ProductDocument.objects.filter(pk=self.product.pk).exists())
+
+
+class CategoryTreeTestCase(APITestCase):
+    """
+    Тесты дерева категорий: один запрос к БД, кэш по версии каталога и ETag.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.phones = Category.objects.create(name='Телефоны')
+        cls.iphones = Category.objects.create(name='iPhone', parent=cls.phones)
+        Category.objects.create(name='iPhone 15', parent=cls.iphones)
+        Category.objects.create(name='Чехлы')
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('category-list')
+
+    def test_tree_is_built_in_one_query_and_cached(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([node['name'] for node in response.data], ['Телефоны', 'Чехлы'])
+        self.assertEqual(response.data[0]['subcategories'][0]['subcategories'][0]['name'], 'iPhone 15')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        self.assertEqual(len(queries), 0)
+
+    def test_etag_and_invalidation(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.iphones.name = 'Apple iPhone'
+            self.iphones.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data[0]['subcategories'][0]['name'], 'Apple iPhone')
+
+
+class CompiledDiscountRulesTestCase(APITestCase):
+    """
+    Тесты скомпилированных правил скидок: результат совпадает с эталонной
+    реализацией, правила читаются из БД один раз и перекомпилируются после правок.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        phones = Category.objects.create(name='Телефоны')
+        iphones = Category.objects.create(name='iPhone', parent=phones)
+        cases = Category.objects.create(name='Чехлы')
+        cls.categories = [phones, iphones, cases]
+        cls.products = [
+            Product.objects.create(
+                name=f'Товар {i}', category=cls.categories[i % 3], regular_price=Decimal(100 + i * 37) / 3
+            )
+            for i in range(6)
+        ]
+        rules = [
+            ('Любые 5', DiscountRule.DiscountType.TOTAL_QUANTITY, 5, '7', {}),
+            ('Любые 8', DiscountRule.DiscountType.TOTAL_QUANTITY, 8, '12', {}),
+            ('Два товара 0', DiscountRule.DiscountType.PRODUCT_QUANTITY, 2, '10', {'product_target': cls.products[0]}),
+            ('Три товара 4', DiscountRule.DiscountType.PRODUCT_QUANTITY, 3, '10', {'product_target': cls.products[4]}),
+            ('Телефоны', DiscountRule.DiscountType.CATEGORY_QUANTITY, 3, '9', {'category_target': phones}),
+            ('iPhone', DiscountRule.DiscountType.CATEGORY_QUANTITY, 2, '9', {'category_target': iphones}),
+            ('Чехлы', DiscountRule.DiscountType.CATEGORY_QUANTITY, 4, '15', {'category_target': cases}),
+        ]
+        for name, discount_type, min_quantity, percentage, target in rules:
+            DiscountRule.objects.create(
+                name=name, discount_type=discount_type, min_quantity=min_quantity,
+                discount_percentage=Decimal(percentage), **target
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def make_cart(self, rng):
+        products = rng.sample(self.products, rng.randint(1, len(self.products)))
+        return [
+            CartItem(id=index, product=product, quantity=rng.randint(1, 4))
+            for index, product in enumerate(products, start=1)
+        ]
+
+    def test_matches_reference_implementation(self):
+        rng = random.Random(42)
+        for _ in range(200):
+            items = self.make_cart(rng)
+            self.assertEqual(calculate_detailed_discounts(items), calculate_detailed_discounts_reference(items))
+        self.assertEqual(calculate_detailed_discounts([]), calculate_detailed_discounts_reference([]))
+
+    def test_empty_results_are_independent(self):
+        calculate_detailed_discounts([])['items'].append('изменено вызывающим кодом')
+        self.assertEqual(calculate_detailed_discounts([])['items'], [])
+
+    def test_rules_are_loaded_once_and_recompiled_on_change(self):
+        items = [CartItem(id=1, product=self.products[2], quantity=1)]
+        calculate_detailed_discounts(items)
+        with CaptureQueriesContext(connection) as queries:
+            result = calculate_detailed_discounts(items)
+        self.assertEqual(len(queries), 0)
+        self.assertIsNone(result['applied_rule'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            DiscountRule.objects.create(
+                name='Любой товар', discount_type=DiscountRule.DiscountType.TOTAL_QUANTITY,
+                min_quantity=1, discount_percentage=Decimal('3')
+            )
+        self.assertEqual(calculate_detailed_discounts(items)['applied_rule'], 'Любой товар')
+
+
+@override_settings(DEBUG=True)  # TelegramAuthMixin пропускает запросы без initData в DEBUG
+class CalculateSelectionTestCase(APITestCase):
+    """
+    Тесты расчета выбранных товаров: один запрос за товарами и кэш повторных состояний.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        phones = Category.objects.create(name='Телефоны')
+        iphones = Category.objects.create(name='iPhone', parent=phones)
+        cls.products = [
+            Product.objects.create(name=f'iPhone {i}', category=iphones, regular_price=Decimal('100.00'))
+            for i in range(10)
+        ]
+        DiscountRule.objects.create(
+            name='Телефоны', discount_type=DiscountRule.DiscountType.CATEGORY_QUANTITY,
+            min_quantity=3, discount_percentage=Decimal('10'), category_target=phones
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('calculate-selection')
+
+    def calculate(self, products, quantity=1):
+        selection = [{'product_id': product.id, 'quantity': quantity} for product in products]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, {'selection': selection}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, len(queries)
+
+    def test_products_are_loaded_in_one_query(self):
+        self.calculate(self.products[-1:])  # правила скидок компилируются при первом расчете
+        _, few_queries = self.calculate(self.products[:2])
+        response, many_queries = self.calculate(self.products)
+        self.assertEqual(many_queries, few_queries)
+        self.assertEqual(len(response.data['items']), 10)
+        self.assertEqual(response.data['applied_rule'], 'Телефоны')
+        self.assertEqual(response.data['final_total'], Decimal('900.00'))
+
+    def test_repeated_state_is_served_from_cache(self):
+        first, _ = self.calculate(self.products[:3])
+        second, queries = self.calculate(self.products[:3])
+        self.assertEqual(queries, 0)
+        self.assertEqual(second.data, first.data)
+
+        # Изменение цены меняет версию карточки, а значит и ключ кэша
+        self.products[0].regular_price = Decimal('200.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].save()
+        response, _ = self.calculate(self.products[:3])
+        self.assertEqual(response.data['subtotal'], Decimal('400.00'))
+
+    def test_invalid_selection(self):
+        response = self.client.post(self.url, {'selection': [{'product_id': 'x'}]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(DEBUG=True)  # TelegramAuthMixin пропускает запросы без initData в DEBUG
+class CartBatchUpdateTestCase(APITestCase):
+    """
+    Тесты PATCH /api/cart/: пакетное изменение корзины в одной транзакции.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Аксессуары')
+        cls.products = [
+            Product.objects.create(name=f'Кабель {i}', category=category, regular_price=Decimal('10.00'))
+            for i in range(5)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('cart-detail')
+
+    def patch(self, changes):
+        return self.client.patch(self.url, {'items': changes}, format='json')
+
+    def test_upsert_and_delete_in_one_request(self):
+        self.patch([{'product_id': product.id, 'quantity': 1} for product in self.products[:3]])
+
+        response = self.patch([
+            {'product_id': self.products[0].id, 'quantity': 4},   # изменить
+            {'product_id': self.products[1].id, 'quantity': 0},   # удалить
+            {'product_id': self.products[3].id, 'quantity': 2},   # добавить
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        quantities = {item['product']['id']: item['quantity'] for item in response.data['items']}
+        self.assertEqual(quantities, {self.products[0].id: 4, self.products[2].id: 1, self.products[3].id: 2})
+        self.assertEqual(response.data['subtotal'], Decimal('70.00'))
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        self.patch([{'product_id': self.products[0].id, 'quantity': 1}])  # корзина и карточки уже есть
+        with CaptureQueriesContext(connection) as small:
+            self.patch([{'product_id': self.products[0].id, 'quantity': 2}])
+        with CaptureQueriesContext(connection) as large:
+            self.patch([{'product_id': product.id, 'quantity': 3} for product in self.products])
+        # Разница - только загрузка карточек новых товаров (промах кэша)
+        self.assertLessEqual(len(large), len(small) + 1)
+
+    def test_clear_cart_and_unknown_product(self):
+        self.patch([{'product_id': product.id, 'quantity': 1} for product in self.products])
+        response = self.patch([{'product_id': product.id, 'quantity': 0} for product in self.products])
+        self.assertEqual(response.data['items'], [])
+
+        response = self.patch([{'product_id': 0, 'quantity': 1}])
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.patch(self.url, {'items': 'all'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(DEBUG=True)  # TelegramAuthMixin пропускает запросы без initData в DEBUG
+class CartDeltaTestCase(APITestCase):
+    """
+    Тесты дельта-ответов корзины по cart_version.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Аксессуары')
+        cls.products = [
+            Product.objects.create(name=f'Кабель {i}', category=category, regular_price=Decimal('10.00'))
+            for i in range(4)
+        ]
+        DiscountRule.objects.create(
+            name='Любые 4', discount_type=DiscountRule.DiscountType.TOTAL_QUANTITY,
+            min_quantity=4, discount_percentage=Decimal('10')
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('cart-detail')
+        full = self.client.patch(self.url, {'items': [
+            {'product_id': product.id, 'quantity': 1} for product in self.products[:3]
+        ]}, format='json').data
+        self.assertFalse(full['delta'])
+        self.version = full['cart_version']
+
+    def test_mutation_returns_only_changed_lines(self):
+        response = self.client.post(self.url, {
+            'product_id': self.products[0].id, 'quantity': 2, 'cart_version': self.version
+        }, format='json')
+        data = response.data
+        self.assertTrue(data['delta'])
+        self.assertEqual(data['cart_version'], self.version + 1)
+        self.assertNotIn('items', data)
+        # Скидка "Любые 4" включилась: цены изменились у всех строк
+        self.assertEqual(data['applied_rule'], 'Любые 4')
+        self.assertEqual(len(data['changed']), 3)
+
+        response = self.client.delete(self.url, {
+            'product_ids': [self.products[1].id], 'cart_version': data['cart_version']
+        }, format='json')
+        data = response.data
+        self.assertTrue(data['delta'])
+        self.assertEqual(data['removed'], [self.products[1].id])
+        # Скидка отключилась: у оставшихся строк пропала скидочная цена
+        self.assertIsNone(data['applied_rule'])
+        self.assertEqual([line['discounted_price'] for line in data['changed']], [None, None])
+        self.assertEqual(data['subtotal'], Decimal('30.00'))
+
+    def test_stale_version_gets_full_snapshot(self):
+        self.client.post(self.url, {'product_id': self.products[3].id, 'quantity': 1}, format='json')
+        response = self.client.post(self.url, {
+            'product_id': self.products[0].id, 'quantity': 3, 'cart_version': self.version
+        }, format='json')
+        self.assertFalse(response.data['delta'])
+        self.assertEqual(len(response.data['items']), 4)
+
+        response = self.client.get(self.url, {'cart_version': response.data['cart_version']})
+        self.assertTrue(response.data['delta'])
+        self.assertEqual(response.data['changed'], [])
+
+
+@override_settings(DEBUG=True, CART_WRITE_BEHIND=True)
+class CartStoreTestCase(APITestCase):
+    """
+    Тесты хранилища корзин: изменения живут в кэше и пачками сбрасываются в БД.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Аксессуары')
+        cls.products = [
+            Product.objects.create(name=f'Кабель {i}', category=category, regular_price=Decimal('10.00'))
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+    def db_items(self, telegram_id):
+        return dict(CartItem.objects.filter(cart__telegram_id=telegram_id).values_list('product_id', 'quantity'))
+
+    def test_changes_are_flushed_in_batches(self):
+        first, second = self.products[:2]
+        change_cart(1, {first.id: 2, second.id: 1})
+        change_cart(2, {first.id: 5})
+        with CaptureQueriesContext(connection) as queries:
+            change_cart(1, {second.id: 0})
+        self.assertEqual(len(queries), 0)  # корзина уже в кэше, БД не трогаем
+        self.assertFalse(Cart.objects.exists())
+
+        self.assertEqual(flush_dirty_carts(), 2)
+        self.assertEqual(self.db_items(1), {first.id: 2})
+        self.assertEqual(self.db_items(2), {first.id: 5})
+        self.assertEqual(flush_dirty_carts(), 0)
+
+        # После вытеснения из кэша корзина поднимается из БД с той же версией
+        version = get_cart(1)['version']
+        cache.clear()
+        self.assertEqual(get_cart(1), {'version': version, 'items': {first.id: 2}})
+
+    @mock.patch('shop.carts.FLUSH_BATCH_SIZE', 2)
+    def test_large_log_is_flushed_in_batches(self):
+        for telegram_id in range(1, 6):
+            change_cart(telegram_id, {self.products[0].id: telegram_id})
+
+        with mock.patch('shop.carts.persist_carts', wraps=persist_carts) as persist:
+            self.assertEqual(flush_dirty_carts(), 5)
+        self.assertEqual([len(call.args[0]) for call in persist.call_args_list], [2, 2, 1])
+        self.assertEqual(self.db_items(5), {self.products[0].id: 5})
+        self.assertEqual(flush_dirty_carts(), 0)
+
+    def test_order_is_created_from_store(self):
+        telegram_id = 123456789  # пользователь, которого подставляет TelegramAuthMixin в DEBUG
+        change_cart(telegram_id, {self.products[0].id: 2, self.products[1].id: 1})
+
+        response = self.client.post(reverse('order-create'), {
+            'first_name': 'Иван', 'last_name': 'Иванов', 'phone': '+79990000000',
+            'delivery_method': 'СДЭК', 'cdek_office_address': 'Омск',
+            'items': [{'product_id': self.products[0].id, 'quantity': 2}],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Order.objects.get().subtotal, Decimal('20.00'))
+
+        # Заказанный товар ушел из корзины, остальное осталось
+        self.assertEqual(get_cart(telegram_id)['items'], {self.products[1].id: 1})
+        flush_dirty_carts()
+        self.assertEqual(self.db_items(telegram_id), {self.products[1].id: 1})
+
+    def test_order_item_quantities_come_from_pricing(self):
+        """Тест: количество из тела запроса не расходится с суммой заказа."""
+        telegram_id = 123456789
+        change_cart(telegram_id, {self.products[0].id: 2})
+
+        response = self.client.post(reverse('order-create'), {
+            'first_name': 'Иван', 'last_name': 'Иванов', 'phone': '+79990000000',
+            'delivery_method': 'СДЭК', 'cdek_office_address': 'Омск',
+            'items': [{'product_id': self.products[0].id, 'quantity': 5}],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        order = Order.objects.get()
+        self.assertEqual(order.subtotal, Decimal('20.00'))
+        self.assertEqual(list(order.items.values_list('product_id', 'quantity')), [(self.products[0].id, 2)])
+
+    @mock.patch('shop.carts.CART_LOCK_TIMEOUT', 0.05)
+    def test_busy_cart_is_not_changed_without_lock(self):
+        telegram_id = 123456789  # пользователь, которого подставляет TelegramAuthMixin в DEBUG
+        cache.add(f'cart-lock:{telegram_id}', 'другой запрос', 60)
+
+        response = self.client.post(reverse('cart-detail'), {'product_id': self.products[0].id, 'quantity': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(get_cart(telegram_id)['items'], {})
+
+    def test_lock_taken_over_after_expiry_is_not_released(self):
+        key = 'cart-lock:1'
+        with cart_lock(1):
+            # Наша блокировка истекла, и ее получил другой процесс
+            cache.set(key, 'другой запрос', 60)
+        self.assertEqual(cache.get(key), 'другой запрос')
+
+        cache.delete(key)
+        with cart_lock(1):
+            pass
+        self.assertIsNone(cache.get(key))
+
+    @override_settings(CART_WRITE_BEHIND=False)
+    def test_cart_bypasses_cache_without_write_behind(self):
+        first, second = self.products[:2]
+        change_cart(1, {first.id: 2})
+        self.assertEqual(self.db_items(1), {first.id: 2})
+
+        # Изменение из другого процесса (его локальный кэш нам не виден) сразу видно
+        CartItem.objects.filter(cart__telegram_id=1).update(quantity=3)
+        self.assertEqual(get_cart(1)['items'], {first.id: 3})
+
+        state, _ = change_cart(1, {second.id: 1})
+        self.assertEqual(state['items'], {first.id: 3, second.id: 1})
+        self.assertEqual(self.db_items(1), {first.id: 3, second.id: 1})
+
+
+@override_settings(DEBUG=True, CART_WRITE_BEHIND=True)
+class SignedQuoteTestCase(APITestCase):
+    """
+    Тесты подписанных квот: заказ по актуальной квоте оформляется без пересчета.
+    """
+    telegram_id = 123456789  # пользователь, которого подставляет TelegramAuthMixin в DEBUG
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Аксессуары')
+        cls.products = [
+            Product.objects.create(name=f'Кабель {i}', category=category, regular_price=Decimal('10.00'))
+            for i in range(2)
+        ]
+        DiscountRule.objects.create(
+            name='Любые 3', discount_type=DiscountRule.DiscountType.TOTAL_QUANTITY,
+            min_quantity=3, discount_percentage=Decimal('10')
+        )
+
+    def setUp(self):
+        cache.clear()
+        change_cart(self.telegram_id, {self.products[0].id: 2, self.products[1].id: 1})
+        self.selection = [{'product_id': product.id, 'quantity': quantity} for product, quantity in zip(self.products, (2, 1))]
+
+    def get_quote(self):
+        response = self.client.post(reverse('calculate-selection'), {'selection': self.selection}, format='json')
+        return response.data['quote']
+
+    def create_order(self, quote):
+        return self.client.post(reverse('order-create'), {
+            'first_name': 'Иван', 'last_name': 'Иванов', 'phone': '+79990000000',
+            'delivery_method': 'СДЭК', 'cdek_office_address': 'Омск',
+            'items': self.selection, 'quote': quote,
+        }, format='json')
+
+    def test_valid_quote_skips_recalculation(self):
+        quote = self.get_quote()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.create_order(quote)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse([query for query in queries if 'FROM "shop_product"' in query['sql']])
+
+        order = Order.objects.get()
+        self.assertEqual((order.subtotal, order.final_total, order.applied_rule), (Decimal('30.00'), Decimal('27.00'), 'Любые 3'))
+        self.assertEqual(
+            sorted(order.items.values_list('product_id', 'price_at_purchase')),
+            [(self.products[0].id, Decimal('9.00')), (self.products[1].id, Decimal('9.00'))]
+        )
+
+    def test_price_change_during_calculation_is_not_quoted(self):
+        """Тест: цена, измененная между снятием версии и чтением товаров, не проходит по квоте."""
+        def pricing_version_then_price_change(product_ids):
+            version = pricing_version(product_ids)
+            self.products[0].regular_price = Decimal('20.00')
+            with self.captureOnCommitCallbacks(execute=True):
+                self.products[0].save()
+            return version
+
+        with mock.patch('shop.views.pricing_version', pricing_version_then_price_change):
+            quote = self.get_quote()
+        self.create_order(quote)
+        self.assertEqual(Order.objects.get().subtotal, Decimal('50.00'))
+
+    def test_stale_or_forged_quote_is_recalculated(self):
+        quote = self.get_quote()
+        self.products[0].regular_price = Decimal('20.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[0].save()
+        self.create_order(quote)
+        self.assertEqual(Order.objects.get().subtotal, Decimal('50.00'))
+
+        change_cart(self.telegram_id, {self.products[0].id: 2, self.products[1].id: 1})
+        quote = self.get_quote()
+        items = [(product.id, quantity) for product, quantity in zip(self.products, (2, 1))]
+        self.assertIsNotNone(redeem_quote(quote, self.telegram_id, items))
+        self.assertIsNone(redeem_quote(quote[:-2] + 'xx', self.telegram_id, items))
+        self.assertIsNone(redeem_quote(quote, 1, items))                    # чужая квота
+        self.assertIsNone(redeem_quote(quote, self.telegram_id, items[:1]))  # другой состав
+
+
+@override_settings(DEBUG=True, CART_WRITE_BEHIND=True)
+class IdempotentOrderTestCase(APITestCase):
+    """
+    Тесты оформления заказа с Idempotency-Key: повтор не создает дубль.
+    """
+    telegram_id = 123456789  # пользователь, которого подставляет TelegramAuthMixin в DEBUG
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Аксессуары')
+        cls.products = [
+            Product.objects.create(name=f'Кабель {i}', category=category, regular_price=Decimal('10.00'))
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        change_cart(self.telegram_id, {product.id: 1 for product in self.products})
+
+    def create_order(self, key):
+        return self.client.post(reverse('order-create'), {
+            'first_name': 'Иван', 'last_name': 'Иванов', 'phone': '+79990000000',
+            'delivery_method': 'СДЭК', 'cdek_office_address': 'Омск',
+            'items': [{'product_id': product.id, 'quantity': 1} for product in self.products],
+        }, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_returns_original_order(self):
+        first = self.create_order('attempt-1')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Order.objects.get().items.count(), 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            retry = self.create_order('attempt-1')
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data['order_id'], first.data['order_id'])
+        self.assertEqual(len(queries), 0)
+
+        # Ключ в кэше потерян - заказ находится по ключу в БД
+        cache.delete(order_idempotency_key(self.telegram_id, 'attempt-1'))
+        with CaptureQueriesContext(connection) as queries:
+            retry = self.create_order('attempt-1')
+        self.assertTrue(any('shop_order' in query['sql'] for query in queries))
+        self.assertEqual(retry.data['order_id'], first.data['order_id'])
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_items_are_created_in_bulk(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.create_order('attempt-2')
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "shop_orderitem"')]
+        self.assertEqual(len(inserts), 1)
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    """Поддельный Telegram Bot API: запоминает запросы и отвечает кодом server.status_code."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, json.loads(body)))
+        self.send_response(self.server.status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'ok': self.server.status_code == 200}).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(DEBUG=True, CART_WRITE_BEHIND=True, TELEGRAM_BOT_TOKEN='test-token')
+class OutboxTestCase(APITestCase):
+    """
+    Тесты очереди уведомлений: сообщение пишется вместе с заказом,
+    воркер отправляет его в Telegram и повторяет с задержкой при ошибке.
+    """
+    telegram_id = 123456789
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Аксессуары')
+        cls.product = Product.objects.create(name='Кабель', category=category, regular_price=Decimal('10.00'))
+        shop_settings = ShopSettings.load()
+        shop_settings.manager_chat_id = '42'
+        shop_settings.save()
+
+    def setUp(self):
+        cache.clear()
+        self.server = HTTPServer(('127.0.0.1', 0), FakeTelegramHandler)
+        self.server.requests = []
+        self.server.status_code = 200
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        api_url = override_settings(TELEGRAM_API_URL=f'http://127.0.0.1:{self.server.server_port}')
+        api_url.enable()
+        self.addCleanup(api_url.disable)
+
+        change_cart(self.telegram_id, {self.product.id: 2})
+        response = self.client.post(reverse('order-create'), {
+            'first_name': 'Иван', 'last_name': 'Иванов', 'phone': '+79990000000',
+            'delivery_method': 'СДЭК', 'cdek_office_address': 'Омск',
+            'items': [{'product_id': self.product.id, 'quantity': 2}],
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.order_id = response.data['order_id']
+
+    def test_order_notification_is_sent(self):
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.payload, {'order_id': self.order_id})
+        self.assertEqual(self.server.requests, [])  # оформление заказа не ходит в Telegram
+
+        self.assertEqual(process_outbox(), (1, 0))
+        path, body = self.server.requests[0]
+        self.assertEqual(path, '/bottest-token/sendMessage')
+        self.assertEqual(body['chat_id'], '42')
+        self.assertIn(f'Новый заказ #{self.order_id}', body['text'])
+        self.assertIn('Кабель (x2)', body['text'])
+
+        # Отправленное сообщение больше не берется
+        self.assertEqual(process_outbox(), (0, 0))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_failed_send_is_retried_with_backoff(self):
+        self.server.status_code = 500
+        self.assertEqual(process_outbox(), (0, 1))
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.attempts, 1)
+        self.assertIsNone(message.sent_at)
+        self.assertIn('500', message.last_error)
+        self.assertGreater(message.available_at, timezone.now())
+
+        # До истечения задержки сообщение не отправляется повторно
+        self.assertEqual(process_outbox(), (0, 0))
+        self.assertEqual(len(self.server.requests), 1)
+
+        self.server.status_code = 200
+        OutboxMessage.objects.update(available_at=timezone.now())
+        self.assertEqual(process_outbox(), (1, 0))
+        self.assertIsNotNone(OutboxMessage.objects.get().sent_at)
+
+    def test_message_is_sent_outside_transaction(self):
+        """Тест: отправка идет после коммита аренды, а не под блокировкой строк."""
+        test_case = self
+        outer_blocks = len(connection.atomic_blocks)
+
+        class CheckingSender:
+            def send(self, text):
+                test_case.assertEqual(len(connection.atomic_blocks), outer_blocks)
+                message = OutboxMessage.objects.get()
+                test_case.assertEqual(message.attempts, 1)
+                # Пока сообщение отправляется, другие воркеры его не берут
+                test_case.assertGreater(message.available_at, timezone.now())
+
+        self.assertEqual(process_outbox(sender=CheckingSender()), (1, 0))
+        self.assertIsNotNone(OutboxMessage.objects.get().sent_at)
+
+    def test_gives_up_after_max_attempts(self):
+        OutboxMessage.objects.update(attempts=MAX_ATTEMPTS)
+        self.assertEqual(process_outbox(), (0, 0))
+        self.assertEqual(self.server.requests, [])
+
+
+class OrderExportTestCase(APITestCase):
+    """
+    Тесты потоковой выгрузки заказов в CSV.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Аксессуары')
+        products = [
+            Product.objects.create(name=f'Кабель {i}', category=category, regular_price=Decimal('10.00'))
+            for i in range(3)
+        ]
+        for i in range(5):
+            order = Order.objects.create(
+                telegram_id=i, last_name='Иванов', first_name='Иван', phone='+79990000000',
+                delivery_method='СДЭК', subtotal=Decimal('30.00'), final_total=Decimal('30.00')
+            )
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, quantity=i + 1, price_at_purchase=product.regular_price)
+                for product in products
+            ])
+
+    def read_csv(self, rows):
+        with CaptureQueriesContext(connection) as queries:
+            data = list(csv.reader(''.join(rows).splitlines()))
+        return data, len(queries)
+
+    def test_orders_export(self):
+        data, query_count = self.read_csv(order_rows(Order.objects.all()))
+        self.assertEqual(query_count, 1)
+        self.assertEqual(data[0][:2], ['id', 'status'])
+        self.assertEqual(len(data), 1 + 5)
+
+    def test_orders_with_items_export_has_no_n_plus_one(self):
+        data, query_count = self.read_csv(order_item_rows(Order.objects.filter(telegram_id__lt=4)))
+        # Одна строка на позицию, название товара без отдельных запросов
+        self.assertEqual(query_count, 1)
+        self.assertEqual(len(data), 1 + 4 * 3)
+        header = data[0]
+        first = dict(zip(header, data[1]))
+        self.assertEqual(first['product_name'], 'Кабель 0')
+        self.assertEqual(first['quantity'], '1')
+        self.assertEqual(first['price_at_purchase'], '10.00')
+
+
+@mock.patch('shop.analytics.ROLLUP_LAG', timedelta(0))
+class SalesRollupTestCase(APITestCase):
+    """
+    Тесты дневных агрегатов продаж и дашборда в админке.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Аксессуары')
+        cls.cable = Product.objects.create(name='Кабель', category=cls.category, regular_price=Decimal('10.00'))
+        cls.charger = Product.objects.create(name='Зарядка', category=cls.category, regular_price=Decimal('30.00'))
+
+    def create_order(self, items, status=Order.OrderStatus.NEW, applied_rule=None, discount=Decimal('0')):
+        subtotal = sum(product.regular_price * quantity for product, quantity in items)
+        order = Order.objects.create(
+            telegram_id=1, last_name='Иванов', first_name='Иван', phone='+79990000000', delivery_method='СДЭК',
+            status=status, subtotal=subtotal, discount_amount=discount, final_total=subtotal - discount,
+            applied_rule=applied_rule,
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=quantity, price_at_purchase=product.regular_price)
+            for product, quantity in items
+        ])
+        return order
+
+    def test_rollups_are_updated_incrementally(self):
+        first = self.create_order([(self.cable, 2), (self.charger, 1)], applied_rule='Скидка 10%', discount=Decimal('5.00'))
+        self.create_order([(self.cable, 1)])
+        self.create_order([(self.charger, 3)], status=Order.OrderStatus.CANCELED)
+
+        self.assertEqual(update_sales_rollups(), 1)
+        today = timezone.localdate()
+        statuses = {row.status: row for row in SalesDay.objects.filter(day=today)}
+        self.assertEqual(statuses['new'].orders_count, 2)
+        self.assertEqual(statuses['new'].final_total, Decimal('55.00'))
+        self.assertEqual(statuses['canceled'].orders_count, 1)
+        # Отмененные заказы не попадают в продажи товаров, категорий и скидок
+        products = dict(ProductSalesDay.objects.values_list('product_id', 'quantity'))
+        self.assertEqual(products, {self.cable.id: 3, self.charger.id: 1})
+        self.assertEqual(CategorySalesDay.objects.get().revenue, Decimal('60.00'))
+        self.assertEqual(DiscountRuleSalesDay.objects.get().discount_amount, Decimal('5.00'))
+
+        # Без изменений проход ничего не пересчитывает
+        self.assertEqual(update_sales_rollups(), 0)
+
+        first.status = Order.OrderStatus.CANCELED
+        first.save()
+        self.assertEqual(update_sales_rollups(), 1)
+        self.assertEqual(SalesDay.objects.get(day=today, status='canceled').orders_count, 2)
+        self.assertEqual(dict(ProductSalesDay.objects.values_list('product_id', 'quantity')), {self.cable.id: 1})
+        self.assertFalse(DiscountRuleSalesDay.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(SalesDay.objects.get(day=today, status='canceled').orders_count, 1)
+
+    def test_days_are_split_at_local_midnight(self):
+        """Тест: заказы относятся к дню по местному времени, выборка идет по диапазонам created_at."""
+        day = timezone.localdate() - timedelta(days=3)
+        midnight = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+        for created_at in (midnight - timedelta(seconds=1), midnight, midnight + timedelta(hours=23, minutes=59)):
+            order = self.create_order([(self.cable, 1)])
+            Order.objects.filter(pk=order.pk).update(created_at=created_at)
+
+        with CaptureQueriesContext(connection) as queries:
+            rebuild_sales_days([day, day - timedelta(days=1)])
+        self.assertEqual(SalesDay.objects.get(day=day).orders_count, 2)
+        self.assertEqual(SalesDay.objects.get(day=day - timedelta(days=1)).orders_count, 1)
+        self.assertEqual(ProductSalesDay.objects.get(day=day).quantity, 2)
+        where_clauses = [query['sql'].split(' WHERE ', 1)[1] for query in queries if 'FROM "shop_order' in query['sql']]
+        self.assertTrue(where_clauses)
+        self.assertFalse([clause for clause in where_clauses if 'django_datetime_cast_date' in clause])
+
+    def test_dashboard_reads_only_rollups(self):
+        self.create_order([(self.cable, 2)])
+        update_sales_rollups()
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:shop_order_dashboard'), {'days': 7})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'Кабель')
+        self.assertFalse([query for query in queries if 'FROM "shop_order"' in query['sql'] or 'FROM "shop_orderitem"' in query['sql']])
+
+
+class AdminChangelistTestCase(APITestCase):
+    """
+    Тесты списков в админке: число запросов не зависит от числа строк и глубины категорий.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.root = Category.objects.create(name='Электроника')
+        cls.child = Category.objects.create(name='Телефоны', parent=cls.root)
+        cls.leaf = Category.objects.create(name='Чехлы', parent=cls.child)
+
+    def setUp(self):
+        self.client.force_login(self.admin_user)
+
+    def add_products(self, count, category):
+        for i in range(count):
+            Product.objects.create(name=f'Товар {i}', category=category, regular_price=Decimal('10.00'))
+
+    def get_changelist(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return queries.captured_queries, response
+
+    def test_product_changelist_query_count_is_constant(self):
+        url = reverse('admin:shop_product_changelist')
+        self.add_products(3, self.root)
+        baseline, _ = self.get_changelist(url)
+
+        deeper = Category.objects.create(name='Силикон', parent=self.leaf)
+        self.add_products(20, deeper)
+        self.add_products(20, self.leaf)
+        queries, response = self.get_changelist(url)
+        self.assertEqual(len(queries), len(baseline))
+        self.assertContains(response, 'Электроника -&gt; Телефоны -&gt; Чехлы -&gt; Силикон')
+
+    def test_order_changelist_has_no_distinct_scan(self):
+        queries, response = self.get_changelist(reverse('admin:shop_order_changelist'))
+        self.assertContains(response, 'СДЭК')
+        self.assertFalse([query for query in queries if 'DISTINCT' in query['sql']])
+
+    def test_category_str_uses_one_query(self):
+        leaf = Category.objects.get(pk=self.leaf.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(str(leaf), 'Электроника -> Телефоны -> Чехлы')
+        self.assertEqual(Category.full_paths()[self.leaf.pk], 'Электроника -> Телефоны -> Чехлы')
+
+
+@override_settings(DEBUG=False, TELEGRAM_BOT_TOKEN='123:test-token')
+class TelegramAuthenticationTestCase(APITestCase):
+    """
+    Тесты аутентификации по initData Telegram Web App.
+    """
+
+    def setUp(self):
+        cache.clear()
+        verified_init_data.clear()
+
+    def init_data(self, auth_date=None, user_id=42):
+        fields = {
+            'auth_date': str(int(time.time()) if auth_date is None else auth_date),
+            'query_id': 'AAF',
+            'user': json.dumps({'id': user_id, 'first_name': 'Иван'}),
+        }
+        data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+        secret_key = hmac.new(b"WebAppData", b'123:test-token', hashlib.sha256).digest()
+        fields['hash'] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+        return urlencode(fields)
+
+    def get_cart(self, init_data=None):
+        headers = {'HTTP_AUTHORIZATION': f'tma {init_data}'} if init_data is not None else {}
+        return self.client.get(reverse('cart-detail'), **headers)
+
+    def test_valid_init_data_is_verified_once(self):
+        init_data = self.init_data()
+        with mock.patch('shop.authentication.validate_init_data', wraps=validate_init_data) as validate:
+            for _ in range(3):
+                response = self.get_cart(init_data)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # HMAC считается только для первого запроса сессии
+        self.assertEqual(validate.call_count, 1)
+        self.assertEqual(get_cart(42)['version'], 0)
+
+    def test_rejects_missing_forged_and_stale_init_data(self):
+        self.assertEqual(self.get_cart().status_code, status.HTTP_401_UNAUTHORIZED)
+
+        forged = self.init_data().replace('42', '43')
+        self.assertEqual(self.get_cart(forged).status_code, status.HTTP_401_UNAUTHORIZED)
+
+        stale = self.init_data(auth_date=int(time.time()) - 2 * 24 * 60 * 60)
+        self.assertEqual(self.get_cart(stale).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cached_init_data_expires_by_auth_date(self):
+        auth_date = int(time.time())
+        init_data = self.init_data(auth_date=auth_date)
+        self.assertEqual(self.get_cart(init_data).status_code, status.HTTP_200_OK)
+
+        with mock.patch('shop.authentication.time.time', return_value=auth_date + 24 * 60 * 60 + 1):
+            self.assertEqual(self.get_cart(init_data).status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class FakeRedisSets:
+    """Поддельный клиент Redis с командами множеств, которые использует counters.py."""
+
+    def __init__(self):
+        self.sets = {}
+        self.commands = []
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(str(member).encode() for member in members)
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def smembers(self, key):
+        self.commands.append(lambda: set(self.sets.get(key, ())))
+        return self
+
+    def delete(self, key):
+        self.commands.append(lambda: int(self.sets.pop(key, None) is not None))
+        return self
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command() for command in commands]
+
+
+@override_settings(ARTICLE_VIEWS_BUFFERED=True, ARTICLE_VIEWS_DEDUP=True)
+class ArticleViewCounterTestCase(APITestCase):
+    """
+    Тесты буферизованного счетчика просмотров статей.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.popular = Article.objects.create(title='Популярная', slug='popular', status=Article.Status.PUBLISHED)
+        cls.other = Article.objects.create(title='Другая', slug='other', status=Article.Status.PUBLISHED)
+        cls.draft = Article.objects.create(title='Черновик', slug='draft')
+
+    def setUp(self):
+        cache.clear()
+        redis = mock.patch('shop.counters.redis_client', return_value=FakeRedisSets())
+        redis.start()
+        self.addCleanup(redis.stop)
+
+    def view(self, slug):
+        return self.client.post(reverse('article-increment-view', kwargs={'slug': slug}))
+
+    @override_settings(DEBUG=False)
+    def test_views_are_buffered_and_flushed_in_one_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(5):
+                self.assertEqual(self.view('popular').status_code, status.HTTP_200_OK)
+            self.view('other')
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE')])
+        self.assertEqual(self.view('draft').status_code, status.HTTP_404_NOT_FOUND)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(flush_article_views(), 2)
+        # Только UPDATE: статьи с просмотрами известны из буфера, таблица статей не перебирается
+        self.assertEqual([query['sql'].split()[0] for query in queries], ['UPDATE'])
+        self.popular.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.popular.views_count, self.other.views_count), (5, 1))
+
+        # Буфер очищен: повторный сброс ничего не прибавляет
+        self.assertEqual(flush_article_views(), 0)
+
+        response = self.client.get(reverse('article-list'), {'ordering': '-views_count'})
+        self.assertEqual([article['slug'] for article in response.data['articles']['results']], ['popular', 'other'])
+
+    @override_settings(DEBUG=True)  # без initData подставляется один и тот же пользователь
+    def test_views_are_deduplicated_per_user_and_day(self):
+        for _ in range(3):
+            self.view('popular')
+        flush_article_views()
+        self.popular.refresh_from_db()
+        self.assertEqual(self.popular.views_count, 1)
+
+    @override_settings(DEBUG=False, TELEGRAM_BOT_TOKEN='123:test-token')
+    def test_view_with_expired_init_data_is_counted_anonymously(self):
+        response = self.client.post(
+            reverse('article-increment-view', kwargs={'slug': 'popular'}), HTTP_AUTHORIZATION='tma auth_date=1&hash=0'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        flush_article_views()
+        self.popular.refresh_from_db()
+        self.assertEqual(self.popular.views_count, 1)
+
+    @override_settings(DEBUG=False)
+    def test_views_are_written_immediately_without_redis(self):
+        with mock.patch('shop.counters.redis_client', return_value=None):
+            self.view('popular')
+            self.assertEqual(flush_article_views(), 0)
+        self.popular.refresh_from_db()
+        self.assertEqual(self.popular.views_count, 1)
+
+    @override_settings(DEBUG=False, ARTICLE_VIEWS_BUFFERED=False)
+    def test_unbuffered_views_are_written_immediately(self):
+        self.view('popular')
+        self.popular.refresh_from_db()
+        self.assertEqual(self.popular.views_count, 1)
+
+
+class ArticleTextTestCase(APITestCase):
+    """
+    Тесты хранимого текста статьи: время чтения и описание без разбора HTML при чтении.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.article = Article.objects.create(
+            title='Обзор', slug='review', status=Article.Status.PUBLISHED,
+            content='<p>Слово&nbsp;слово</p>' + '<p>текст</p>' * 399,
+        )
+
+    def test_text_fields_are_stored_on_save(self):
+        self.assertEqual(self.article.plain_text[:11], 'Слово слово')
+        self.assertEqual(self.article.word_count, 401)
+        self.assertEqual(self.article.reading_time, 3)
+
+        self.article.content = '<p>Коротко</p>'
+        self.article.save(update_fields=['content'])
+        self.article.refresh_from_db()
+        self.assertEqual((self.article.plain_text, self.article.word_count, self.article.reading_time), ('Коротко', 1, 1))
+
+    def test_detail_uses_stored_text(self):
+        with mock.patch('shop.models.html_to_text') as html_to_text:
+            response = self.client.get(reverse('article-detail', kwargs={'slug': 'review'}))
+        html_to_text.assert_not_called()
+        self.assertEqual(response.data['reading_time'], 3)
+        self.assertEqual(len(response.data['meta_description']), 160)
+        self.assertTrue(response.data['meta_description'].startswith('Слово слово текст'))
+
+    def test_backfill_command(self):
+        Article.objects.filter(pk=self.article.pk).update(plain_text='', word_count=0, reading_time=0)
+        call_command('rebuild_article_text', stdout=mock.Mock())
+        self.article.refresh_from_db()
+        self.assertEqual((self.article.word_count, self.article.reading_time), (401, 3))
+
+
+class BlogIndexCacheTestCase(APITestCase):
+    """
+    Тесты кэша ленты блога и отложенной публикации статей.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = ArticleCategory.objects.create(name='Новости', slug='news')
+        cls.article = Article.objects.create(
+            title='Опубликована', slug='published', status=Article.Status.PUBLISHED, category=cls.category,
+        )
+        cls.scheduled = Article.objects.create(
+            title='Отложена', slug='scheduled', status=Article.Status.PUBLISHED,
+            published_at=timezone.now() + timedelta(hours=1),
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def _slugs(self, response):
+        return [article['slug'] for article in response.data['articles']['results']]
+
+    def test_scheduled_article_appears_after_publish_job(self):
+        self.assertFalse(self.scheduled.is_visible)
+        self.assertEqual(self._slugs(self.client.get(reverse('article-list'))), ['published'])
+        self.assertEqual(self.client.get(reverse('article-detail', kwargs={'slug': 'scheduled'})).status_code, 404)
+
+        Article.objects.filter(pk=self.scheduled.pk).update(published_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(scheduler.publish_scheduled_articles(), 1)
+
+        self.assertEqual(self._slugs(self.client.get(reverse('article-list'))), ['published', 'scheduled'])
+        self.assertEqual(self.client.get(reverse('article-detail', kwargs={'slug': 'scheduled'})).status_code, 200)
+
+    def test_repeat_index_request_is_served_from_cache(self):
+        first = self.client.get(reverse('article-list'), {'category': 'news'})
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('article-list'), {'category': 'news'})
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(self._slugs(second), ['published'])
+
+        not_modified = self.client.get(reverse('article-list'), {'category': 'news'}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_search_is_not_cached(self):
+        response = self.client.get(reverse('article-list'), {'search': 'Опубликована'})
+        self.assertNotIn('ETag', response)
+
+    def test_article_change_invalidates_index(self):
+        etag = self.client.get(reverse('article-list'))['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.article.status = Article.Status.DRAFT
+            self.article.save()
+
+        response = self.client.get(reverse('article-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._slugs(response), [])
+
+
+class ThumbnailQueueTestCase(APITestCase):
+    """
+    Тесты очереди генерации миниатюр: загрузка не рендерит картинки, это делает воркер,
+    а сериализаторы берут URL миниатюр из манифеста объекта.
+    """
+
+    def setUp(self):
+        cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _upload(self, name='banner.png'):
+        content = io.BytesIO()
+        Image.new('RGB', (600, 300), 'red').save(content, format='PNG')
+        return SimpleUploadedFile(name, content.getvalue(), content_type='image/png')
+
+    def test_upload_enqueues_job_without_rendering(self):
+        banner = PromoBanner.objects.create(title='Баннер', image=self._upload())
+
+        job = ThumbnailJob.objects.get()
+        self.assertEqual((job.model, job.object_id, job.source_field), ('shop.PromoBanner', banner.pk, 'image'))
+        # URL строится без обращения к хранилищу и без рендеринга
+        url = banner.image_thumbnail.url
+        self.assertTrue(url.endswith('.webp'))
+        self.assertFalse(default_storage.exists(banner.image_thumbnail.name))
+
+        self.assertEqual(process_thumbnail_jobs(InlineExecutor()), (1, 0))
+        self.assertFalse(ThumbnailJob.objects.exists())
+        with default_storage.open(banner.image_thumbnail.name) as thumbnail:
+            self.assertEqual(Image.open(thumbnail).size, (280, 140))
+
+    def test_reupload_updates_pending_job(self):
+        banner = PromoBanner.objects.create(title='Баннер', image=self._upload())
+        banner.image = self._upload('other.png')
+        banner.save()
+
+        job = ThumbnailJob.objects.get()
+        self.assertEqual(job.source_name, banner.image.name)
+
+    def test_failed_job_is_retried_later(self):
+        banner = PromoBanner.objects.create(title='Баннер', image=self._upload())
+        default_storage.delete(banner.image.name)
+
+        self.assertEqual(process_thumbnail_jobs(InlineExecutor()), (0, 1))
+        job = ThumbnailJob.objects.get()
+        self.assertEqual(job.attempts, 1)
+        self.assertGreater(job.available_at, timezone.now())
+        self.assertIn('FileNotFoundError', job.last_error)
+        # До истечения задержки задача не берется повторно
+        self.assertEqual(process_thumbnail_jobs(InlineExecutor()), (0, 0))
+
+    def test_rebuild_all_thumbnails(self):
+        banner = PromoBanner.objects.create(title='Баннер', image=self._upload())
+        done, errors = rebuild_all_thumbnails(InlineExecutor())
+        self.assertEqual((done, errors), (1, []))
+        self.assertTrue(default_storage.exists(banner.image_thumbnail.name))
+
+        default_storage.delete(banner.image_thumbnail.name)
+        call_command('rebuild_thumbnails', '--force', '--workers=0', stdout=mock.Mock())
+        self.assertTrue(default_storage.exists(banner.image_thumbnail.name))
+
+    def test_rebuild_command_reports_failed_images(self):
+        banner = PromoBanner.objects.create(title='Баннер', image=self._upload())
+        broken = PromoBanner.objects.create(title='Без файла', image=self._upload('broken.png'))
+        default_storage.delete(broken.image.name)
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('rebuild_thumbnails', '--workers=0', stdout=stdout, stderr=stderr)
+        self.assertIn('Обработано изображений: 1, с ошибкой: 1', stdout.getvalue())
+        self.assertIn(f'shop.PromoBanner #{broken.pk}.image {broken.image.name}: FileNotFoundError', stderr.getvalue())
+        self.assertTrue(default_storage.exists(banner.image_thumbnail.name))
+
+    def test_serializer_reads_manifest_without_storage_checks(self):
+        banner = PromoBanner.objects.create(title='Баннер', image=self._upload())
+        # Пока миниатюры нет, отдается оригинал
+        response = self.client.get(reverse('banner-list'))
+        self.assertTrue(response.data[0]['image_url'].endswith(banner.image.url))
+
+        process_thumbnail_jobs(InlineExecutor())
+        banner.refresh_from_db()
+        self.assertEqual(banner.thumbnails['image_thumbnail']['source'], banner.image.name)
+
+        with mock.patch('django.core.files.storage.FileSystemStorage.exists') as exists:
+            response = self.client.get(reverse('banner-list'))
+        exists.assert_not_called()
+        self.assertEqual(response.data[0]['image_url'], f"http://testserver{banner.thumbnails['image_thumbnail']['url']}")
+
+    def test_manifest_update_invalidates_product_card(self):
+        category = Category.objects.create(name='Колонки')
+        product = Product.objects.create(
+            name='Колонка', category=category, regular_price=Decimal('990.00'), main_image=self._upload('main.png')
+        )
+        card = self.client.get(reverse('product-list')).data['results'][0]
+        self.assertTrue(card['main_image_thumbnail_url'].endswith(product.main_image.url))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            process_thumbnail_jobs(InlineExecutor())
+        card = self.client.get(reverse('product-list')).data['results'][0]
+        self.assertTrue(card['main_image_thumbnail_url'].endswith('.webp'))
+
+    def test_verify_reconciles_manifest_with_storage(self):
+        banner = PromoBanner.objects.create(title='Баннер', image=self._upload())
+        process_thumbnail_jobs(InlineExecutor())
+        banner.refresh_from_db()
+        manifest = banner.thumbnails
+
+        # Потерянный манифест восстанавливается по файлам в хранилище
+        PromoBanner.objects.filter(pk=banner.pk).update(thumbnails={})
+        self.assertEqual(verify_thumbnails(), (1, 0))
+        banner.refresh_from_db()
+        self.assertEqual(banner.thumbnails, manifest)
+
+        # Пропавший файл убирается из манифеста, изображение снова в очереди
+        default_storage.delete(banner.image_thumbnail.name)
+        call_command('verify_thumbnails', stdout=mock.Mock())
+        banner.refresh_from_db()
+        self.assertEqual(banner.thumbnails, {})
+        self.assertTrue(ThumbnailJob.objects.filter(object_id=banner.pk).exists())
@@ -0,0 +1,284 @@
+# backend/shop/thumbnails.py
+"""
+Фоновая генерация миниатюр (ImageSpecField из django-imagekit).
+
+Стратегия кэш-файлов QueuedThumbnailStrategy (IMAGEKIT_DEFAULT_CACHEFILE_STRATEGY)
+оптимистична: обращение к .url миниатюры не проверяет хранилище и не рендерит
+картинку, поэтому сериализаторы никогда не запускают Pillow. Вместо этого при
+сохранении нового исходного изображения (например, загрузка в админке) в той же
+транзакции ставится задача ThumbnailJob, а воркер `python manage.py
+run_thumbnail_worker` рендерит все спецификации изображения в пуле процессов
+(THUMBNAIL_WORKERS, по умолчанию по одному на ядро).
+
+`python manage.py rebuild_thumbnails` генерирует миниатюры всех изображений
+тем же пулом (первичное заполнение, изменение процессоров спецификации).
+
+URL сгенерированных миниатюр записываются в манифест объекта (поле thumbnails),
+и сериализаторы читают их оттуда (thumbnail_url), не вычисляя имена кэш-файлов
+и не обращаясь к хранилищу. Запись манифеста привязана к имени исходного
+файла: пока миниатюра нового изображения не готова, отдается URL оригинала.
+`python manage.py verify_thumbnails` сверяет манифесты с хранилищем.
+"""
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+
+import django
+from django.apps import apps
+from django.db import transaction
+from django.utils import timezone
+from imagekit.cachefiles import ImageCacheFile
+from imagekit.models.fields.utils import ImageSpecFileDescriptor
+
+from .models import ThumbnailJob
+from .outbox import backoff_delay
+
+MAX_ATTEMPTS = 10
+# Пока воркер рендерит пачку (вне транзакции), другие воркеры ее не берут;
+# если воркер упал, задачи снова станут доступны по истечении аренды
+CLAIM_TIMEOUT = timedelta(minutes=10)
+REBUILD_CHUNK_SIZE = 500
+
+
+@lru_cache(maxsize=None)
+def thumbnail_specs():
+    """{(модель, поле-источник): [имена ImageSpecField]} для моделей магазина."""
+    specs = defaultdict(list)
+    for model in apps.get_app_config('shop').get_models():
+        for attname, value in vars(model).items():
+            if isinstance(value, ImageSpecFileDescriptor):
+                specs[model, value.source_field_name].append(attname)
+    return dict(specs)
+
+
+def _spec_files(model, source_field, source_name):
+    """Кэш-файлы всех спецификаций исходного изображения: [(имя спецификации, ImageCacheFile)]."""
+    field = model._meta.get_field(source_field)
+    # Файл-источник восстанавливается по имени, без загрузки объекта из БД
+    source = field.attr_class(None, field, source_name)
+    return [
+        (attname, ImageCacheFile(getattr(model, attname).get_spec(source=source)))
+        for attname in thumbnail_specs()[model, source_field]
+    ]
+
+
+def render_thumbnails(model_label, source_field, source_name, force=False):
+    """
+    Рендерит все миниатюры исходного изображения и возвращает записи манифеста
+    {спецификация: {'source': ..., 'url': ...}}. Выполняется в процессе пула и не обращается к БД.
+    """
+    entries = {}
+    for attname, file in _spec_files(apps.get_model(model_label), source_field, source_name):
+        file.generate(force=force)
+        entries[attname] = {'source': source_name, 'url': file.url}
+    return entries
+
+
+def thumbnail_url(instance, spec_name):
+    """
+    URL миниатюры из манифеста объекта. Если миниатюра текущего изображения
+    еще не сгенерирована - URL оригинала (он точно существует). Хранилище не проверяется.
+    """
+    source = getattr(instance, vars(type(instance))[spec_name].source_field_name)
+    if not source:
+        return None
+    entry = instance.thumbnails.get(spec_name)
+    if entry and entry['source'] == source.name:
+        return entry['url']
+    return source.url
+
+
+def update_manifest(model_label, object_id, source_field, entries):
+    """
+    Записывает миниатюры в манифест объекта. Сохранение идет через save(), поэтому
+    кэши карточек, документов и ленты блога сбрасываются обычными сигналами (signals.py).
+    Возвращает True, если манифест изменился.
+    """
+    instance = apps.get_model(model_label)._default_manager.filter(pk=object_id).first()
+    if instance is None:
+        return False
+    # Изображение могли заменить, пока миниатюры рендерились: старые записи не нужны
+    source_name = getattr(instance, source_field).name
+    entries = {attname: entry for attname, entry in entries.items() if entry['source'] == source_name}
+    manifest = {**instance.thumbnails, **entries}
+    if manifest == instance.thumbnails:
+        return False
+    instance.thumbnails = manifest
+    instance.save(update_fields=['thumbnails'])
+    return True
+
+
+class InlineExecutor:
+    """Исполнитель без пула (workers=0): задачи выполняются сразу в текущем процессе."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def thumbnail_pool(workers):
+    """
+    Пул процессов для рендеринга. Процессы запускаются через spawn, а не fork:
+    они не наследуют открытые соединения с БД и кэшем родителя.
+    """
+    if not workers:
+        return InlineExecutor()
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup
+    )
+
+
+class QueuedThumbnailStrategy:
+    """
+    Стратегия кэш-файлов imagekit: миниатюры генерируются воркером, а не при обращении.
+    URL миниатюры строится без проверки хранилища (до генерации файл отдаст 404).
+    """
+
+    def on_source_saved(self, file):
+        source = file.generator.source
+        enqueue_thumbnails(source.instance, source.field.name)
+
+    def on_content_required(self, file):
+        # Содержимое миниатюры (не URL) нужно только коду, который читает саму картинку
+        file.generate()
+
+    def should_verify_existence(self, file):
+        return False
+
+
+def enqueue_thumbnails(instance, source_field):
+    """Ставит (или обновляет) задачу генерации миниатюр изображения объекта."""
+    source_name = getattr(instance, source_field).name
+    if not source_name:
+        return
+    ThumbnailJob.objects.bulk_create(
+        [ThumbnailJob(
+            model=instance._meta.label, object_id=instance.pk, source_field=source_field, source_name=source_name,
+        )],
+        update_conflicts=True,
+        unique_fields=['model', 'object_id', 'source_field'],
+        update_fields=['source_name', 'available_at', 'attempts', 'last_error'],
+    )
+
+
+def claim_thumbnail_jobs(batch_size):
+    """Забирает пачку готовых задач (SELECT ... FOR UPDATE SKIP LOCKED) под аренду CLAIM_TIMEOUT."""
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(
+            ThumbnailJob.objects.select_for_update(skip_locked=True)
+            .filter(available_at__lte=now, attempts__lt=MAX_ATTEMPTS)
+            .order_by('available_at')[:batch_size]
+        )
+        for job in jobs:
+            job.attempts += 1
+            job.available_at = now + CLAIM_TIMEOUT
+        ThumbnailJob.objects.bulk_update(jobs, ['attempts', 'available_at'])
+    return jobs
+
+
+def process_thumbnail_jobs(executor, batch_size=50):
+    """
+    Рендерит одну пачку задач в пуле `executor`. Возвращает (выполнено, с ошибкой).
+    """
+    jobs = claim_thumbnail_jobs(batch_size)
+    futures = [
+        (job, executor.submit(render_thumbnails, job.model, job.source_field, job.source_name))
+        for job in jobs
+    ]
+    done = failed = 0
+    for job, future in futures:
+        # Фильтр по source_name: если изображение заменили во время рендеринга,
+        # задача уже указывает на новый файл и должна остаться в очереди
+        current = ThumbnailJob.objects.filter(pk=job.pk, source_name=job.source_name)
+        try:
+            update_manifest(job.model, job.object_id, job.source_field, future.result())
+        except Exception as exc:
+            current.update(
+                available_at=timezone.now() + backoff_delay(job.attempts), last_error=f"{type(exc).__name__}: {exc}"
+            )
+            failed += 1
+        else:
+            current.delete()
+            done += 1
+    return done, failed
+
+
+def thumbnail_sources():
+    """Все исходные изображения с миниатюрами: (модель, ID объекта, поле-источник, имя файла)."""
+    for model, source_field in thumbnail_specs():
+        rows = model._default_manager.exclude(**{source_field: ''}).order_by('pk')\
+            .values_list('pk', source_field).iterator(chunk_size=REBUILD_CHUNK_SIZE)
+        for object_id, name in rows:
+            yield model._meta.label, object_id, source_field, name
+
+
+def rebuild_all_thumbnails(executor, force=False):
+    """
+    Генерирует миниатюры всех изображений. Без force существующие файлы не
+    перерисовываются. Возвращает (изображений обработано, список ошибок).
+    """
+    done, errors = 0, []
+
+    def collect(batch):
+        nonlocal done
+        for source, future in batch:
+            model_label, object_id, source_field, _ = source
+            try:
+                update_manifest(model_label, object_id, source_field, future.result())
+            except Exception as exc:
+                errors.append((source, f"{type(exc).__name__}: {exc}"))
+            else:
+                done += 1
+
+    # Задачи отправляются в пул порциями, чтобы не держать в памяти futures всех изображений
+    batch = []
+    for source in thumbnail_sources():
+        model_label, _, source_field, source_name = source
+        batch.append((source, executor.submit(render_thumbnails, model_label, source_field, source_name, force=force)))
+        if len(batch) >= REBUILD_CHUNK_SIZE:
+            collect(batch)
+            batch = []
+    collect(batch)
+    return done, errors
+
+
+def verify_thumbnails():
+    """
+    Сверяет манифесты с хранилищем: добавляет записи для существующих файлов
+    миниатюр, удаляет записи о пропавших и ставит их изображения в очередь генерации.
+    Возвращает (исправлено манифестов, поставлено в очередь).
+    """
+    fixed = queued = 0
+    for model, source_field in thumbnail_specs():
+        specs = thumbnail_specs()[model, source_field]
+        for instance in model._default_manager.order_by('pk').iterator(chunk_size=REBUILD_CHUNK_SIZE):
+            source_name = getattr(instance, source_field).name
+            manifest = {attname: entry for attname, entry in instance.thumbnails.items() if attname not in specs}
+            missing = False
+            if source_name:
+                for attname, file in _spec_files(model, source_field, source_name):
+                    if file.storage.exists(file.name):
+                        manifest[attname] = {'source': source_name, 'url': file.url}
+                    else:
+                        missing = True
+            if manifest != instance.thumbnails:
+                instance.thumbnails = manifest
+                instance.save(update_fields=['thumbnails'])
+                fixed += 1
+            if missing:
+                enqueue_thumbnails(instance, source_field)
+                queued += 1
+    return fixed, queued
@@ -2,16 +2,34 @@
 
 import hmac
 import hashlib
+import html
 import json
+from functools import lru_cache
 from urllib.parse import parse_qsl
 
+from django.utils.html import strip_tags
+
+
+def html_to_text(value):
+    """Превращает HTML из CKEditor в чистый текст (без тегов и HTML-сущностей)."""
+    # Пробел перед каждым тегом: иначе соседние абзацы ("...конец</p><p>Начало...") слипаются в одно слово
+    return ' '.join(html.unescape(strip_tags((value or '').replace('<', ' <'))).split())
+
+
+@lru_cache(maxsize=4)
+def webapp_secret_key(bot_token: str) -> bytes:
+    """Секретный ключ проверки initData. Зависит только от токена бота, поэтому вычисляется один раз."""
+    return hmac.new(key=b"WebAppData", msg=bot_token.encode(), digestmod=hashlib.sha256).digest()
+
+
 def validate_init_data(init_data_str: str, bot_token: str):
     """
     Проверяет и парсит строку initData из Telegram Web App.
 
     :param init_data_str: Полная строка initData из window.Telegram.WebApp.initData
     :param bot_token: Секретный токен вашего бота.
-    :return: Словарь с данными пользователя, если валидация прошла успешно, иначе None.
+    :return: Кортеж (данные пользователя, auth_date), если подпись верна, иначе None.
+             Свежесть auth_date проверяет вызывающий код (см. authentication.py).
     """
     try:
         # Разбираем строку на параметры
@@ -26,23 +44,18 @@ def validate_init_data(init_data_str: str, bot_token: str):
             f"{key}={value}" for key, value in sorted(parsed_data.items())
         )
 
-        # Генерируем секретный ключ из токена бота
-        secret_key = hmac.new(
-            key=b"WebAppData", msg=bot_token.encode(), digestmod=hashlib.sha256
-        ).digest()
-
         # Генерируем наш хеш
         calculated_hash = hmac.new(
-            key=secret_key, msg=data_check_string.encode(), digestmod=hashlib.sha256
+            key=webapp_secret_key(bot_token), msg=data_check_string.encode(), digestmod=hashlib.sha256
         ).hexdigest()
 
-        # Сравниваем хеши
-        if calculated_hash == hash_from_telegram:
+        # Сравниваем хеши (за постоянное время)
+        if hmac.compare_digest(calculated_hash, hash_from_telegram):
             # Данные валидны, возвращаем информацию о пользователе
             user_data = json.loads(parsed_data.get("user", "{}"))
-            return user_data
+            return user_data, int(parsed_data["auth_date"])
     except Exception:
-        # В случае любой ошибки (например, битый JSON) считаем данные невалидными
+        # В случае любой ошибки (например, битый JSON или нет auth_date) считаем данные невалидными
         return None
 
-    return None
\ No newline at end of file
+    return None
@@ -1,20 +1,27 @@
 # backend/shop/views.py
-from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError
 from django.utils import timezone
-from django.db.models import Prefetch
-from django.db.models import F
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import etag
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, Q
 
-from decimal import Decimal
+import json
+from base64 import b64decode, b64encode
 
 from rest_framework import generics, filters, status
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django_filters.rest_framework import DjangoFilterBackend
 
 from .models import (
-    Product, Category, PromoBanner, DiscountRule,
-    ShopSettings, FaqItem, Cart, CartItem, Order, Article, ArticleCategory
+    Product, Category, PromoBanner,
+    ShopSettings, FaqItem, CartItem, Order, Article, ArticleCategory
 )
 from .serializers import (
     ProductListSerializer, ProductDetailSerializer, CategorySerializer,
@@ -22,103 +29,207 @@ from .serializers import (
     DealOfTheDaySerializer, CartSerializer, DetailedCartItemSerializer, OrderCreateSerializer,
     ArticleListSerializer, ArticleDetailSerializer, ArticleCategorySerializer
 )
-from .utils import validate_init_data
+from .caching import (
+    BLOG_INDEX_TIMEOUT, CART_LINES_TIMEOUT, CATEGORY_TREE_TIMEOUT, ORDER_IDEMPOTENCY_TIMEOUT, SELECTION_CACHE_TIMEOUT,
+    blog_categories_key, blog_index_key, cart_lines_key, category_tree_key, get_blog_version, get_catalog_version,
+    order_idempotency_key, pricing_version, selection_cache_key
+)
+from .carts import CartLocked, cart_lock, change_cart, change_locked_cart, get_cart
+from .counters import record_article_view
+from .discounts import calculate_detailed_discounts
+from .quotes import issue_quote, order_pricing, redeem_quote
+from .documents import get_product_document, product_detail_queryset, render_product_document
+from .search import FullTextSearchFilter
+from .authentication import OptionalTelegramInitDataAuthentication, TelegramInitDataAuthentication
 
 
 # --- ИЗМЕНЕНИЕ: Определение миксина ПЕРЕНЕСЕНО В НАЧАЛО ФАЙЛА ---
 class TelegramAuthMixin(APIView):
     """
-    Миксин для проверки аутентификации Telegram Web App.
-    Извлекает данные пользователя из initData и делает их доступными в request.telegram_user.
+    Базовый класс эндпоинтов Telegram Web App. Пользователь проверяется по initData
+    (см. authentication.py) и доступен как request.user (TelegramUser).
     """
-    def dispatch(self, request, *args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-
-        # Для локальной разработки без Telegram, разрешаем доступ в режиме DEBUG
-        if not auth_header and settings.DEBUG:
-            print("WARNING: Bypassing Telegram auth in DEBUG mode.")
-            # Подставляем фейковые данные для тестов
-            request.telegram_user = {'id': 123456789, 'first_name': 'Test', 'last_name': 'User', 'username': 'testuser'}
-            return super().dispatch(request, *args, **kwargs)
-
-        if not auth_header or not auth_header.startswith('tma '):
-            return Response({"error": "Authorization header is missing or invalid"}, status=status.HTTP_401_UNAUTHORIZED)
-
-        init_data_str = auth_header.split(' ')[1]
+    authentication_classes = [TelegramInitDataAuthentication]
+    permission_classes = [IsAuthenticated]
 
-        # Валидируем initData с помощью нашего токена
-        user_data = validate_init_data(init_data_str, settings.TELEGRAM_BOT_TOKEN)
+    def handle_exception(self, exc):
+        if isinstance(exc, CartLocked):
+            # Корзину дольше CART_LOCK_TIMEOUT держит параллельный запрос: изменения не применены
+            return Response({"error": "Корзина изменяется другим запросом, повторите позже"}, status=status.HTTP_409_CONFLICT)
+        return super().handle_exception(exc)
 
-        if user_data is None:
-            return Response({"error": "Invalid Telegram data"}, status=status.HTTP_403_FORBIDDEN)
 
-        # Сохраняем проверенные данные пользователя в объект запроса для дальнейшего использования
-        request.telegram_user = user_data
-        return super().dispatch(request, *args, **kwargs)
+def category_tree_etag(request, *args, **kwargs):
+    return f"categories-{get_catalog_version()}"
 
 
-def parse_init_data(init_data: str, bot_token: str):
+class CategoryListView(APIView):
     """
-    Validates and parses the initData string from a Telegram Web App.
-    Returns user data dictionary if valid, otherwise None.
+    Дерево категорий. Все категории загружаются одним запросом, дерево собирается
+    в памяти и кэшируется до следующего изменения каталога. Повторный запрос
+    с If-None-Match получает 304 без тела.
     """
-    try:
-        # Разбираем строку на параметры
-        parsed_data = dict(parse_qsl(init_data))
-        hash_from_telegram = parsed_data.pop("hash", None)
-
-        if not hash_from_telegram:
-            return None
-
-        # Формируем строку для проверки хеша
-        data_check_string = "\n".join(
-            f"{key}={value}" for key, value in sorted(parsed_data.items())
-        )
-
-        # Генерируем секретный ключ из токена бота
-        secret_key = hmac.new(
-            key=b"WebAppData", msg=bot_token.encode(), digestmod=hashlib.sha256
-        ).digest()
-
-        # Генерируем наш хеш
-        calculated_hash = hmac.new(
-            key=secret_key, msg=data_check_string.encode(), digestmod=hashlib.sha256
-        ).hexdigest()
-
-        # Сравниваем хеши
-        if calculated_hash == hash_from_telegram:
-            # Данные валидны, возвращаем информацию о пользователе
-            user_data = json.loads(parsed_data.get("user", "{}"))
-            return user_data
-    except Exception:
-        return None
-    return None
-
-
-class CategoryListView(generics.ListAPIView):
-    queryset = Category.objects.filter(parent__isnull=True)
-    serializer_class = CategorySerializer
-    pagination_class = None
+    @method_decorator(etag(category_tree_etag))
+    def get(self, request, *args, **kwargs):
+        key = category_tree_key(get_catalog_version())
+        data = cache.get(key)
+        if data is None:
+            children_by_parent = {}
+            for category in Category.objects.order_by('id'):
+                children_by_parent.setdefault(category.parent_id, []).append(category)
+            serializer = CategorySerializer(
+                children_by_parent.get(None, []), many=True, context={'children_by_parent': children_by_parent}
+            )
+            data = serializer.data
+            cache.set(key, data, CATEGORY_TREE_TIMEOUT)
+        return Response(data)
 
 class PromoBannerListView(generics.ListAPIView):
     queryset = PromoBanner.objects.filter(is_active=True).order_by('order')
     serializer_class = PromoBannerSerializer
     pagination_class = None
 
-class StandardResultsSetPagination(PageNumberPagination):
+class KeysetResultsSetPagination(BasePagination):
+    """
+    Курсорная (keyset) пагинация для бесконечной ленты.
+    Следующая страница выбирается условием по паре (поле сортировки, id) вместо OFFSET,
+    а общее количество (COUNT(*)) не считается вовсе. Ответ: {'next', 'previous', 'results'}.
+
+    Сортировка берется из уже отсортированного queryset (OrderingFilter),
+    иначе из Meta.ordering модели. Используется только первое поле + id для однозначности.
+    Пустые значения сортируемого поля (например, effective_price до заполнения) идут
+    в конце ленты при любом направлении сортировки.
+    """
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        ordering = list(queryset.query.order_by) or list(queryset.model._meta.ordering)
+        field = ordering[0] if ordering and isinstance(ordering[0], str) else '-pk'
+        descending = field.startswith('-')
+        self.field_name = field.lstrip('-')
+        if self.field_name == 'id':
+            self.field_name = 'pk'
+        prefix = '-' if descending else ''
+        nullable = self.is_nullable(queryset, self.field_name)
+        if self.field_name == 'pk':
+            order_by = ['-pk' if descending else 'pk']
+        elif nullable:
+            field = F(self.field_name)
+            order_by = [field.desc(nulls_last=True) if descending else field.asc(nulls_last=True), f'{prefix}pk']
+        else:
+            order_by = [f'{prefix}{self.field_name}', f'{prefix}pk']
+        queryset = queryset.order_by(*order_by)
+
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            lookup = 'lt' if descending else 'gt'
+            value = cursor.get('value')
+            if self.field_name == 'pk':
+                queryset = queryset.filter(**{f'pk__{lookup}': cursor['id']})
+            elif value is None:
+                if not nullable:
+                    raise NotFound(self.invalid_cursor_message)
+                # Курсор уже в хвосте из пустых значений: дальше только они, по id
+                queryset = queryset.filter(**{f'{self.field_name}__isnull': True, f'pk__{lookup}': cursor['id']})
+            else:
+                condition = (
+                    Q(**{f'{self.field_name}__{lookup}': value}) |
+                    Q(**{self.field_name: value, f'pk__{lookup}': cursor['id']})
+                )
+                if nullable:
+                    condition |= Q(**{f'{self.field_name}__isnull': True})
+                queryset = queryset.filter(condition)
+
+        # Берем на один элемент больше, чтобы понять, есть ли следующая страница
+        results = list(queryset[:page_size + 1])
+        self.has_next = len(results) > page_size
+        self.page = results[:page_size]
+        return self.page
+
+    @staticmethod
+    def is_nullable(queryset, field_name):
+        if field_name == 'pk':
+            return False
+        annotation = queryset.query.annotations.get(field_name)
+        if annotation is not None:
+            return getattr(annotation.output_field, 'null', True)
+        try:
+            return queryset.model._meta.get_field(field_name).null
+        except FieldDoesNotExist:
+            return True
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+            if size > 0:
+                return min(size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(b64decode(encoded.encode('ascii')).decode('utf-8'))
+            if not isinstance(cursor, dict) or 'id' not in cursor:
+                raise ValueError
+            return cursor
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, obj):
+        value = None
+        if self.field_name != 'pk':
+            value = getattr(obj, self.field_name)
+            if value is not None:
+                value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+        data = json.dumps({'value': value, 'id': obj.pk}, separators=(',', ':'))
+        return b64encode(data.encode('utf-8')).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': None,
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
 
 class ProductListView(generics.ListAPIView):
     serializer_class = ProductListSerializer
-    pagination_class = StandardResultsSetPagination
+    pagination_class = KeysetResultsSetPagination
     filter_backends = [
         DjangoFilterBackend,
         filters.OrderingFilter,
-        filters.SearchFilter,
+        FullTextSearchFilter,
     ]
+    # search_fields используются только вне PostgreSQL (обычный ILIKE-поиск)
     search_fields = ['name', 'description']
+    search_trigram_field = 'name'
 
     # 1. РАЗРЕШАЕМ СОРТИРОВКУ ПО 'price'
     # Фронтенд уже отправляет 'price', так что теперь все будет совпадать.
@@ -127,9 +238,10 @@ class ProductListView(generics.ListAPIView):
     def get_queryset(self):
         # 2. СОЗДАЕМ БАЗОВЫЙ QUERYSET
         # Здесь мы выбираем только активные товары и подгружаем связанные данные.
+        # info_panels не подгружаем: карточки берутся из кэша, а для промахов
+        # ProductCardListSerializer сам подгружает панельки одним запросом.
         base_queryset = Product.objects.filter(is_active=True)\
-            .select_related('category')\
-            .prefetch_related('info_panels')
+            .select_related('category')
 
         # 3. АННОТИРУЕМ QUERYSET АКТУАЛЬНОЙ ЦЕНОЙ
         # Используем метод, который мы добавили в модель Product.
@@ -153,64 +265,48 @@ class ProductListView(generics.ListAPIView):
         category_id = self.request.query_params.get('category')
         if category_id:
             try:
-                category = Category.objects.get(pk=category_id)
-                def get_all_children_ids(category_obj):
-                    children_ids = []
-                    children = category_obj.subcategories.all()
-                    for child in children:
-                        children_ids.append(child.id)
-                        children_ids.extend(get_all_children_ids(child))
-                    return children_ids
-                categories_ids_to_filter = [category.id] + get_all_children_ids(category)
-                # ВАЖНО: фильтруем queryset_with_price
-                queryset_with_price = queryset_with_price.filter(category__id__in=categories_ids_to_filter)
+                category = Category.objects.only('tree_path').get(pk=category_id)
+                if category.tree_path:
+                    # Все поддерево категории выбирается одним условием по индексу материализованного пути
+                    # ВАЖНО: фильтруем queryset_with_price
+                    queryset_with_price = queryset_with_price.filter(category__tree_path__startswith=category.tree_path)
+                else:
+                    # Пути еще не построены (до запуска rebuild_category_paths после деплоя):
+                    # собираем поддерево по уровням, GET-запрос ничего не пишет в БД
+                    categories_ids_to_filter = [category.id]
+                    level = [category.id]
+                    while level:
+                        level = list(Category.objects.filter(parent_id__in=level).values_list('id', flat=True))
+                        categories_ids_to_filter.extend(level)
+                    queryset_with_price = queryset_with_price.filter(category__id__in=categories_ids_to_filter)
             except Category.DoesNotExist:
                 return Product.objects.none()
 
-        # 4. ВАЖНАЯ ЧАСТЬ: ПРИМЕНЯЕМ СОРТИРОВКУ И ПОИСК
-        # Мы убрали эту логику из вашего кода, но она должна быть здесь.
-        # DRF filter_backends должны применяться к финальному queryset.
-        for backend in list(self.filter_backends):
-             queryset_with_price = backend().filter_queryset(self.request, queryset_with_price, self)
-
+        # 4. СОРТИРОВКА И ПОИСК
+        # filter_backends применяются стандартным ListAPIView.list() через filter_queryset(),
+        # поэтому здесь их не вызываем - иначе поиск и сортировка выполнялись бы дважды.
         return queryset_with_price
 
 class ProductDetailView(generics.RetrieveAPIView):
-    # 3. ОПТИМИЗАЦИЯ: Заменяем атрибут queryset на метод get_queryset для сложного запроса.
+    """
+    Детальная страница товара. Отдается из заранее собранного документа
+    (см. documents.py); пока документ устарел или не собран - живой сериализацией.
+    """
     serializer_class = ProductDetailSerializer
 
     def get_queryset(self):
-        """
-        Создаем максимально оптимизированный запрос, который "жадно" загружает
-        все необходимые связанные данные для детальной страницы товара.
-        """
-        # Создаем специальный Prefetch для сопутствующих товаров,
-        # чтобы для них тоже сразу подгружались инфо-панельки.
-        # Это предотвращает N+1 запросы внутри сериализатора сопутствующих товаров.
-        related_products_prefetch = Prefetch(
-            'related_products',
-            queryset=Product.objects.filter(is_active=True).prefetch_related('info_panels')
-        )
+        return product_detail_queryset()
 
-        return Product.objects.filter(is_active=True).select_related(
-            'category',       # Загружаем категорию (связь один-ко-многим)
-            'color_group'     # Загружаем группу цветов
-        ).prefetch_related(
-            'info_panels',    # Загружаем все инфо-панели (многие-ко-многим)
-            'images',         # Загружаем все доп. изображения
-            'info_cards',     # Загружаем все инфо-карточки
-            related_products_prefetch, # Используем наш специальный prefetch
-            Prefetch(
-                'color_group__products', # Загружаем все товары из той же группы цветов
-                queryset=Product.objects.filter(is_active=True),
-                to_attr='color_variations_prefetched' # Сохраняем результат в отдельный атрибут
-            )
-        )
+    def retrieve(self, request, *args, **kwargs):
+        data = get_product_document(self.kwargs['pk'])
+        if data is not None:
+            return Response(render_product_document(data, request))
+        return super().retrieve(request, *args, **kwargs)
 
 class ShopSettingsView(APIView):
     def get(self, request, *args, **kwargs):
-        settings = ShopSettings.load()
-        serializer = ShopSettingsSerializer(settings, context={'request': request})
+        shop_settings = ShopSettings.load()
+        serializer = ShopSettingsSerializer(shop_settings, context={'request': request})
         return Response(serializer.data)
 
 class FaqListView(generics.ListAPIView):
@@ -234,227 +330,174 @@ class DealOfTheDayView(generics.RetrieveAPIView):
 
 
 
-def calculate_detailed_discounts(items):
-    """
-    Рассчитывает скидки и возвращает ДЕТАЛИЗИРОВАННЫЙ список товаров.
-    'items' должен быть списком CartItem.
-    """
-    if not items:
-        return {
-            'items': [],
-            'subtotal': '0.00', 'discount_amount': '0.00', 'final_total': '0.00',
-            'applied_rule': None, 'upsell_hint': None
-        }
-
-    subtotal = Decimal('0')
-    total_quantity = 0
-    product_quantities = {}
-    category_quantities = {}
-
-    # Конвертируем queryset в простой список для удобства
-    item_list = [{'product': item.product, 'quantity': item.quantity, 'id': item.id} for item in items]
-
-    for item in item_list:
-        product = item['product']
-        quantity = item['quantity']
-        price = product.current_price
-        subtotal += price * quantity
-        total_quantity += quantity
-        product_quantities[product.id] = quantity
-        current_category = product.category
-        while current_category is not None:
-            category_quantities[current_category.id] = category_quantities.get(current_category.id, 0) + quantity
-            current_category = current_category.parent
-
-    best_discount_amount = Decimal('0')
-    applied_rule = None
-    active_rules = DiscountRule.objects.filter(is_active=True).select_related('product_target', 'category_target')
-
-    for rule in active_rules:
-        current_discount = Decimal('0')
-        if rule.discount_type == DiscountRule.DiscountType.TOTAL_QUANTITY:
-            if total_quantity >= rule.min_quantity:
-                current_discount = subtotal * (rule.discount_percentage / 100)
-        elif rule.discount_type == DiscountRule.DiscountType.PRODUCT_QUANTITY and rule.product_target_id in product_quantities:
-            if product_quantities[rule.product_target_id] >= rule.min_quantity:
-                target_subtotal = item_list[0]['product'].current_price * item_list[0]['quantity'] # Пример упрощен
-                for item in item_list:
-                    if item['product'].id == rule.product_target_id:
-                        target_subtotal = item['product'].current_price * item['quantity']
-                current_discount = target_subtotal * (rule.discount_percentage / 100)
-        elif rule.discount_type == DiscountRule.DiscountType.CATEGORY_QUANTITY and rule.category_target_id in category_quantities:
-            if category_quantities[rule.category_target_id] >= rule.min_quantity:
-                target_subtotal = Decimal('0')
-                target_category_id = rule.category_target_id
-                for item in item_list:
-                    is_in_target_category = False
-                    cat = item['product'].category
-                    while cat is not None:
-                        if cat.id == target_category_id: is_in_target_category = True; break
-                        cat = cat.parent
-                    if is_in_target_category: target_subtotal += item['product'].current_price * item['quantity']
-                current_discount = target_subtotal * (rule.discount_percentage / 100)
-        if current_discount > best_discount_amount:
-            best_discount_amount = current_discount
-            applied_rule = rule
-
-    # --- 2. "РАСКРАШИВАЕМ" ТОВАРЫ ПОСЛЕ НАХОЖДЕНИЯ ЛУЧШЕЙ СКИДКИ ---
-    final_items = []
-    if applied_rule:
-        for item in item_list:
-            product = item['product']
-            quantity = item['quantity']
-            original_price = product.current_price
-            discounted_price = None
-
-            is_discounted = False
-            if applied_rule.discount_type == DiscountRule.DiscountType.TOTAL_QUANTITY:
-                is_discounted = True
-            elif applied_rule.discount_type == DiscountRule.DiscountType.PRODUCT_QUANTITY:
-                if product.id == applied_rule.product_target_id: is_discounted = True
-            elif applied_rule.discount_type == DiscountRule.DiscountType.CATEGORY_QUANTITY:
-                cat = product.category
-                while cat is not None:
-                    if cat.id == applied_rule.category_target_id: is_discounted = True; break
-                    cat = cat.parent
-
-            if is_discounted:
-                discounted_price = original_price * (Decimal('100') - applied_rule.discount_percentage) / Decimal('100')
-
-            final_items.append({
-                'id': item['id'],
-                'product': product,
-                'quantity': quantity,
-                'original_price': original_price,
-                'discounted_price': discounted_price.quantize(Decimal("0.01")) if discounted_price else None
-            })
-    else:
-        # Если скидки нет, просто форматируем данные
-        for item in item_list:
-            final_items.append({
-                'id': item['id'],
-                'product': item['product'],
-                'quantity': item['quantity'],
-                'original_price': item['product'].current_price,
-                'discounted_price': None
-            })
-
-
-    # --- Логика подсказок остается той же, она уже работает правильно ---
-    upsell_hint = None
-    if not applied_rule:
-        # ... (здесь вся ваша существующая логика для upsell_hint без изменений)
-        min_needed_for_hint = float('inf')
-        for rule in active_rules:
-            needed = 0
-            current_hint = ""
-            if rule.discount_type == DiscountRule.DiscountType.TOTAL_QUANTITY:
-                needed = rule.min_quantity - total_quantity
-                if 0 < needed: current_hint = f"Добавьте еще {needed} шт. любого товара, чтобы получить скидку {rule.discount_percentage}%!"
-            elif rule.discount_type == DiscountRule.DiscountType.PRODUCT_QUANTITY and rule.product_target:
-                current_qty = product_quantities.get(rule.product_target.id, 0)
-                needed = rule.min_quantity - current_qty
-                if 0 < needed: current_hint = f"Добавьте еще {needed} шт. товара «{rule.product_target.name}», чтобы получить скидку {rule.discount_percentage}%!"
-            elif rule.discount_type == DiscountRule.DiscountType.CATEGORY_QUANTITY and rule.category_target:
-                current_qty = category_quantities.get(rule.category_target.id, 0)
-                needed = rule.min_quantity - current_qty
-                if 0 < needed: current_hint = f"Добавьте еще {needed} шт. из категории «{rule.category_target.name}», чтобы получить скидку {rule.discount_percentage}%!"
-
-            if current_hint and needed < min_needed_for_hint:
-                min_needed_for_hint = needed
-                upsell_hint = current_hint
-
-    # --- Финальный расчет ---
-    final_total = subtotal - best_discount_amount
-
-    return {
-        'items': final_items,
-        'subtotal': subtotal.quantize(Decimal("0.01")),
-        'discount_amount': best_discount_amount.quantize(Decimal("0.01")),
-        'final_total': final_total,
-        'applied_rule': applied_rule.name if applied_rule else None,
-        'upsell_hint': upsell_hint,
-    }
-
-
 # --- 2. НОВЫЙ VIEW ДЛЯ ДИНАМИЧЕСКОГО РАСЧЕТА ---
 class CalculateSelectionView(TelegramAuthMixin):
     """
     Рассчитывает итоги и скидки для произвольного набора товаров (выбранных).
     """
     def post(self, request, *args, **kwargs):
-        selection = request.data.get('selection', [])
-
-        # Конвертируем selection в queryset CartItem-ов "на лету"
-        # Это хак, но он позволяет переиспользовать код
-        cart_items_mock = []
-        for item_data in selection:
-            try:
-                product = Product.objects.select_related('category').get(id=item_data['product_id'])
-                cart_item = CartItem(product=product, quantity=item_data['quantity'])
-                cart_items_mock.append(cart_item)
-            except Product.DoesNotExist:
-                continue
+        try:
+            selection = [
+                (int(item_data['product_id']), int(item_data['quantity']))
+                for item_data in request.data.get('selection', [])
+            ]
+        except (KeyError, TypeError, ValueError):
+            return Response({"error": "Invalid selection"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Корзина часто переключается между одними и теми же состояниями (галочки),
+        # поэтому готовый ответ кэшируется по выбору и версиям правил, категорий и цен
+        telegram_id = request.user.id
+        # Версия цен снимается до чтения товаров и правил (см. issue_quote)
+        version = pricing_version(product_id for product_id, _ in selection)
+        key = selection_cache_key(selection, version, request.build_absolute_uri('/'))
+        cached = cache.get(key)
+        if cached is not None:
+            detailed_data, pricing = cached
+            return Response({**detailed_data, 'quote': issue_quote(telegram_id, pricing, version)})
+
+        # Все товары выбора одним запросом; предки категорий берутся из tree_path
+        products = Product.objects.select_related('category').in_bulk(
+            [product_id for product_id, _ in selection]
+        )
+        # Несохраненные CartItem позволяют переиспользовать расчет корзины
+        cart_items_mock = [
+            CartItem(product=products[product_id], quantity=quantity)
+            for product_id, quantity in selection
+            if product_id in products
+        ]
 
         detailed_data = calculate_detailed_discounts(cart_items_mock)
+        pricing = order_pricing(detailed_data)
         # Сериализуем "раскрашенные" товары
         detailed_data['items'] = DetailedCartItemSerializer(detailed_data['items'], many=True, context={'request': request}).data
-        return Response(detailed_data)
+        # Ответ кэшируется без квоты: квота подписывается для каждого пользователя
+        cache.set(key, (detailed_data, pricing), SELECTION_CACHE_TIMEOUT)
+        return Response({**detailed_data, 'quote': issue_quote(telegram_id, pricing, version)})
 
 # --- 3. ОБНОВЛЯЕМ CartView, ЧТОБЫ ОН ИСПОЛЬЗОВАЛ НОВУЮ ФУНКЦИЮ ---
 class CartView(TelegramAuthMixin):
+    """
+    Корзина пользователя. Состояние корзины берется из хранилища (см. carts.py).
+
+    Клиент может передать cart_version - версию корзины, которая у него есть
+    (в теле запроса или в query-параметре). Если она совпадает с версией на сервере
+    до изменения, в ответ уходит дельта: только изменившиеся строки (changed),
+    ID удаленных товаров (removed) и новые итоги. Иначе - полный снимок корзины,
+    как раньше. В обоих случаях ответ содержит новую cart_version.
+    ID строки корзины в ответе - это ID товара (товар встречается в корзине один раз).
+    """
+    def get_client_version(self, request):
+        value = request.query_params.get('cart_version', request.data.get('cart_version'))
+        try:
+            return int(value) if value is not None else None
+        except (TypeError, ValueError):
+            return None
+
+    def cart_response(self, request, telegram_id, state, previous_version):
+        """
+        Пересчитанная корзина: товары с категориями загружаются одним запросом.
+        Дельта отдается относительно previous_version, если клиент прислал именно ее.
+        """
+        # Версия цен снимается до чтения товаров и правил (см. issue_quote)
+        version = pricing_version(state['items'])
+        products = Product.objects.select_related('category').in_bulk(list(state['items']))
+        items = [
+            CartItem(id=product_id, product=products[product_id], quantity=quantity)
+            for product_id, quantity in state['items'].items()
+            if product_id in products
+        ]
+        detailed_data = calculate_detailed_discounts(items)
+        # Квота позволяет оформить заказ без повторного расчета (см. quotes.py)
+        detailed_data['quote'] = issue_quote(telegram_id, order_pricing(detailed_data), version)
+
+        # Состояние строк запоминаем, чтобы следующий ответ мог быть дельтой.
+        # Сравниваются и цены: скидка или цена могли измениться и у нетронутых строк.
+        lines = {
+            item['product'].id: (item['quantity'], str(item['original_price']), str(item['discounted_price']))
+            for item in detailed_data['items']
+        }
+        client_version = self.get_client_version(request)
+        previous = None
+        if client_version is not None and client_version == previous_version:
+            previous = cache.get(cart_lines_key(telegram_id, client_version))
+        cache.set(cart_lines_key(telegram_id, state['version']), lines, CART_LINES_TIMEOUT)
+
+        context = {'request': request}
+        if previous is None:
+            # Сериализуем "раскрашенные" товары (карточки берутся из кэша)
+            detailed_data['items'] = DetailedCartItemSerializer(detailed_data['items'], many=True, context=context).data
+            detailed_data.update(cart_version=state['version'], delta=False)
+            return Response(detailed_data, status=status.HTTP_200_OK)
+
+        changed = [item for item in detailed_data.pop('items') if previous.get(item['product'].id) != lines[item['product'].id]]
+        detailed_data.update(
+            cart_version=state['version'],
+            delta=True,
+            changed=DetailedCartItemSerializer(changed, many=True, context=context).data,
+            removed=[product_id for product_id in previous if product_id not in lines],
+        )
+        return Response(detailed_data, status=status.HTTP_200_OK)
+
     def get(self, request, *args, **kwargs):
-        telegram_id = request.telegram_user.get('id')
+        telegram_id = request.user.id
         if not telegram_id:
             return Response({"error": "Telegram ID не предоставлен"}, status=status.HTTP_400_BAD_REQUEST)
 
-        cart, _ = Cart.objects.prefetch_related('items__product__category', 'items__product__info_panels').get_or_create(telegram_id=telegram_id)
-
-        detailed_data = calculate_detailed_discounts(cart.items.all())
-        # Сериализуем "раскрашенные" товары
-        detailed_data['items'] = DetailedCartItemSerializer(detailed_data['items'], many=True, context={'request': request}).data
-
-        return Response(detailed_data)
+        state = get_cart(telegram_id)
+        return self.cart_response(request, telegram_id, state, state['version'])
 
     def post(self, request, *args, **kwargs):
         """Добавить/обновить/удалить товар и вернуть обновленную корзину с расчетами."""
-        telegram_id = request.telegram_user.get('id')
+        telegram_id = request.user.id
         if not telegram_id:
             return Response({"error": "Telegram ID не предоставлен"}, status=status.HTTP_400_BAD_REQUEST)
 
-        product_id = request.data.get('product_id')
-        quantity = int(request.data.get('quantity', 1))
+        try:
+            product_id = int(request.data.get('product_id') or 0)
+            quantity = int(request.data.get('quantity', 1))
+        except (TypeError, ValueError):
+            return Response({"error": "Некорректные product_id или quantity"}, status=status.HTTP_400_BAD_REQUEST)
 
         if not product_id:
             return Response({"error": "Product ID не предоставлен"}, status=status.HTTP_400_BAD_REQUEST)
 
-        cart, created = Cart.objects.get_or_create(telegram_id=telegram_id)
+        if quantity > 0 and not Product.objects.filter(id=product_id).exists():
+            return Response({"error": "Товар не найден"}, status=status.HTTP_404_NOT_FOUND)
+
+        # Количество 0 или меньше удаляет товар из корзины
+        state, previous_version = change_cart(telegram_id, {product_id: quantity})
+
+        # Возвращаем обновленное состояние корзины с расчетами
+        return self.cart_response(request, telegram_id, state, previous_version)
 
+    def patch(self, request, *args, **kwargs):
+        """
+        Пакетное изменение корзины: {"items": [{"product_id": 1, "quantity": 2}, ...]}.
+        Количество 0 удаляет позицию. Все изменения применяются атомарно.
+        """
+        telegram_id = request.user.id
+        if not telegram_id:
+            return Response({"error": "Telegram ID не предоставлен"}, status=status.HTTP_400_BAD_REQUEST)
+
+        changes = request.data.get('items')
+        if not isinstance(changes, list):
+            return Response({"error": "Ожидается список items"}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            product = Product.objects.get(id=product_id)
-        except Product.DoesNotExist:
-            return Response({"error": "Товар не найден"}, status=status.HTTP_404_NOT_FOUND)
+            # Для повторяющихся товаров действует последнее изменение
+            quantities = {int(change['product_id']): int(change['quantity']) for change in changes}
+        except (KeyError, TypeError, ValueError):
+            return Response({"error": "Некорректный список items"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if quantity > 0:
-            # Используем update_or_create для более чистого кода
-            cart_item, created = CartItem.objects.update_or_create(
-                cart=cart,
-                product=product,
-                defaults={'quantity': quantity}
-            )
-        else:
-            # Если количество 0 или меньше, удаляем товар из корзины
-            CartItem.objects.filter(cart=cart, product=product).delete()
+        to_add = [product_id for product_id, quantity in quantities.items() if quantity > 0]
+        if Product.objects.filter(id__in=to_add).count() != len(to_add):
+            return Response({"error": "Товар не найден"}, status=status.HTTP_404_NOT_FOUND)
 
-        # Возвращаем обновленное состояние всей корзины с расчетами
-        cart.refresh_from_db()
-        detailed_data = calculate_detailed_discounts(cart.items.all())
-        detailed_data['items'] = DetailedCartItemSerializer(detailed_data['items'], many=True, context={'request': request}).data
-        return Response(detailed_data, status=status.HTTP_200_OK)
+        state, previous_version = change_cart(telegram_id, quantities)
+        return self.cart_response(request, telegram_id, state, previous_version)
 
     def delete(self, request, *args, **kwargs):
         """Удалить несколько товаров из корзины по их ID."""
-        telegram_id = request.telegram_user.get('id')
+        telegram_id = request.user.id
         if not telegram_id:
             return Response({"error": "Telegram ID не предоставлен"}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -462,80 +505,150 @@ class CartView(TelegramAuthMixin):
         product_ids = request.data.get('product_ids', [])
         if not isinstance(product_ids, list):
             return Response({"error": "Ожидается список product_ids"}, status=status.HTTP_400_BAD_REQUEST)
-
         try:
-            cart = Cart.objects.get(telegram_id=telegram_id)
-            # Удаляем все CartItem, связанные с этой корзиной и переданными ID товаров
-            CartItem.objects.filter(cart=cart, product_id__in=product_ids).delete()
-        except Cart.DoesNotExist:
-            # Если корзины нет, значит, и удалять нечего. Просто возвращаем успех.
-            pass
+            quantities = {int(product_id): 0 for product_id in product_ids}
+        except (TypeError, ValueError):
+            return Response({"error": "Ожидается список product_ids"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Возвращаем обновленное состояние всей корзины с расчетами
-        cart, _ = Cart.objects.get_or_create(telegram_id=telegram_id)
-        detailed_data = calculate_detailed_discounts(cart.items.all())
-        detailed_data['items'] = DetailedCartItemSerializer(detailed_data['items'], many=True, context={'request': request}).data
-        return Response(detailed_data, status=status.HTTP_200_OK)
+        state, previous_version = change_cart(telegram_id, quantities)
+
+        # Возвращаем обновленное состояние корзины с расчетами
+        return self.cart_response(request, telegram_id, state, previous_version)
 
 
 class OrderCreateView(TelegramAuthMixin):
+    """
+    Оформление заказа. Заголовок Idempotency-Key (уникальный для попытки оформления)
+    защищает от дублей: повтор запроса с тем же ключом возвращает уже созданный заказ.
+    """
+    def created_response(self, order_id):
+        return Response({'success': True, 'order_id': order_id}, status=status.HTTP_201_CREATED)
+
     def post(self, request, *args, **kwargs):
-        telegram_id = request.telegram_user.get('id')
+        telegram_id = request.user.id
         if not telegram_id:
             return Response({"error": "Telegram ID не предоставлен"}, status=status.HTTP_400_BAD_REQUEST)
 
+        idempotency_key = request.headers.get('Idempotency-Key') or None
+        if idempotency_key and len(idempotency_key) > 64:
+            return Response({"error": "Слишком длинный Idempotency-Key"}, status=status.HTTP_400_BAD_REQUEST)
+        if idempotency_key:
+            # Повтор уже выполненного запроса отвечаем из кэша, не трогая БД
+            order_id = cache.get(order_idempotency_key(telegram_id, idempotency_key))
+            if order_id is not None:
+                return self.created_response(order_id)
+
         try:
-            cart = Cart.objects.get(telegram_id=telegram_id)
-            selected_product_ids = {item['product_id'] for item in request.data.get('items', [])}
-            if not selected_product_ids:
-                 return Response({"error": "В заказе нет товаров"}, status=status.HTTP_400_BAD_REQUEST)
-            items_to_order = cart.items.filter(product_id__in=selected_product_ids)
-            if not items_to_order.exists():
+            selected_product_ids = {int(item['product_id']) for item in request.data.get('items', [])}
+        except (KeyError, TypeError, ValueError):
+            return Response({"error": "Некорректный список товаров"}, status=status.HTTP_400_BAD_REQUEST)
+        if not selected_product_ids:
+            return Response({"error": "В заказе нет товаров"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Корзина заблокирована до конца оформления: заказ считается ровно по тому
+        # состоянию, из которого потом удаляются заказанные товары
+        with cart_lock(telegram_id):
+            if idempotency_key:
+                # Параллельный повтор мог успеть оформить заказ, пока мы ждали блокировку
+                order_id = self.find_order(telegram_id, idempotency_key)
+                if order_id is not None:
+                    return self.created_response(order_id)
+
+            state = get_cart(telegram_id)
+            if not state['items']:
+                return Response({"error": "Корзина не найдена"}, status=status.HTTP_404_NOT_FOUND)
+
+            ordered = [
+                (product_id, quantity) for product_id, quantity in state['items'].items()
+                if product_id in selected_product_ids
+            ]
+            if not ordered:
                 return Response({"error": "Выбранные товары не найдены в корзине"}, status=status.HTTP_400_BAD_REQUEST)
-        except Cart.DoesNotExist:
-            return Response({"error": "Корзина не найдена"}, status=status.HTTP_404_NOT_FOUND)
 
-        calculation_results = calculate_detailed_discounts(list(items_to_order))
+            # Расчет из квоты страницы оформления; пересчитываем, только если она
+            # истекла или с тех пор изменились цены, правила скидок или состав заказа
+            pricing = redeem_quote(request.data.get('quote'), telegram_id, ordered)
+            if pricing is None:
+                products = Product.objects.select_related('category').in_bulk([product_id for product_id, _ in ordered])
+                items_to_order = [
+                    CartItem(id=product_id, product=products[product_id], quantity=quantity)
+                    for product_id, quantity in ordered if product_id in products
+                ]
+                if not items_to_order:
+                    return Response({"error": "Выбранные товары не найдены в корзине"}, status=status.HTTP_400_BAD_REQUEST)
+                pricing = order_pricing(calculate_detailed_discounts(items_to_order))
+
+            serializer = OrderCreateSerializer(data=request.data, context={'telegram_id': telegram_id, 'pricing': pricing})
+
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+            # Шаг 1: Одной транзакцией сохраняем заказ со всеми позициями
+            # и уведомление менеджеру (его отправит воркер run_outbox_worker, см. outbox.py)
+            try:
+                order = serializer.save(idempotency_key=idempotency_key)
+            except IntegrityError:
+                # Заказ с этим ключом создал параллельный запрос в обход блокировки
+                order_id = self.find_order(telegram_id, idempotency_key) if idempotency_key else None
+                if order_id is None:
+                    raise
+                return self.created_response(order_id)
+
+            if idempotency_key:
+                cache.set(order_idempotency_key(telegram_id, idempotency_key), order.id, ORDER_IDEMPOTENCY_TIMEOUT)
 
-        serializer = OrderCreateSerializer(data=request.data, context={'telegram_id': telegram_id, 'calculation_results': calculation_results})
+            # Шаг 2: Очищаем корзину от заказанных товаров
+            change_locked_cart(telegram_id, {product_id: 0 for product_id, _, _ in pricing['items']})
 
-        if serializer.is_valid():
-            # Шаг 1: Просто сохраняем заказ в нашей базе данных
-            order = serializer.save()
+        return self.created_response(order.id)
 
-            # Шаг 2: Выводим в консоль сервера сообщение
-            # В будущем сюда можно добавить отправку уведомления менеджеру в Telegram
-            print(f"Новый заказ #{order.id} успешно создан и сохранен в Django Admin.")
+    def find_order(self, telegram_id, idempotency_key):
+        """ID заказа, уже оформленного с этим ключом (кэш, затем БД)."""
+        order_id = cache.get(order_idempotency_key(telegram_id, idempotency_key))
+        if order_id is None:
+            order_id = Order.objects.filter(
+                telegram_id=telegram_id, idempotency_key=idempotency_key
+            ).values_list('id', flat=True).first()
+        return order_id
 
-            # Шаг 3: Очищаем корзину от заказанных товаров
-            items_to_order.delete()
 
-            return Response({'success': True, 'order_id': order.id}, status=status.HTTP_201_CREATED)
-        else:
-            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+def is_blog_index_request(request):
+    """Первая страница ленты (только фильтр по категории) - ее ответ кэшируется целиком."""
+    return set(request.GET) <= {'category'}
 
 
+def blog_index_etag(request, *args, **kwargs):
+    if not is_blog_index_request(request):
+        return None
+    return f"blog-{get_blog_version()}"
+
+
+@method_decorator(etag(blog_index_etag), name='get')
 class ArticleListView(generics.ListAPIView):
     """
     Возвращает комплексные данные для страницы блога:
     - Список всех категорий для фильтрации.
     - Список статей с пагинацией, фильтрацией по категории и сортировкой.
+
+    Первая страница каждой категории кэшируется под версией блога: версия меняется
+    при изменении статей/категорий и при наступлении даты отложенной публикации
+    (см. Article.publish_scheduled), поэтому выборка не зависит от текущего времени.
     """
     serializer_class = ArticleListSerializer
-    pagination_class = StandardResultsSetPagination
+    pagination_class = KeysetResultsSetPagination
 
     # 1. ИЗМЕНЕНИЕ: Добавляем OrderingFilter и разрешаем сортировку по просмотрам
-    filter_backends = [filters.OrderingFilter, filters.SearchFilter]
-    search_fields = ['title', 'content']
+    filter_backends = [filters.OrderingFilter, FullTextSearchFilter]
+    search_fields = ['title', 'plain_text']
+    search_trigram_field = 'title'
     ordering_fields = ['published_at', 'views_count']
     ordering = ['-published_at'] # Сортировка по умолчанию
 
     def get_queryset(self):
         """Формирует основной queryset статей на основе параметров запроса."""
         queryset = Article.objects.filter(
-            status=Article.Status.PUBLISHED,
-            published_at__lte=timezone.now() # Учитываем отложенную публикацию
-        ).select_related('category')
+            is_visible=True # Опубликована и дата публикации наступила
+        ).select_related('category').defer('content', 'plain_text') # Тексты в списке не нужны
 
         # Фильтрация по категории
         category_slug = self.request.query_params.get('category')
@@ -549,6 +662,18 @@ class ArticleListView(generics.ListAPIView):
         Переопределяем стандартный метод .list() для добавления
         дополнительных данных в API-ответ.
         """
+        version = get_blog_version()
+        if not is_blog_index_request(request):
+            return Response(self.get_list_data(version))
+
+        key = blog_index_key(version, request.query_params.get('category', ''), request.build_absolute_uri('/'))
+        data = cache.get(key)
+        if data is None:
+            data = self.get_list_data(version)
+            cache.set(key, data, BLOG_INDEX_TIMEOUT)
+        return Response(data)
+
+    def get_list_data(self, version):
         # 1. Получаем основной отфильтрованный и отсортированный список статей с пагинацией
         queryset = self.filter_queryset(self.get_queryset())
         page = self.paginate_queryset(queryset)
@@ -559,36 +684,39 @@ class ArticleListView(generics.ListAPIView):
             articles_serializer = self.get_serializer(queryset, many=True)
             paginated_response = Response(articles_serializer.data)
 
-        # 2. Получаем список всех категорий
-        categories = ArticleCategory.objects.all()
-        categories_serializer = ArticleCategorySerializer(categories, many=True)
+        # 2. Получаем список всех категорий (меняется вместе с версией блога)
+        categories = cache.get(blog_categories_key(version))
+        if categories is None:
+            categories = ArticleCategorySerializer(ArticleCategory.objects.all(), many=True).data
+            cache.set(blog_categories_key(version), categories, BLOG_INDEX_TIMEOUT)
 
         # 3. Собираем финальный ответ
-        data = {
-            'categories': categories_serializer.data,
+        return {
+            'categories': categories,
             'articles': paginated_response.data # Здесь уже есть 'results', 'next', 'count' и т.д.
         }
 
-        return Response(data)
-
 
 class ArticleDetailView(generics.RetrieveAPIView):
     """Возвращает одну статью по её slug."""
-    queryset = Article.objects.filter(status=Article.Status.PUBLISHED)
+    queryset = Article.objects.filter(is_visible=True)
     serializer_class = ArticleDetailSerializer
     lookup_field = 'slug' # Указываем, что искать нужно по полю 'slug', а не по 'id'
 
 class ArticleIncrementViewCountView(APIView):
     """
-    Увеличивает счётчик просмотров для статьи на 1.
-    Безопасен с точки зрения race conditions.
+    Засчитывает просмотр статьи. Просмотры копятся в буфере и пишутся
+    в БД пачкой (см. counters.py), поэтому строка статьи не блокируется.
+    Пользователь Telegram (если есть initData) нужен для дедупликации за день;
+    с устаревшим initData просмотр засчитывается анонимно.
     """
+    authentication_classes = [OptionalTelegramInitDataAuthentication]
+    permission_classes = [AllowAny]
+
     def post(self, request, slug, *args, **kwargs):
-        try:
-            article = Article.objects.get(slug=slug, status=Article.Status.PUBLISHED)
-            # Используем F() для атомарного увеличения значения в базе данных
-            article.views_count = F('views_count') + 1
-            article.save(update_fields=['views_count'])
-            return Response(status=status.HTTP_200_OK)
-        except Article.DoesNotExist:
-            return Response(status=status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+        article_id = Article.objects.filter(slug=slug, is_visible=True).values_list('id', flat=True).first()
+        if article_id is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        viewer_id = request.user.id if request.user.is_authenticated else None
+        record_article_view(article_id, viewer_id)
+        return Response(status=status.HTTP_200_OK)
\ No newline at end of file
@@ -1,6 +1,6 @@
 // frontend/src/context/CartContext.js
 
-import React, { createContext, useState, useContext, useEffect, useCallback } from 'react';
+import React, { createContext, useState, useContext, useEffect, useCallback, useRef } from 'react';
 import apiClient from '../api';
 import { useTelegram } from '../utils/telegram';
 import debounce from 'lodash.debounce';
@@ -40,8 +40,34 @@ export const CartProvider = ({ children }) => {
         }
     }, 300), []); // Задержка в 300 мс
 
-    // Функция для обновления состояния из ответа сервера (без изменений)
-    const updateStateFromServer = (data) => {
+    // Версия корзины и строки, которые у нас есть: сервер отвечает на изменения
+    // дельтой (changed/removed) относительно этой версии, если она не устарела
+    const cartVersionRef = useRef(null);
+    const cartItemsRef = useRef([]);
+
+    // Собирает полный список строк из дельта-ответа сервера
+    const applyDelta = (data) => {
+        const changed = new Map(data.changed.map(item => [item.product.id, item]));
+        const removed = new Set(data.removed);
+        const items = cartItemsRef.current
+            .filter(item => !removed.has(item.product.id))
+            .map(item => changed.get(item.product.id) || item);
+        const known = new Set(items.map(item => item.product.id));
+        // Новые строки сервер добавляет в конец корзины
+        data.changed.forEach(item => {
+            if (!known.has(item.product.id)) items.push(item);
+        });
+        return { ...data, items };
+    };
+
+    // Функция для обновления состояния из ответа сервера
+    const updateStateFromServer = (response) => {
+        const data = response && response.delta ? applyDelta(response) : response;
+        if (data && data.cart_version !== undefined) {
+            cartVersionRef.current = data.cart_version;
+        }
+        cartItemsRef.current = (data && data.items) || [];
+
         if (data && data.items) {
             // Мы больше НЕ преобразуем `data.items`.
             // Бэкенд уже отдает их в идеальном виде.
@@ -64,6 +90,7 @@ export const CartProvider = ({ children }) => {
                 final_total: data.final_total,
                 applied_rule: data.applied_rule,
                 upsell_hint: data.upsell_hint,
+                quote: data.quote, // Подписанный расчет для оформления заказа
             });
 
         } else {
@@ -120,18 +147,21 @@ export const CartProvider = ({ children }) => {
         }
     };
 
+    // Тело изменяющего запроса с версией корзины, которая есть у клиента
+    const withVersion = (body) => ({ ...body, cart_version: cartVersionRef.current });
+
     const addToCart = (product) => {
         const existingItem = cartItems.find(item => item.product.id === product.id);
         const newQuantity = existingItem ? existingItem.quantity + 1 : 1;
         if (newQuantity > MAX_QUANTITY) return;
-        handleCartAction(() => apiClient.post('/cart/', { product_id: product.id, quantity: newQuantity }));
+        handleCartAction(() => apiClient.post('/cart/', withVersion({ product_id: product.id, quantity: newQuantity })));
     };
 
     // ИЗМЕНЕНИЕ: Полностью переработанная функция с валидацией
     const updateQuantity = (productId, quantity) => {
         // Правило №1: Если количество становится 0 или меньше, удаляем товар (quantity = 0)
         if (quantity < 1) {
-            handleCartAction(() => apiClient.post('/cart/', { product_id: productId, quantity: 0 }));
+            handleCartAction(() => apiClient.post('/cart/', withVersion({ product_id: productId, quantity: 0 })));
             return;
         }
 
@@ -143,7 +173,7 @@ export const CartProvider = ({ children }) => {
         }
 
         // Если все проверки пройдены, отправляем запрос на обновление
-        handleCartAction(() => apiClient.post('/cart/', { product_id: productId, quantity: quantity }));
+        handleCartAction(() => apiClient.post('/cart/', withVersion({ product_id: productId, quantity: quantity })));
     };
 
     const toggleItemSelection = (productId) => {
@@ -174,15 +204,16 @@ export const CartProvider = ({ children }) => {
     const deleteSelectedItems = () => {
         const product_ids = Array.from(selectedItems);
         // Используем новый DELETE-метод нашего API
-        handleCartAction(() => apiClient.delete('/cart/', { data: { product_ids } }));
+        handleCartAction(() => apiClient.delete('/cart/', { data: withVersion({ product_ids }) }));
         // Очищаем выбор после удаления
         setSelectedItems(new Set());
     };
 
+    // Очищаем корзину одним пакетным запросом (количество 0 удаляет позицию)
     const clearCart = () => {
-        cartItems.forEach(item => {
-            handleCartAction(() => apiClient.post('/cart/', { product_id: item.product.id, quantity: 0 }));
-        });
+        const items = cartItems.map(item => ({ product_id: item.product.id, quantity: 0 }));
+        if (items.length === 0) return;
+        handleCartAction(() => apiClient.patch('/cart/', withVersion({ items })));
     };
 
     const value = {
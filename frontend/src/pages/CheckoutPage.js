@@ -1,5 +1,5 @@
 // проект/frontend/src/pages/CheckoutForm.js
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
 import { useForm, Controller, useWatch } from 'react-hook-form';
 import { IMaskInput } from 'react-imask';
@@ -18,6 +18,11 @@ const CheckoutPage = () => {
     const navigate = useNavigate();
     const { cartItems, selectedItems, selectionInfo, deleteSelectedItems } = useCart();
     const [isAgreed, setIsAgreed] = useState(false);
+    // Один ключ на попытку оформления: повторная отправка (например, после обрыва связи)
+    // вернет уже созданный заказ вместо дубля
+    const idempotencyKeyRef = useRef(
+        window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`
+    );
 
     const {
         register,
@@ -65,9 +70,13 @@ const CheckoutPage = () => {
         };
 
         orderDataForBackend.items = itemsToOrder;
+        // Подписанный расчет со страницы корзины: сервер не пересчитывает скидки, если он актуален
+        orderDataForBackend.quote = selectionInfo.quote;
 
         try {
-            await apiClient.post('/orders/create/', orderDataForBackend);
+            await apiClient.post('/orders/create/', orderDataForBackend, {
+                headers: { 'Idempotency-Key': idempotencyKeyRef.current },
+            });
             sendTelegramMessage(formData);
             deleteSelectedItems();
             tg.close();